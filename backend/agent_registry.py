@@ -0,0 +1,338 @@
+import contextlib
+import os
+import threading
+import time
+
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+from vertexai.generative_models import GenerationConfig, GenerativeModel
+from context_builder import estimate_tokens
+from resilience import call, call_async, error_status
+from quota_governor import QuotaGovernor, lane_for, VERTEX_QUOTA_OUTPUT_TOKENS, VERTEX_QUOTA_MEDIA_TOKENS
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# off: 通常の system_instruction / vertex: Vertex AI のコンテキストキャッシュ / local: ローカル検証用の代替
+AGENT_CONTEXT_CACHE = os.getenv("AGENT_CONTEXT_CACHE", "off").lower()
+AGENT_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("AGENT_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# Vertex のコンテキストキャッシュには最小トークン数がある（これ未満の指示はキャッシュしない）
+AGENT_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("AGENT_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+# 期限切れ直前のキャッシュは作り直す
+_CACHE_REFRESH_MARGIN = timedelta(minutes=5)
+
+
+def _generation_kwargs(generation_config: Optional[dict]) -> Dict[str, Any]:
+    """
+    generate_content に渡す generation_config。
+    response_schema を含む dict は SDK がそのまま proto に渡して失敗するため GenerationConfig に変換する
+    """
+    if not generation_config:
+        return {}
+    if isinstance(generation_config, dict) and "response_schema" in generation_config:
+        return {"generation_config": GenerationConfig.from_dict(generation_config)}
+    return {"generation_config": generation_config}
+
+
+def _usage_tokens(usage: Any) -> Optional[int]:
+    """usage_metadata の合計トークン数（取れなければ None = 見積もりのまま精算しない）"""
+    return getattr(usage, "total_token_count", 0) or None
+
+
+class _AgentEntry:
+    def __init__(self, name: str, model_id: str, system_instruction: str):
+        self.name = name
+        self.model_id = model_id
+        self.system_instruction = system_instruction
+        self.instruction_tokens = estimate_tokens(system_instruction)
+        self.model: Optional[GenerativeModel] = None
+        self.cached_content: Any = None
+        self.cache_expires_at: Optional[datetime] = None
+        self.lock = threading.Lock()
+
+
+class AgentRegistry:
+    """
+    エージェント（システム指示）ごとに GenerativeModel を1度だけ生成して使い回す。
+    AGENT_CONTEXT_CACHE=vertex なら静的なシステム指示を Vertex のコンテキストキャッシュに置き、
+    リクエストごとに同じ指示を送らないようにする（作成に失敗したら通常のモデルで続行）。
+    AGENT_CONTEXT_CACHE=local は Vertex を使わずにキャッシュ経路を再現するローカル用の代替で、
+    モデルは通常どおり呼び出し、キャッシュできたはずのトークン数だけを集計する。
+    """
+
+    def __init__(self, model_id: str, context_cache: str = AGENT_CONTEXT_CACHE, governor: Optional[QuotaGovernor] = None):
+        self.model_id = model_id
+        self.context_cache = context_cache
+        # 全エージェント共通のクォータ制御（None なら制限しない）
+        self.governor = governor
+        self._agents: Dict[str, _AgentEntry] = {}
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = defaultdict(lambda: {
+            "calls": 0,
+            "errors": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "output_tokens": 0,
+            "latency_seconds": 0.0,
+            "streams": 0,
+            "ttft_seconds": 0.0,
+            "model_builds": 0,
+            "cache_creates": 0,
+        })
+
+    def register(self, name: str, system_instruction: str):
+        self._agents[name] = _AgentEntry(name, self.model_id, system_instruction)
+
+    def instruction(self, name: str) -> str:
+        return self._agents[name].system_instruction
+
+    def _count(self, name: str, **amounts):
+        with self._stats_lock:
+            s = self._stats[name]
+            for k, v in amounts.items():
+                s[k] += v
+
+    def _create_cached_content(self, entry: _AgentEntry):
+        if self.context_cache == "local":
+            return f"local/{entry.name}"
+        from vertexai.preview import caching
+        return caching.CachedContent.create(
+            model_name=entry.model_id,
+            system_instruction=entry.system_instruction,
+            ttl=timedelta(seconds=AGENT_CONTEXT_CACHE_TTL_SECONDS),
+            display_name=f"agent-{entry.name}",
+        )
+
+    def _cache_wanted(self, entry: _AgentEntry) -> bool:
+        return self.context_cache in ("vertex", "local") and entry.instruction_tokens >= AGENT_CONTEXT_CACHE_MIN_TOKENS
+
+    def model(self, name: str) -> GenerativeModel:
+        entry = self._agents[name]
+        now = datetime.now(timezone.utc)
+        if entry.model is not None and (entry.cache_expires_at is None or entry.cache_expires_at - _CACHE_REFRESH_MARGIN > now):
+            return entry.model
+
+        with entry.lock:
+            if entry.model is not None and (entry.cache_expires_at is None or entry.cache_expires_at - _CACHE_REFRESH_MARGIN > now):
+                return entry.model
+
+            if self._cache_wanted(entry):
+                try:
+                    entry.cached_content = self._create_cached_content(entry)
+                    entry.cache_expires_at = now + timedelta(seconds=AGENT_CONTEXT_CACHE_TTL_SECONDS)
+                    self._count(name, cache_creates=1)
+                    if self.context_cache == "vertex":
+                        entry.model = GenerativeModel.from_cached_content(cached_content=entry.cached_content)
+                        self._count(name, model_builds=1)
+                        print(f"🧊 [{name}] system instruction cached ({entry.instruction_tokens} tokens)")
+                        return entry.model
+                except Exception as e:
+                    print(f"⚠️ [{name}] context cache unavailable, using plain model: {e}")
+                    entry.cached_content = None
+                    entry.cache_expires_at = None
+                    # 期限切れのキャッシュに紐づいたモデルを使い続けないよう、通常のモデルを作り直す
+                    entry.model = None
+
+            if entry.model is None:
+                entry.model = GenerativeModel(model_name=entry.model_id, system_instruction=entry.system_instruction)
+                self._count(name, model_builds=1)
+            return entry.model
+
+    def generate(self, name: str, contents: Any, generation_config: Optional[dict] = None) -> str:
+        """エージェントのモデルで generate_content を呼び、テキストを返す（トークン数・所要時間を集計）"""
+        model = self.model(name)
+        kwargs = _generation_kwargs(generation_config)
+
+        def attempt():
+            try:
+                return model.generate_content(contents, **kwargs)
+            except Exception as e:
+                self._note_error(e)
+                raise
+
+        start = time.perf_counter()
+        try:
+            # 429 / 503 などは締め切り内でバックオフ付き再試行（設定によってはヘッジ）する。
+            # クォータの枠は試行ごとに取り直すので、429 で絞った後の再試行も待ち行列に並ぶ
+            response = call("llm", attempt, admit=self._admitter(name, contents))
+            text = response.text
+        except Exception:
+            self._count(name, calls=1, errors=1, latency_seconds=time.perf_counter() - start)
+            raise
+
+        self._record_usage(name, getattr(response, "usage_metadata", None), start)
+        return text
+
+    def stream(self, name: str, contents: Any, generation_config: Optional[dict] = None) -> Iterator[str]:
+        """generate_content(stream=True) のテキストチャンクを順に返す（最初のチャンクまでの時間も集計）"""
+        model = self.model(name)
+        ttft = None
+        usage = None
+        kwargs = _generation_kwargs(generation_config)
+        with self._quota(name, contents) as quota:
+            start = time.perf_counter()
+            try:
+                for chunk in model.generate_content(contents, stream=True, **kwargs):
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # 最後のチャンクは usage_metadata だけでテキストを持たないことがある
+                        continue
+                    if not text:
+                        continue
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    yield text
+            except Exception as e:
+                self._note_error(e)
+                self._count(name, calls=1, errors=1, latency_seconds=time.perf_counter() - start)
+                raise
+
+            self._count(name, streams=1, ttft_seconds=ttft or 0.0)
+            quota["tokens"] = self._record_usage(name, usage, start)
+
+    async def generate_async(self, name: str, contents: Any, generation_config: Optional[dict] = None) -> str:
+        """generate の asyncio 版（generate_content_async を使い、スレッドを占有しない）"""
+        model = self.model(name)
+        kwargs = _generation_kwargs(generation_config)
+
+        async def attempt():
+            try:
+                return await model.generate_content_async(contents, **kwargs)
+            except Exception as e:
+                self._note_error(e)
+                raise
+
+        start = time.perf_counter()
+        try:
+            response = await call_async("llm", attempt, admit=self._admitter_async(name, contents))
+            text = response.text
+        except Exception:
+            self._count(name, calls=1, errors=1, latency_seconds=time.perf_counter() - start)
+            raise
+
+        self._record_usage(name, getattr(response, "usage_metadata", None), start)
+        return text
+
+    async def stream_async(self, name: str, contents: Any, generation_config: Optional[dict] = None) -> AsyncIterator[str]:
+        """stream の asyncio 版"""
+        model = self.model(name)
+        ttft = None
+        usage = None
+        kwargs = _generation_kwargs(generation_config)
+        async with self._quota_async(name, contents) as quota:
+            start = time.perf_counter()
+            try:
+                async for chunk in await model.generate_content_async(contents, stream=True, **kwargs):
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        continue
+                    if not text:
+                        continue
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    yield text
+            except Exception as e:
+                self._note_error(e)
+                self._count(name, calls=1, errors=1, latency_seconds=time.perf_counter() - start)
+                raise
+
+            self._count(name, streams=1, ttft_seconds=ttft or 0.0)
+            quota["tokens"] = self._record_usage(name, usage, start)
+
+    def _estimate_tokens(self, name: str, contents: Any) -> int:
+        """クォータの見積もり: システム指示 + プロンプト + 出力の想定（画像・動画は1パートあたりの固定値）"""
+        parts = contents if isinstance(contents, list) else [contents]
+        prompt = sum(estimate_tokens(p) if isinstance(p, str) else VERTEX_QUOTA_MEDIA_TOKENS for p in parts)
+        return self._agents[name].instruction_tokens + prompt + VERTEX_QUOTA_OUTPUT_TOKENS
+
+    @contextlib.contextmanager
+    def _quota(self, name: str, contents: Any):
+        """クォータの枠を確保して実行する。with の中で quota["tokens"] に実際の使用量を入れると精算する"""
+        if self.governor is None:
+            yield {}
+            return
+        ticket = self.governor.admit(lane_for(name), self._estimate_tokens(name, contents))
+        quota = {}
+        try:
+            yield quota
+        finally:
+            self.governor.release(ticket, quota.get("tokens"))
+
+    def _admitter(self, name: str, contents: Any):
+        """
+        resilience.call の admit: 試行ごとに枠を確保し、その送信が終わったら実際の使用量で精算する関数を返す。
+        レーンはここで決めておく（ヘッジの2本目はプールのスレッドで確保するため contextvars が届かない）
+        """
+        if self.governor is None:
+            return None
+        lane, tokens = lane_for(name), self._estimate_tokens(name, contents)
+
+        def admit():
+            ticket = self.governor.admit(lane, tokens)
+            return lambda response: self.governor.release(ticket, _usage_tokens(getattr(response, "usage_metadata", None)))
+        return admit
+
+    def _admitter_async(self, name: str, contents: Any):
+        if self.governor is None:
+            return None
+        lane, tokens = lane_for(name), self._estimate_tokens(name, contents)
+
+        async def admit():
+            ticket = await self.governor.admit_async(lane, tokens)
+            return lambda response: self.governor.release(ticket, _usage_tokens(getattr(response, "usage_metadata", None)))
+        return admit
+
+    @contextlib.asynccontextmanager
+    async def _quota_async(self, name: str, contents: Any):
+        if self.governor is None:
+            yield {}
+            return
+        ticket = await self.governor.admit_async(lane_for(name), self._estimate_tokens(name, contents))
+        quota = {}
+        try:
+            yield quota
+        finally:
+            self.governor.release(ticket, quota.get("tokens"))
+
+    def _note_error(self, e: Exception):
+        # 見積もりより実際のクォータが厳しい。待ち行列側も回復を待たせる
+        if self.governor is not None and error_status(e) == 429:
+            self.governor.throttle()
+
+    def _record_usage(self, name: str, usage: Any, start: float) -> Optional[int]:
+        entry = self._agents[name]
+        cached = getattr(usage, "cached_content_token_count", 0) or 0
+        if self.context_cache == "local" and entry.cached_content is not None:
+            cached = entry.instruction_tokens
+        self._count(
+            name,
+            calls=1,
+            latency_seconds=time.perf_counter() - start,
+            prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            cached_tokens=cached,
+            output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+        )
+        return _usage_tokens(usage)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            agents = {}
+            for name, s in self._stats.items():
+                calls = s["calls"] or 1
+                agents[name] = {
+                    **{k: (round(v, 3) if isinstance(v, float) else int(v)) for k, v in s.items()},
+                    "avg_prompt_tokens": round(s["prompt_tokens"] / calls, 1),
+                    "avg_cached_tokens": round(s["cached_tokens"] / calls, 1),
+                    "avg_latency_seconds": round(s["latency_seconds"] / calls, 3),
+                    "avg_ttft_seconds": round(s["ttft_seconds"] / s["streams"], 3) if s["streams"] else None,
+                }
+        return {
+            "context_cache": self.context_cache,
+            "instruction_tokens": {n: e.instruction_tokens for n, e in self._agents.items()},
+            "agents": agents,
+        }
@@ -0,0 +1,139 @@
+import os
+import threading
+
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud import firestore, storage
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROJECT_ID = os.getenv("GCP_PROJECT_ID", "tier3-ops-resolver")
+UPLOAD_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME", "tier3-ops-resolver-uploads")
+ATTACHMENT_INDEX_COLLECTION = os.getenv("ATTACHMENT_INDEX_COLLECTION", "attachments")
+CAS_PREFIX = "blobs/sha256"
+
+# 添付はSHA-256で内容アドレス化して保存する:
+#   GCS:       blobs/sha256/{sha256}（旧形式は blobs/sha256/{sha256}.{ext}）
+#   Firestore: attachments/{sha256} -> {uri, size, mime_type, filenames, message_ids, analyzed_case_ids}
+# 同じ内容でも参照ごとにファイル名は違うので、Gemini に渡す MIME は URI の拡張子ではなく索引の mime_type を使う
+
+# Gemini に渡せる形式（拡張子 -> MIME）
+_EXT_MIME_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg", "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "heic": "image/heif", "heif": "image/heif",
+    "mp4": "video/mp4", "mov": "video/mp4", "mpeg": "video/mp4", "mpg": "video/mp4", "avi": "video/mp4",
+    "pdf": "application/pdf",
+    **{ext: "text/plain" for ext in ("txt", "log", "csv", "json", "py", "js", "html", "xml")},
+}
+_lock = threading.Lock()
+_storage_client = None
+_db = None
+
+def get_storage_client() -> storage.Client:
+    global _storage_client
+    if _storage_client is None:
+        with _lock:
+            if _storage_client is None:
+                _storage_client = storage.Client(project=PROJECT_ID)
+    return _storage_client
+
+def _get_db() -> firestore.Client:
+    global _db
+    if _db is None:
+        with _lock:
+            if _db is None:
+                _db = firestore.Client(project=PROJECT_ID)
+    return _db
+
+def _index_ref(sha256: str):
+    return _get_db().collection(ATTACHMENT_INDEX_COLLECTION).document(sha256)
+
+def _blob_path(sha256: str) -> str:
+    return f"{CAS_PREFIX}/{sha256}"
+
+def mime_type_for(name: str) -> Optional[str]:
+    """ファイル名（または URI）の拡張子から Gemini に渡す MIME を決める。対応していない形式なら None"""
+    ext = os.path.splitext(name)[1].lower().lstrip(".")
+    return _EXT_MIME_TYPES.get(ext)
+
+def sha256_from_uri(uri: str) -> Optional[str]:
+    """内容アドレス化された gs:// URI から SHA-256 を取り出す（旧形式の URI は None）"""
+    marker = f"/{CAS_PREFIX}/"
+    if marker not in uri:
+        return None
+    return os.path.splitext(uri.split(marker, 1)[1])[0] or None
+
+def store_attachment(fileobj, sha256: str, size: int, filename: str, content_type: Optional[str], msg_id: str, chunk_size: Optional[int] = None) -> Tuple[str, bool]:
+    """
+    添付を保存し (gs:// URI, 重複かどうか) を返す。
+    同じ内容が既にあればアップロードせず、索引に参照（メッセージID/ファイル名）を追加するだけ。
+    """
+    index_ref = _index_ref(sha256)
+    mime_type = mime_type_for(filename)
+    snap = index_ref.get()
+    if snap.exists:
+        entry = snap.to_dict()
+        updates = {
+            "filenames": firestore.ArrayUnion([filename]),
+            "message_ids": firestore.ArrayUnion([msg_id]),
+            "ref_count": firestore.Increment(1),
+        }
+        # 最初の参照が対応外の拡張子（.bin など）だった場合は、判定できた名前で埋める
+        if mime_type and not entry.get("mime_type"):
+            updates["mime_type"] = mime_type
+        index_ref.update(updates)
+        return entry["uri"], True
+
+    blob_path = _blob_path(sha256)
+    blob = get_storage_client().bucket(UPLOAD_BUCKET_NAME).blob(blob_path, chunk_size=chunk_size)
+    try:
+        # 他のワーカーが同じ内容を同時にアップロードしていても上書きしない
+        blob.upload_from_file(fileobj, content_type=content_type, if_generation_match=0)
+    except PreconditionFailed:
+        pass
+
+    uri = f"gs://{UPLOAD_BUCKET_NAME}/{blob_path}"
+    index_ref.set({
+        "sha256": sha256,
+        "uri": uri,
+        "size": size,
+        "content_type": content_type,
+        "mime_type": mime_type,
+        "filenames": firestore.ArrayUnion([filename]),
+        "message_ids": firestore.ArrayUnion([msg_id]),
+        "ref_count": firestore.Increment(1),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }, merge=True)
+    return uri, False
+
+def lookup_attachments(uris: Iterable[str]) -> Dict[str, dict]:
+    """URI -> 索引エントリ（内容アドレス化されていない URI は含まれない）"""
+    by_sha = {sha: uri for uri in uris if (sha := sha256_from_uri(uri))}
+    if not by_sha:
+        return {}
+    refs = [_index_ref(sha) for sha in by_sha]
+    entries = {}
+    for snap in _get_db().get_all(refs):
+        if snap.exists:
+            entries[by_sha[snap.id]] = snap.to_dict()
+    return entries
+
+def attachment_mime_type(uri: str, entry: Optional[dict]) -> Optional[str]:
+    """索引に記録した MIME を優先し、索引のない URI（アップロード画面から・旧形式）は拡張子で判定する"""
+    if entry and entry.get("mime_type"):
+        return entry["mime_type"]
+    return mime_type_for(uri)
+
+def mark_attachments_analyzed(uris: List[str], case_id: str):
+    for uri in uris:
+        sha = sha256_from_uri(uri)
+        if not sha:
+            continue
+        try:
+            _index_ref(sha).update({"analyzed_case_ids": firestore.ArrayUnion([case_id])})
+        except Exception as e:
+            print(f"⚠️ Failed to mark attachment analyzed ({uri}): {e}")
@@ -0,0 +1,58 @@
+"""
+既存ケースから Gmail スレッド索引 (gmail_threads/{thread_id} -> {case_id}) を作成する。
+索引導入前に作成されたケースへの返信を、件名タグなしでも既存ケースに紐づけるために1回実行する。
+
+Usage: python backfill_thread_index.py [--dry-run] [--project PROJECT_ID]
+"""
+import argparse
+import os
+from datetime import datetime, timezone
+
+from google.cloud import firestore
+from dotenv import load_dotenv
+
+from case_store import THREAD_INDEX_COLLECTION
+
+load_dotenv()
+
+PROJECT_ID = os.getenv("GCP_PROJECT_ID", "tier3-ops-resolver")
+BATCH_SIZE = 400
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--project", default=PROJECT_ID, help="対象の GCP プロジェクト（既定: GCP_PROJECT_ID）")
+    args = parser.parse_args()
+
+    db = firestore.Client(project=args.project)
+    docs = db.collection("cases").select(["gmail_thread_id"]).stream()
+
+    batch = db.batch()
+    pending = 0
+    total = 0
+    for d in docs:
+        thread_id = (d.to_dict() or {}).get("gmail_thread_id")
+        if not thread_id:
+            continue
+        total += 1
+        print(f"{thread_id} -> {d.id}")
+        if args.dry_run:
+            continue
+        batch.set(db.collection(THREAD_INDEX_COLLECTION).document(thread_id), {
+            "case_id": d.id,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        })
+        pending += 1
+        if pending >= BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+
+    print(f"✅ {total} thread mappings {'found' if args.dry_run else 'written'}.")
+
+
+if __name__ == "__main__":
+    main()
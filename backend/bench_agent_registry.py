@@ -0,0 +1,145 @@
+"""
+エージェントごとのモデル生成コストと、システム指示の送信量の計測
+
+  オフライン（デフォルト）:
+    before   : 呼び出しごとに GenerativeModel(...) を生成（旧実装）
+    registry : AgentRegistry が生成済みのモデルを返す
+    各 *_INSTRUCTION の推定トークン数（毎リクエスト再送されていた量）
+
+  --live（Vertex AI 接続が必要）:
+    plain  : system_instruction 付きの通常モデル
+    cached : コンテキストキャッシュ（CachedContent）経由のモデル
+    stream=True で最初のチャンクまでの時間 (TTFT) と usage_metadata の入力/キャッシュトークン数を比較
+
+Usage: python bench_agent_registry.py [--calls 200] [--live] [--agent analyze] [--reps 3]
+"""
+import argparse
+import ast
+import os
+import statistics
+import time
+from datetime import timedelta
+
+import vertexai
+from vertexai.generative_models import GenerativeModel
+
+from agent_registry import AgentRegistry
+from context_builder import estimate_tokens
+
+AGENT_CONSTANTS = {
+    "analyze": "ANALYZER_INSTRUCTION",
+    "draft": "DRAFTER_INSTRUCTION",
+    "chat": "EDITOR_INSTRUCTION",
+    "global_chat": "PM_INSTRUCTION",
+    "escalation": "ESCALATION_INSTRUCTION",
+    "closure": "CLOSER_INSTRUCTION",
+    "summarize": "SUMMARIZER_INSTRUCTION",
+    "triage": "COMBINED_TRIAGE_INSTRUCTION",
+}
+MODEL_ID = os.getenv("GCP_MODEL_ID", "gemini-2.5-flash")
+SAMPLE_PROMPT = "Title: ログイン後に画面が真っ白になる\nDescription: v2.3 へ更新後から発生。\nLogs: TypeError: Cannot read properties of undefined"
+
+
+def load_instructions() -> dict:
+    """main.py を import せずに（GCP 初期化なしで）システム指示の文字列を取り出す"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    constants[target.id] = node.value.value
+    return {agent: constants[const] for agent, const in AGENT_CONSTANTS.items() if const in constants}
+
+
+def measure(fn, calls: int):
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_offline(instructions: dict, calls: int):
+    registry = AgentRegistry(MODEL_ID, context_cache="off")
+    for agent, text in instructions.items():
+        registry.register(agent, text)
+
+    print(f"=== model construction x {calls} per agent ===")
+    for agent, text in instructions.items():
+        before = measure(lambda: GenerativeModel(model_name=MODEL_ID, system_instruction=text), calls)
+        registry.model(agent)
+        cached = measure(lambda: registry.model(agent), calls)
+        print(f"{agent:<12} before={statistics.mean(before) * 1000:7.3f}ms  registry={statistics.mean(cached) * 1000:7.4f}ms")
+
+    print("\n=== static system instruction size (estimated tokens re-sent per call) ===")
+    total = 0
+    for agent, text in instructions.items():
+        tokens = estimate_tokens(text)
+        total += tokens
+        print(f"{agent:<12} {tokens:6d} tokens")
+    print(f"{'total':<12} {total:6d} tokens per full set of agent calls")
+
+
+def _stream_once(model: GenerativeModel):
+    start = time.perf_counter()
+    ttft = None
+    usage = None
+    for chunk in model.generate_content(SAMPLE_PROMPT, stream=True):
+        if ttft is None:
+            ttft = time.perf_counter() - start
+        usage = getattr(chunk, "usage_metadata", None) or usage
+    return ttft, time.perf_counter() - start, usage
+
+
+def bench_live(instructions: dict, agents, reps: int):
+    from vertexai.preview import caching
+
+    for agent in agents:
+        text = instructions[agent]
+        plain = GenerativeModel(model_name=MODEL_ID, system_instruction=text)
+        variants = [("plain", plain)]
+        cached_content = None
+        try:
+            cached_content = caching.CachedContent.create(model_name=MODEL_ID, system_instruction=text, ttl=timedelta(minutes=10))
+            variants.append(("cached", GenerativeModel.from_cached_content(cached_content=cached_content)))
+        except Exception as e:
+            print(f"{agent}: context cache not available ({e})")
+
+        try:
+            for label, model in variants:
+                runs = [_stream_once(model) for _ in range(reps)]
+                usage = runs[-1][2]
+                print(
+                    f"{agent:<12} {label:<7} ttft={statistics.median(r[0] for r in runs) * 1000:8.1f}ms  "
+                    f"total={statistics.median(r[1] for r in runs) * 1000:8.1f}ms  "
+                    f"prompt_tokens={getattr(usage, 'prompt_token_count', '?')}  "
+                    f"cached_tokens={getattr(usage, 'cached_content_token_count', 0)}"
+                )
+        finally:
+            if cached_content is not None:
+                cached_content.delete()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--live", action="store_true")
+    parser.add_argument("--agent", action="append", help="--live で計測するエージェント（複数指定可）")
+    parser.add_argument("--reps", type=int, default=3)
+    args = parser.parse_args()
+
+    # モデルの生成自体は通信しない（--live 以外は認証情報なしで動く）
+    vertexai.init(project=os.getenv("GCP_PROJECT_ID", "tier3-ops-resolver"), location=os.getenv("GCP_LOCATION", "us-central1"))
+    instructions = load_instructions()
+    bench_offline(instructions, args.calls)
+    if args.live:
+        print("\n=== live TTFT / tokens (Vertex AI) ===")
+        bench_live(instructions, args.agent or list(instructions), args.reps)
+
+
+if __name__ == "__main__":
+    main()
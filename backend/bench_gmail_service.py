@@ -0,0 +1,79 @@
+"""
+get_gmail_service() の生成コスト計測（ネットワーク不要・ダミー token.json 使用）
+
+  before : 旧実装（呼び出しごとに token.json 読み込み + build('gmail', 'v1')）
+  cached : キャッシュ済み認証情報 + スレッドごとのサービス再利用
+
+1メッセージ処理あたり旧実装では get_gmail_service() が2回呼ばれていた
+（gmail_webhook + process_single_message）。
+
+Usage: python bench_gmail_service.py [--calls 50]
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+import gmail_utils
+
+
+def write_dummy_token(path: str):
+    expiry = (datetime.now(timezone.utc) + timedelta(hours=1)).replace(tzinfo=None)
+    with open(path, "w") as f:
+        json.dump({
+            "token": "dummy-access-token",
+            "refresh_token": "dummy-refresh-token",
+            "client_id": "dummy.apps.googleusercontent.com",
+            "client_secret": "dummy",
+            "token_uri": "https://oauth2.googleapis.com/token",
+            "scopes": gmail_utils.GMAIL_SCOPES,
+            "expiry": expiry.isoformat() + "Z",
+        }, f)
+
+
+def old_get_gmail_service(token_path: str):
+    creds = Credentials.from_authorized_user_file(token_path, gmail_utils.GMAIL_SCOPES)
+    return build('gmail', 'v1', credentials=creds)
+
+
+def measure(fn, calls: int):
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        token_path = os.path.join(tmp, "token.json")
+        write_dummy_token(token_path)
+        gmail_utils.GMAIL_TOKEN_PATH = token_path
+
+        before = measure(lambda: old_get_gmail_service(token_path), args.calls)
+        cold_start = time.perf_counter()
+        gmail_utils.get_gmail_service()
+        cold = time.perf_counter() - cold_start
+        cached = measure(gmail_utils.get_gmail_service, args.calls)
+
+    before_ms = statistics.mean(before) * 1000
+    cached_ms = statistics.mean(cached) * 1000
+    print(f"=== get_gmail_service() x {args.calls} ===")
+    print(f"before   mean={before_ms:8.3f}ms  p50={statistics.median(before) * 1000:8.3f}ms")
+    print(f"cached   first call={cold * 1000:8.3f}ms  then mean={cached_ms:8.3f}ms")
+    print(f"per-message saving (2 calls/message): {(before_ms - cached_ms) * 2:.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+search_knowledge_base の1クエリあたりのオーバーヘッド計測（ローカル gRPC スタブ使用）
+
+  before : 呼び出しごとに SearchServiceClient + チャネルを生成（旧実装）
+  shared : 共有クライアントを再利用
+  async  : SearchServiceAsyncClient で N 件を同時に投げる
+
+Usage: python bench_knowledge_search.py [--queries 200] [--latency-ms 0]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from concurrent import futures
+
+import grpc
+from google.cloud import discoveryengine_v1 as discoveryengine
+from google.cloud.discoveryengine_v1.services.search_service.transports import (
+    SearchServiceGrpcAsyncIOTransport,
+    SearchServiceGrpcTransport,
+)
+
+import knowledge_utils
+
+SERVICE_NAME = "google.cloud.discoveryengine.v1.SearchService"
+
+
+def _stub_response() -> discoveryengine.SearchResponse:
+    doc = discoveryengine.Document(id="stub-1")
+    doc.struct_data = {"knowledge_type": "fix_case_card", "title": "stub result"}
+    return discoveryengine.SearchResponse(
+        results=[discoveryengine.SearchResponse.SearchResult(id="stub-1", document=doc)]
+    )
+
+
+def start_stub_server(latency_ms: float):
+    response = _stub_response()
+
+    def search(request, context):
+        if latency_ms:
+            time.sleep(latency_ms / 1000)
+        return response
+
+    handler = grpc.method_handlers_generic_handler(SERVICE_NAME, {
+        "Search": grpc.unary_unary_rpc_method_handler(
+            search,
+            request_deserializer=discoveryengine.SearchRequest.deserialize,
+            response_serializer=discoveryengine.SearchResponse.serialize,
+        ),
+    })
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=32))
+    server.add_generic_rpc_handlers((handler,))
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    return server, f"127.0.0.1:{port}"
+
+
+def _new_client(address: str) -> discoveryengine.SearchServiceClient:
+    return discoveryengine.SearchServiceClient(
+        transport=SearchServiceGrpcTransport(channel=grpc.insecure_channel(address))
+    )
+
+
+def _report(label: str, samples):
+    samples_ms = sorted(s * 1000 for s in samples)
+    p95 = samples_ms[int(len(samples_ms) * 0.95) - 1]
+    print(f"{label:<8} mean={statistics.mean(samples_ms):7.3f}ms  p50={statistics.median(samples_ms):7.3f}ms  p95={p95:7.3f}ms")
+
+
+def bench_before(address: str, n: int):
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        client = _new_client(address)
+        client.search(knowledge_utils.build_search_request(f"query {i}", ["fix_case_card"], 5))
+        client.transport.close()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_shared(address: str, n: int):
+    knowledge_utils.set_search_clients(client=_new_client(address))
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        knowledge_utils.search_knowledge_base(f"query {i}", ["fix_case_card"])
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def bench_async(address: str, n: int) -> float:
+    knowledge_utils.set_search_clients(
+        async_client_factory=lambda: discoveryengine.SearchServiceAsyncClient(
+            transport=SearchServiceGrpcAsyncIOTransport(channel=grpc.aio.insecure_channel(address))
+        )
+    )
+    await knowledge_utils.search_knowledge_base_async("warmup")
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        knowledge_utils.search_knowledge_base_async(f"query {i}", ["fix_case_card"]) for i in range(n)
+    ])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="スタブ側で付与する擬似レイテンシ")
+    args = parser.parse_args()
+
+    server, address = start_stub_server(args.latency_ms)
+    try:
+        before = bench_before(address, args.queries)
+        shared = bench_shared(address, args.queries)
+        concurrent_total = asyncio.run(bench_async(address, args.queries))
+    finally:
+        knowledge_utils.set_search_clients()
+        server.stop(None)
+
+    print(f"\n=== {args.queries} queries against local stub ({address}) ===")
+    _report("before", before)
+    _report("shared", shared)
+    print(f"async    {args.queries} concurrent queries in {concurrent_total * 1000:.1f}ms "
+          f"({concurrent_total * 1000 / args.queries:.3f}ms/query amortized)")
+    print(f"per-query overhead saved by client reuse: "
+          f"{(statistics.mean(before) - statistics.mean(shared)) * 1000:.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+新規チケットのトリアージを split（3回生成）と combined（1回生成）で比較する
+
+  ローカル（デフォルト）:
+    RAG と Gemini をスタブに差し替え、実際のプロンプト組み立て（予算・RAG 重複排除込み）を通して
+    - 生成回数 / 入力トークン（システム指示 + プロンプトの推定）/ 出力トークン（推定）
+    - 模擬レイテンシ（1回あたりの固定遅延 + 出力トークン比例）での所要時間
+  --live（Vertex AI 接続が必要）:
+    Gemini は実際に呼び、usage_metadata のトークン数と所要時間を比較する（RAG はスタブのまま）
+
+main を import するので、ローカルでサーバーを起動するときと同じ認証情報（ADC）が必要。
+Firestore / Gmail には書き込まない。
+
+Usage: python bench_triage_modes.py [--reps 5] [--call-ms 400] [--ms-per-output-token 4] [--live]
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+
+import main as backend
+from context_builder import estimate_tokens
+
+SAMPLE_TITLE = "ログイン後に画面が真っ白になる (v2.3)"
+SAMPLE_DESCRIPTION = "株式会社サンプルの田中です。v2.3 へ更新後、ログインすると画面が真っ白になります。全ユーザーで発生しています。"
+SAMPLE_LOGS = "\n".join(
+    f"2026-02-13T10:{i:02d}:00+09:00 ERROR app.js:1042 TypeError: Cannot read properties of undefined (reading 'token')"
+    for i in range(40)
+)
+SAMPLE_SENDER = "tanaka@example.com"
+
+# フィルタごとの検索結果。fix_case_card は解析と返信の両方の検索に出てくる（combined では1回だけ送る）
+_KB_DOCS = {
+    "fix_case_card": ['{"title": "v2.2 更新後の白画面", "root_cause": "トークン更新処理の未定義参照", "fix": "キャッシュ削除と v2.2.1 適用"}'],
+    "timeline_event": ['{"case": "case-0a1b2c3d", "event": "ブラウザキャッシュ削除で解消を確認"}'],
+    "reply_draft": ['{"subject": "画面が表示されない件", "body": "ご不便をおかけしております。原因を調査しております..."}'],
+    "policy_guard_card": ['{"rule": "原因を断定しない。回避策は検証済みのもののみ案内する"}'],
+    "escalation": ['{"case": "case-9f8e7d6c", "target": "Dev", "reason": "フロントエンドのリグレッション"}'],
+}
+
+SAMPLE_PROPOSAL = {
+    "summary": "v2.3 更新後、ログイン直後の画面描画で TypeError が発生し白画面になっている。",
+    "detected_customer_name": "田中",
+    "hypotheses": [{"cause": "トークン更新処理の未定義参照", "likelihood": "High", "reasoning": "app.js:1042 の TypeError が全ユーザーで発生"}],
+    "missing_info": ["発生しているブラウザとバージョン"],
+    "evidence_pack": [{"type": "LOG_SNIPPET", "content": "TypeError: Cannot read properties of undefined", "source": "app.js:1042", "is_verified": True}],
+    "next_action_plan": [{"type": "COMMAND", "title": "キャッシュ削除", "description": "ブラウザキャッシュを削除して再現確認", "command": None}],
+    "confidence_score": 0.8,
+    "next_contact_due_proposal": "2030-01-01T14:00:00+09:00",
+}
+SAMPLE_DRAFT = {
+    "to": SAMPLE_SENDER,
+    "subject": "Re: ログイン後に画面が真っ白になる件",
+    "body": "田中 様\n\nお世話になっております。ご不便をおかけしております。\n現在、v2.3 のトークン更新処理を中心に調査しております。\n\n[担当者名]",
+    "attachments": [],
+}
+CANNED_OUTPUTS = {
+    "analyze": json.dumps(SAMPLE_PROPOSAL, ensure_ascii=False),
+    "draft": json.dumps(SAMPLE_DRAFT, ensure_ascii=False),
+    "escalation": json.dumps({"target": "None", "reason": "Tier-3 で対応可能"}, ensure_ascii=False),
+    "triage": json.dumps({"proposal": SAMPLE_PROPOSAL, "reply_draft": SAMPLE_DRAFT, "escalation_target": None}, ensure_ascii=False),
+}
+
+
+def stub_search(query: str, filters=(), limit: int = 5) -> str:
+    docs = [doc for f in filters for doc in _KB_DOCS.get(f, [])]
+    return "".join(f"\n--- [参考資料 {i+1}] ---\n{doc}\n" for i, doc in enumerate(docs))
+
+
+def _prompt_text(contents) -> str:
+    parts = contents if isinstance(contents, list) else [contents]
+    return "".join(p for p in parts if isinstance(p, str))
+
+
+class StubModel:
+    """agent_registry.generate の代わり。推定トークン数を集計し、模擬レイテンシだけ待つ"""
+
+    def __init__(self, call_ms: float, ms_per_output_token: float):
+        self.call_ms = call_ms
+        self.ms_per_output_token = ms_per_output_token
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def generate(self, name: str, contents, generation_config=None) -> str:
+        text = CANNED_OUTPUTS[name]
+        out_tokens = estimate_tokens(text)
+        with self.lock:
+            self.calls += 1
+            self.input_tokens += estimate_tokens(backend.agent_registry.instruction(name)) + estimate_tokens(_prompt_text(contents))
+            self.output_tokens += out_tokens
+        time.sleep((self.call_ms + out_tokens * self.ms_per_output_token) / 1000)
+        return text
+
+    def usage(self):
+        return self.calls, self.input_tokens, self.output_tokens
+
+
+def _live_usage():
+    agents = backend.agent_registry.stats()["agents"]
+    return (
+        sum(a["calls"] for a in agents.values()),
+        sum(a["prompt_tokens"] for a in agents.values()),
+        sum(a["output_tokens"] for a in agents.values()),
+    )
+
+
+def run_mode(mode: str, reps: int, usage):
+    latencies = []
+    before = usage()
+    results = []
+    for _ in range(reps):
+        start = time.perf_counter()
+        results.append(backend.run_triage(SAMPLE_TITLE, SAMPLE_DESCRIPTION, SAMPLE_LOGS, [], SAMPLE_SENDER, mode=mode))
+        latencies.append(time.perf_counter() - start)
+    after = usage()
+    calls, input_tokens, output_tokens = (a - b for a, b in zip(after, before))
+    modes = {r.mode for r in results}
+    print(
+        f"{mode:<9} calls/ticket={calls / reps:4.1f}  input_tokens={input_tokens / reps:8.0f}  "
+        f"output_tokens={output_tokens / reps:7.0f}  latency p50={statistics.median(latencies) * 1000:8.1f}ms  "
+        f"max={max(latencies) * 1000:8.1f}ms  served_by={sorted(modes)}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reps", type=int, default=5)
+    parser.add_argument("--call-ms", type=float, default=400, help="スタブ: 1回の生成の固定遅延")
+    parser.add_argument("--ms-per-output-token", type=float, default=4, help="スタブ: 出力1トークンあたりの遅延")
+    parser.add_argument("--live", action="store_true")
+    args = parser.parse_args()
+
+    backend.search_knowledge_base = stub_search
+    backend.generation_cache.enabled = False
+
+    if args.live:
+        print("=== live (Vertex AI, usage_metadata) ===")
+        usage = _live_usage
+    else:
+        stub = StubModel(args.call_ms, args.ms_per_output_token)
+        backend.agent_registry.generate = stub.generate
+        print(f"=== local stub (call={args.call_ms:.0f}ms + {args.ms_per_output_token}ms/output token, estimated tokens) ===")
+        usage = stub.usage
+
+    for mode in ("split", "combined"):
+        run_mode(mode, args.reps, usage)
+    print(f"\ncombined fallbacks: {backend.triage_stats['combined_fallbacks']}")
+
+
+if __name__ == "__main__":
+    main()
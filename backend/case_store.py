@@ -0,0 +1,430 @@
+import os
+import time
+import uuid
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud import firestore
+from cache_utils import TTLCache
+from schemas import Case, TimelineEvent, CaseChangeTracker
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ケースドキュメントには直近 N 件だけを持たせ、全イベントは cases/{id}/timeline に追記する
+TIMELINE_TAIL_SIZE = int(os.getenv("TIMELINE_TAIL_SIZE", "20"))
+TIMELINE_SUBCOLLECTION = "timeline"
+
+# Gmail スレッド -> ケースの索引: gmail_threads/{thread_id} -> {case_id}
+# スレッドが別ケースに付け替わることはないので TTL なしの LRU で十分
+THREAD_INDEX_COLLECTION = os.getenv("THREAD_INDEX_COLLECTION", "gmail_threads")
+THREAD_INDEX_CACHE_MAX_ENTRIES = int(os.getenv("THREAD_INDEX_CACHE_MAX_ENTRIES", "5000"))
+thread_index_cache = TTLCache("gmail_thread_index", max_entries=THREAD_INDEX_CACHE_MAX_ENTRIES, ttl_seconds=None)
+
+# 未クローズのケース一覧（PM エージェント用）を1ドキュメントに実体化しておく:
+#   system/active_board -> {"cases": {case_id: {id, title, status, ...}}, "updated_at"}
+# ケースの書き込みと同じバッチで更新するので、global_chat は1回の読み取りで済む
+ACTIVE_BOARD_DOC = ("system", "active_board")
+_BOARD_SOURCE_FIELDS = ("id", "title", "status", "priority", "waiting_for", "next_contact_due", "customer_name")
+
+def _now_utc_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def new_timeline_event(type: str, actor: str, message: str, metadata: Optional[Dict[str, Any]] = None) -> dict:
+    return {
+        "id": f"evt-{uuid.uuid4().hex[:4]}",
+        "timestamp": _now_utc_iso(),
+        "type": type,
+        "actor": actor,
+        "message": message,
+        "metadata": metadata,
+    }
+
+def _timeline_col(db, case_id: str):
+    return db.collection("cases").document(case_id).collection(TIMELINE_SUBCOLLECTION)
+
+def _event_doc_id(event: TimelineEvent) -> str:
+    # seq でソートしやすい ID（同じ seq が競合しても上書きしないよう イベントID を付ける）
+    return f"{event.seq:08d}-{event.id}"
+
+def _thread_ref(db, thread_id: str):
+    return db.collection(THREAD_INDEX_COLLECTION).document(thread_id)
+
+def _set_thread_index(batch, db, thread_id: str, case_id: str):
+    batch.set(_thread_ref(db, thread_id), {"case_id": case_id, "updated_at": _now_utc_iso()})
+
+def lookup_case_id_by_thread(db, thread_id: str) -> Optional[str]:
+    """スレッドIDからケースIDを引く（キャッシュヒットなら0回、ミスでも1回のキー読み取り）"""
+    case_id = thread_index_cache.get(thread_id)
+    if case_id:
+        return case_id
+    start = time.perf_counter()
+    snap = _thread_ref(db, thread_id).get()
+    if not snap.exists:
+        # 新規スレッドは都度確認する（他インスタンスが作成した直後でも取りこぼさない）
+        return None
+    case_id = snap.to_dict().get("case_id")
+    if case_id:
+        thread_index_cache.set(thread_id, case_id, cost_seconds=time.perf_counter() - start)
+    return case_id
+
+def index_case_thread(db, thread_id: str, case_id: str):
+    """既存ケースに別スレッドを紐づける（件名タグで見つかったケースへの返信など）"""
+    _thread_ref(db, thread_id).set({"case_id": case_id, "updated_at": _now_utc_iso()})
+    thread_index_cache.set(thread_id, case_id)
+
+def forget_thread(thread_id: str):
+    """索引が指すケースが存在しなかった場合にキャッシュから外す"""
+    thread_index_cache.delete(thread_id)
+
+def _board_ref(db):
+    return db.collection(ACTIVE_BOARD_DOC[0]).document(ACTIVE_BOARD_DOC[1])
+
+def active_board_entry(case: Any) -> Dict[str, Any]:
+    """Case もしくは Firestore の dict から、ボードに載せる項目だけを取り出す"""
+    d = case if isinstance(case, dict) else case.model_dump(include=set(_BOARD_SOURCE_FIELDS))
+    return {
+        "id": d.get("id"),
+        "title": d.get("title"),
+        "status": d.get("status"),
+        "priority": d.get("priority"),
+        "waiting_for": d.get("waiting_for"),
+        "next_due": d.get("next_contact_due"),
+        "customer": d.get("customer_name"),
+    }
+
+def _set_board_entry(batch, db, case: Case):
+    value = firestore.DELETE_FIELD if case.status == "CLOSED" else active_board_entry(case)
+    batch.set(_board_ref(db), {"cases": {case.id: value}, "updated_at": _now_utc_iso()}, merge=True)
+
+def _open_cases_query(db):
+    return db.collection("cases").where("status", "!=", "CLOSED").select(list(_BOARD_SOURCE_FIELDS))
+
+def _board_entry_from_snapshot(d) -> Dict[str, Any]:
+    data = d.to_dict()
+    data.setdefault("id", d.id)
+    return active_board_entry(data)
+
+def _board_document(entries: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    now = _now_utc_iso()
+    print(f"📋 Active board rebuilt: {len(entries)} cases")
+    return {"cases": entries, "updated_at": now, "built_at": now}
+
+def _board_entries(snap) -> Optional[Dict[str, Dict[str, Any]]]:
+    """ボードのエントリを返す。作り直しが必要なら None"""
+    data = snap.to_dict() if snap.exists else None
+    # built_at がなければ、ケース書き込みで部分的に作られただけで既存ケースが載っていない
+    if not data or "built_at" not in data:
+        return None
+    return data.get("cases") or {}
+
+def rebuild_active_board(db) -> Dict[str, Dict[str, Any]]:
+    """ボードを cases コレクションから作り直す（初回やボード導入前のデータ用）"""
+    entries = {}
+    for d in _open_cases_query(db).stream():
+        entry = _board_entry_from_snapshot(d)
+        entries[entry["id"]] = entry
+    _board_ref(db).set(_board_document(entries))
+    return entries
+
+def load_active_board(db) -> List[Dict[str, Any]]:
+    """未クローズケースの一覧を ID 順で返す（ボード未作成なら作り直す）"""
+    entries = _board_entries(_board_ref(db).get())
+    if entries is None:
+        entries = rebuild_active_board(db)
+    return [entries[k] for k in sorted(entries)]
+
+def append_timeline_events(case: Case, events: List[dict]) -> List[TimelineEvent]:
+    """
+    メモリ上の case にイベントを追記し、timeline を直近 TIMELINE_TAIL_SIZE 件に切り詰める。
+    戻り値はサブコレクションに書き込むべきイベント（save_case に渡す）。
+    """
+    pending: List[TimelineEvent] = []
+
+    # 旧形式（timeline 全件をドキュメント内に保持）のケースは初回追記時に移行する
+    if case.timeline_count == 0 and case.timeline:
+        for i, legacy in enumerate(case.timeline):
+            ev = legacy if isinstance(legacy, TimelineEvent) else TimelineEvent(**legacy)
+            ev.seq = i + 1
+            pending.append(ev)
+        case.timeline = list(pending)
+        case.timeline_count = len(pending)
+
+    for raw in events:
+        ev = raw if isinstance(raw, TimelineEvent) else TimelineEvent(**raw)
+        case.timeline_count += 1
+        ev.seq = case.timeline_count
+        case.timeline.append(ev)
+        pending.append(ev)
+
+    case.timeline = case.timeline[-TIMELINE_TAIL_SIZE:]
+    return pending
+
+def _set_timeline_events(batch, db, case_id: str, new_events: List[TimelineEvent]):
+    col = _timeline_col(db, case_id)
+    for ev in new_events:
+        batch.set(col.document(_event_doc_id(ev)), ev.model_dump())
+
+def _stage_save(db, case: Case, new_events: List[TimelineEvent], merge: bool):
+    batch = db.batch()
+    batch.set(db.collection("cases").document(case.id), case.model_dump(), merge=merge)
+    if case.gmail_thread_id:
+        _set_thread_index(batch, db, case.gmail_thread_id, case.id)
+    _set_board_entry(batch, db, case)
+    _set_timeline_events(batch, db, case.id, new_events)
+    return batch
+
+def save_case(db, case: Case, new_events: List[TimelineEvent] = (), merge: bool = False):
+    """ケースドキュメントと新規タイムラインイベントを1つのバッチで書き込む"""
+    _stage_save(db, case, new_events, merge).commit()
+    if case.gmail_thread_id:
+        thread_index_cache.set(case.gmail_thread_id, case.id)
+
+def _case_from_snapshot(snap) -> Tuple[Optional[Case], Optional[CaseChangeTracker]]:
+    if not snap.exists:
+        return None, None
+    case = Case(**snap.to_dict())
+    return case, CaseChangeTracker(case, update_time=snap.update_time)
+
+def load_case(db, case_id: str) -> Tuple[Optional[Case], Optional[CaseChangeTracker]]:
+    """ケースを読み込み、変更追跡用のスナップショット（update_time 付き）と一緒に返す"""
+    return _case_from_snapshot(db.collection("cases").document(case_id).get())
+
+def update_case(db, case: Case, tracker: CaseChangeTracker, new_events: List[TimelineEvent] = (), check_update_time: bool = False) -> Dict[str, Any]:
+    """
+    変更されたフィールドだけを update() で書き込む（他フィールドへの同時編集を上書きしない）。
+    check_update_time=True なら読み込み後に他で更新されていた場合 FailedPrecondition になる。
+    new_events があるときは seq の採番が競合しないようトランザクションで書き込む。
+    """
+    if new_events:
+        return _update_case_transaction(db, case, tracker, list(new_events), check_update_time)
+    changes = tracker.changes(case)
+    if not changes:
+        return changes
+    _stage_update(db, case, tracker, changes, new_events, check_update_time).commit()
+    _after_update(case, changes)
+    return changes
+
+def _stage_update(db, case: Case, tracker: CaseChangeTracker, changes: Dict[str, Any], new_events: List[TimelineEvent], check_update_time: bool, batch=None):
+    batch = batch if batch is not None else db.batch()
+    if changes:
+        option = None
+        if check_update_time and tracker.update_time is not None:
+            option = db.write_option(last_update_time=tracker.update_time)
+        batch.update(db.collection("cases").document(case.id), changes, option=option)
+    adopted_thread = changes.get("gmail_thread_id")
+    if adopted_thread:
+        _set_thread_index(batch, db, adopted_thread, case.id)
+    if any(path.split(".", 1)[0] in _BOARD_SOURCE_FIELDS for path in changes):
+        _set_board_entry(batch, db, case)
+    _set_timeline_events(batch, db, case.id, new_events)
+    return batch
+
+class _TimelineAppend:
+    """
+    append_timeline_events で採番した直後の状態を覚えておき、トランザクション内で読んだ最新のケースに合わせて付け直す。
+    トランザクションは競合するとやり直されるので、毎回この時点の状態から計算する
+    """
+
+    def __init__(self, case: Case, tracker: CaseChangeTracker, new_events: List[TimelineEvent]):
+        self.case = case
+        self.tracker = tracker
+        self.events = [(ev, ev.seq) for ev in new_events]
+        self.tail = list(case.timeline)
+        self.count = case.timeline_count
+        loaded = tracker.snapshot.get("timeline_count") or 0
+        # 読み込み時の最終 seq（旧形式のケースは移行で 1..len(timeline) が振られている）
+        self.base = loaded or len(tracker.snapshot.get("timeline") or [])
+        self.loaded = loaded
+
+    def rebase(self, snap, check_update_time: bool) -> List[TimelineEvent]:
+        """最新のケースドキュメント snap の後ろに新規イベントを並べ直し、書き込むべきイベントを返す"""
+        for ev, seq in self.events:
+            ev.seq = seq
+        self.case.timeline = list(self.tail)
+        self.case.timeline_count = self.count
+        if not snap.exists:
+            return [ev for ev, _ in self.events]
+        if check_update_time and self.tracker.update_time is not None and snap.update_time != self.tracker.update_time:
+            raise FailedPrecondition(f"case {self.case.id} was updated after it was loaded")
+
+        data = snap.to_dict() or {}
+        stored = data.get("timeline_count") or 0
+        if stored == self.loaded:
+            return [ev for ev, _ in self.events]
+
+        # 読み込み後に他の書き込みがタイムラインを伸ばしていた。移行済みなら移行分は捨て、残りを末尾に付け直す
+        fresh = [ev for ev, seq in self.events if seq > self.base]
+        for i, ev in enumerate(fresh):
+            ev.seq = stored + i + 1
+        stored_tail = [TimelineEvent(**e) for e in (data.get("timeline") or [])]
+        self.case.timeline = (stored_tail + fresh)[-TIMELINE_TAIL_SIZE:]
+        self.case.timeline_count = stored + len(fresh)
+        print(f"🔀 Case {self.case.id}: timeline moved {self.loaded} -> {stored} since load, re-sequenced {len(fresh)} event(s)")
+        return fresh
+
+def _update_case_transaction(db, case: Case, tracker: CaseChangeTracker, new_events: List[TimelineEvent], check_update_time: bool) -> Dict[str, Any]:
+    ref = db.collection("cases").document(case.id)
+    pending = _TimelineAppend(case, tracker, new_events)
+
+    @firestore.transactional
+    def run(transaction):
+        events = pending.rebase(ref.get(transaction=transaction), check_update_time)
+        changes = tracker.changes(case)
+        _stage_update(db, case, tracker, changes, events, False, batch=transaction)
+        return changes
+
+    changes = run(db.transaction())
+    _after_update(case, changes)
+    return changes
+
+def _after_update(case: Case, changes: Dict[str, Any]):
+    adopted_thread = changes.get("gmail_thread_id")
+    if adopted_thread:
+        thread_index_cache.set(adopted_thread, case.id)
+    print(f"💾 Case {case.id} updated fields: {sorted(changes)}")
+
+def _tail_events(case: Case) -> List[TimelineEvent]:
+    return [ev if isinstance(ev, TimelineEvent) else TimelineEvent(**ev) for ev in case.timeline]
+
+def _full_timeline_query(db, case: Case):
+    """ドキュメント内の tail で全件そろっていれば None"""
+    if case.timeline_count <= len(case.timeline):
+        return None
+    return _timeline_col(db, case.id).order_by("seq")
+
+def load_full_timeline(db, case: Case) -> List[TimelineEvent]:
+    """全タイムラインを seq 昇順で返す（ドキュメント内の tail で足りる場合は読まない）"""
+    query = _full_timeline_query(db, case)
+    if query is None:
+        return _tail_events(case)
+    return [TimelineEvent(**d.to_dict()) for d in query.stream()]
+
+def _timeline_since_query(db, case: Case, after_seq: int, upto_seq: Optional[int]):
+    """tail（未移行ケースはドキュメント内の全件）で足りれば None"""
+    if case.timeline_count == 0:
+        return None
+    tail = case.timeline
+    first = tail[0] if tail else None
+    first_seq = (first.seq if isinstance(first, TimelineEvent) else (first or {}).get("seq")) or 0
+    if tail and first_seq <= after_seq + 1:
+        return None
+    query = _timeline_col(db, case.id).where("seq", ">", after_seq)
+    if upto_seq is not None:
+        query = query.where("seq", "<=", upto_seq)
+    return query.order_by("seq")
+
+def _filter_since(case: Case, events: Optional[List[TimelineEvent]], after_seq: int, upto_seq: Optional[int]) -> List[TimelineEvent]:
+    if events is None:
+        events = _tail_events(case)
+        if case.timeline_count == 0:
+            for i, ev in enumerate(events):
+                ev.seq = ev.seq or i + 1
+    return [
+        ev for ev in events
+        if (ev.seq or 0) > after_seq and (upto_seq is None or (ev.seq or 0) <= upto_seq)
+    ]
+
+def load_timeline_since(db, case: Case, after_seq: int, upto_seq: Optional[int] = None) -> List[TimelineEvent]:
+    """after_seq より後（upto_seq 以下）のイベントを seq 昇順で返す（ドキュメント内の tail で足りれば読まない）"""
+    query = _timeline_since_query(db, case, after_seq, upto_seq)
+    events = None if query is None else [TimelineEvent(**d.to_dict()) for d in query.stream()]
+    return _filter_since(case, events, after_seq, upto_seq)
+
+def _legacy_timeline_page(case: Case, before_seq: Optional[int], limit: int) -> Tuple[List[TimelineEvent], Optional[int]]:
+    # 未移行のケースはドキュメント内の timeline が全件
+    events = _tail_events(case)
+    for i, ev in enumerate(events):
+        ev.seq = i + 1
+    if before_seq is not None:
+        events = [ev for ev in events if ev.seq < before_seq]
+    page = events[-limit:]
+    next_before = page[0].seq if page and page[0].seq > 1 else None
+    return page, next_before
+
+def _timeline_page_query(db, case: Case, before_seq: Optional[int], limit: int):
+    query = _timeline_col(db, case.id).order_by("seq", direction=firestore.Query.DESCENDING)
+    if before_seq is not None:
+        query = query.where("seq", "<", before_seq)
+    return query.limit(limit + 1)
+
+def _timeline_page(docs: list, limit: int) -> Tuple[List[TimelineEvent], Optional[int]]:
+    page = [TimelineEvent(**d.to_dict()) for d in docs[:limit]]
+    page.reverse()
+    next_before = page[0].seq if len(docs) > limit else None
+    return page, next_before
+
+def list_timeline_page(db, case: Case, before_seq: Optional[int], limit: int) -> Tuple[List[TimelineEvent], Optional[int]]:
+    """
+    before_seq より古いイベントを新しい順に最大 limit 件取得し、seq 昇順で返す。
+    戻り値: (イベント, 次ページ用の before_seq)
+    """
+    if case.timeline_count == 0:
+        return _legacy_timeline_page(case, before_seq, limit)
+    return _timeline_page(list(_timeline_page_query(db, case, before_seq, limit).stream()), limit)
+
+# ==========================================
+#  AsyncClient 版（API リクエスト経路用）
+# ==========================================
+# adb は firestore.AsyncClient。クエリ・バッチの組み立ては同期版と共通で、I/O だけを await する。
+# インジェストワーカー（スレッド）は引き続き同期版を使う
+
+async def load_case_async(adb, case_id: str) -> Tuple[Optional[Case], Optional[CaseChangeTracker]]:
+    return _case_from_snapshot(await adb.collection("cases").document(case_id).get())
+
+async def save_case_async(adb, case: Case, new_events: List[TimelineEvent] = (), merge: bool = False):
+    await _stage_save(adb, case, new_events, merge).commit()
+    if case.gmail_thread_id:
+        thread_index_cache.set(case.gmail_thread_id, case.id)
+
+async def update_case_async(adb, case: Case, tracker: CaseChangeTracker, new_events: List[TimelineEvent] = (), check_update_time: bool = False) -> Dict[str, Any]:
+    if new_events:
+        return await _update_case_transaction_async(adb, case, tracker, list(new_events), check_update_time)
+    changes = tracker.changes(case)
+    if not changes:
+        return changes
+    await _stage_update(adb, case, tracker, changes, new_events, check_update_time).commit()
+    _after_update(case, changes)
+    return changes
+
+async def _update_case_transaction_async(adb, case: Case, tracker: CaseChangeTracker, new_events: List[TimelineEvent], check_update_time: bool) -> Dict[str, Any]:
+    ref = adb.collection("cases").document(case.id)
+    pending = _TimelineAppend(case, tracker, new_events)
+
+    @firestore.async_transactional
+    async def run(transaction):
+        events = pending.rebase(await ref.get(transaction=transaction), check_update_time)
+        changes = tracker.changes(case)
+        _stage_update(adb, case, tracker, changes, events, False, batch=transaction)
+        return changes
+
+    changes = await run(adb.transaction())
+    _after_update(case, changes)
+    return changes
+
+async def load_full_timeline_async(adb, case: Case) -> List[TimelineEvent]:
+    query = _full_timeline_query(adb, case)
+    if query is None:
+        return _tail_events(case)
+    return [TimelineEvent(**d.to_dict()) async for d in query.stream()]
+
+async def load_timeline_since_async(adb, case: Case, after_seq: int, upto_seq: Optional[int] = None) -> List[TimelineEvent]:
+    query = _timeline_since_query(adb, case, after_seq, upto_seq)
+    events = None if query is None else [TimelineEvent(**d.to_dict()) async for d in query.stream()]
+    return _filter_since(case, events, after_seq, upto_seq)
+
+async def list_timeline_page_async(adb, case: Case, before_seq: Optional[int], limit: int) -> Tuple[List[TimelineEvent], Optional[int]]:
+    if case.timeline_count == 0:
+        return _legacy_timeline_page(case, before_seq, limit)
+    return _timeline_page([d async for d in _timeline_page_query(adb, case, before_seq, limit).stream()], limit)
+
+async def load_active_board_async(adb) -> List[Dict[str, Any]]:
+    entries = _board_entries(await _board_ref(adb).get())
+    if entries is None:
+        entries = {}
+        async for d in _open_cases_query(adb).stream():
+            entry = _board_entry_from_snapshot(d)
+            entries[entry["id"]] = entry
+        await _board_ref(adb).set(_board_document(entries))
+    return [entries[k] for k in sorted(entries)]
@@ -0,0 +1,219 @@
+import os
+import threading
+
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# セクションごとのトークン予算（概算）。長期化したケースでもプロンプトが青天井にならないようにする
+CONTEXT_BUDGETS = {
+    "history": int(os.getenv("CONTEXT_BUDGET_HISTORY", "4000")),
+    "summary": int(os.getenv("CONTEXT_BUDGET_SUMMARY", "1500")),
+    "logs": int(os.getenv("CONTEXT_BUDGET_LOGS", "6000")),
+    "knowledge": int(os.getenv("CONTEXT_BUDGET_KNOWLEDGE", "3000")),
+    "draft": int(os.getenv("CONTEXT_BUDGET_DRAFT", "3000")),
+    "analysis": int(os.getenv("CONTEXT_BUDGET_ANALYSIS", "3000")),
+    "board": int(os.getenv("CONTEXT_BUDGET_BOARD", "6000")),
+    # まとめてトリアージ用（解析・返信・エスカレーションの RAG を重複排除して1つにしたもの）
+    "triage_knowledge": int(os.getenv("CONTEXT_BUDGET_TRIAGE_KNOWLEDGE", "5000")),
+}
+# 1イベントあたりの上限（巨大なログ貼り付けが履歴枠を独占しないように）
+EVENT_MAX_TOKENS = int(os.getenv("CONTEXT_EVENT_MAX_TOKENS", "400"))
+# 経緯を理解するうえで重要なイベントは、古くても優先して残す
+HIGH_SIGNAL_EVENT_TYPES = {"INGEST", "HUMAN_APPROVE", "STATUS_CHANGE", "ESCALATION"}
+HIGH_SIGNAL_SHARE = 0.3
+
+TRIM_MARKER = "\n...（中略: 約{tokens}トークン省略）...\n"
+EVENTS_OMITTED_MARKER = "...（{count}件のイベントを省略）..."
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    Gemini のトークン数の概算（API を呼ばない）。
+    日本語などの非ASCII文字は 1文字≒1トークン、ASCII は 4文字≒1トークンとして数える。
+    """
+    if not text:
+        return 0
+    # UTF-8 で非ASCII文字は概ね3バイトになることを利用して文字を走査せずに数える
+    non_ascii = (len(text.encode("utf-8")) - len(text)) // 2
+    ascii_chars = len(text) - non_ascii
+    return non_ascii + (ascii_chars + 3) // 4
+
+def truncate_to_budget(text: str, budget: int, keep: str = "head") -> Tuple[str, int]:
+    """
+    text を budget トークン以内に切り詰める。戻り値: (切り詰め後のテキスト, 省略したトークン数)
+    keep: "head" は先頭を残す（検索結果など上位ほど重要）、"tail" は末尾を残す（会話履歴）、
+          "head_tail" は両端を残す（ログ: 発生状況と最後のエラーの両方が重要）
+    """
+    total = estimate_tokens(text)
+    if total <= budget:
+        return text, 0
+
+    chars = max(int(len(text) * budget / total), 0)
+    while chars > 0:
+        if keep == "tail":
+            kept = text[-chars:]
+        elif keep == "head_tail":
+            kept = text[: chars // 2] + text[len(text) - (chars - chars // 2):]
+        else:
+            kept = text[:chars]
+        if estimate_tokens(kept) <= budget:
+            break
+        chars = int(chars * 0.9)
+
+    if chars <= 0:
+        return "", total
+
+    omitted = total - estimate_tokens(kept)
+    marker = TRIM_MARKER.format(tokens=omitted)
+    if keep == "tail":
+        return marker + text[-chars:], omitted
+    if keep == "head_tail":
+        return text[: chars // 2] + marker + text[len(text) - (chars - chars // 2):], omitted
+    return text[:chars] + marker, omitted
+
+def _event_dict(event: Any) -> Dict[str, Any]:
+    if isinstance(event, dict):
+        return event
+    return event.model_dump() if hasattr(event, "model_dump") else event.dict()
+
+def format_event(event: Any) -> str:
+    d = _event_dict(event)
+    line = f"[{d.get('timestamp', '')}] {d.get('actor', 'UNKNOWN')} ({d.get('type', 'EVENT')}): {d.get('message', '')}"
+    return truncate_to_budget(line, EVENT_MAX_TOKENS, keep="head")[0]
+
+def select_timeline(events: Iterable[Any], budget: int) -> Tuple[str, int, int]:
+    """
+    予算内に収まるようにタイムラインを選び、時系列順のテキストにする。
+    1) 最初のイベントと重要イベント（新しい順）に予算の一部を割り当て
+    2) 残りを直近のイベントから順に埋める
+    戻り値: (テキスト, 省略したイベント数, 省略したトークン数)
+    """
+    lines = [format_event(e) for e in events]
+    types = [_event_dict(e).get("type") for e in events]
+    costs = [estimate_tokens(l) + 1 for l in lines]
+    if sum(costs) <= budget:
+        return "\n".join(lines), 0, 0
+
+    selected = set()
+    used = 0
+
+    def take(i: int, limit: int) -> bool:
+        nonlocal used
+        if i in selected:
+            return True
+        if used + costs[i] > limit:
+            return False
+        selected.add(i)
+        used += costs[i]
+        return True
+
+    reserved = int(budget * HIGH_SIGNAL_SHARE)
+    if lines:
+        take(0, reserved)
+    for i in reversed(range(len(lines))):
+        if types[i] in HIGH_SIGNAL_EVENT_TYPES:
+            take(i, reserved)
+    for i in reversed(range(len(lines))):
+        if not take(i, budget):
+            break
+
+    out = []
+    skipped = 0
+    for i, line in enumerate(lines):
+        if i in selected:
+            if skipped:
+                out.append(EVENTS_OMITTED_MARKER.format(count=skipped))
+                skipped = 0
+            out.append(line)
+        else:
+            skipped += 1
+    if skipped:
+        out.append(EVENTS_OMITTED_MARKER.format(count=skipped))
+
+    dropped = len(lines) - len(selected)
+    omitted_tokens = sum(costs) - used
+    return "\n".join(out), dropped, omitted_tokens
+
+# プロセス全体の集計（/metrics 用）
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"prompts": 0, "trimmed_prompts": 0, "tokens_in": 0, "tokens_omitted": 0})
+
+def context_stats() -> Dict[str, Dict[str, int]]:
+    with _stats_lock:
+        return {label: dict(v) for label, v in _stats.items()}
+
+class PromptContext:
+    """
+    1つのプロンプトを組み立てる間、セクションごとに予算を適用し、何を削ったかを記録する。
+
+        ctx = PromptContext("analyze")
+        history = ctx.text("history", history, keep="tail")
+        logs = ctx.text("logs", logs, keep="head_tail")
+        ctx.log()
+    """
+
+    def __init__(self, label: str, budgets: Optional[Dict[str, int]] = None):
+        self.label = label
+        self.budgets = {**CONTEXT_BUDGETS, **(budgets or {})}
+        self.sections: Dict[str, Dict[str, int]] = {}
+
+    def _record(self, name: str, original: int, omitted: int, dropped_events: int = 0):
+        self.sections[name] = {
+            "original_tokens": original,
+            "tokens": original - omitted,
+            "omitted_tokens": omitted,
+            "dropped_events": dropped_events,
+        }
+
+    def text(self, name: str, text: Optional[str], keep: str = "head", budget: Optional[int] = None) -> str:
+        text = text or ""
+        original = estimate_tokens(text)
+        trimmed, omitted = truncate_to_budget(text, budget or self.budgets.get(name, original), keep=keep)
+        self._record(name, original, omitted)
+        return trimmed
+
+    def timeline(self, name: str, events: List[Any], budget: Optional[int] = None) -> str:
+        events = list(events or [])
+        original = sum(estimate_tokens(format_event(e)) + 1 for e in events)
+        rendered, dropped, omitted = select_timeline(events, budget or self.budgets.get("history", original))
+        self._record(name, original, omitted, dropped)
+        return rendered
+
+    def case_history(self, name: str, summary: Optional[str], events: List[Any]) -> str:
+        """ローリング要約（古い経緯）+ 要約に含まれていない直近イベント"""
+        recent = self.timeline(name, events)
+        if not summary:
+            return recent
+        summary = self.text(f"{name}_summary", summary, budget=self.budgets["summary"])
+        return f"（これまでの要約）\n{summary}\n\n（直近の経緯）\n{recent or 'なし'}"
+
+    @property
+    def trimmed(self) -> Dict[str, Dict[str, int]]:
+        return {k: v for k, v in self.sections.items() if v["omitted_tokens"]}
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "label": self.label,
+            "tokens": sum(v["tokens"] for v in self.sections.values()),
+            "original_tokens": sum(v["original_tokens"] for v in self.sections.values()),
+            "trimmed": self.trimmed,
+        }
+
+    def log(self) -> Dict[str, Any]:
+        rep = self.report()
+        with _stats_lock:
+            s = _stats[self.label]
+            s["prompts"] += 1
+            s["tokens_in"] += rep["tokens"]
+            s["tokens_omitted"] += rep["original_tokens"] - rep["tokens"]
+            if rep["trimmed"]:
+                s["trimmed_prompts"] += 1
+        if rep["trimmed"]:
+            detail = ", ".join(
+                f"{k} {v['original_tokens']}→{v['tokens']}" + (f" (-{v['dropped_events']} events)" if v["dropped_events"] else "")
+                for k, v in rep["trimmed"].items()
+            )
+            print(f"✂️ [{self.label}] context trimmed: {detail} (total ~{rep['tokens']} tokens)")
+        return rep
@@ -0,0 +1,354 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+from cache_utils import TTLCache
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# memory (ローカル) / firestore / redis (本番: 複数インスタンスで共有)
+GENERATION_CACHE_BACKEND = os.getenv("GENERATION_CACHE_BACKEND", "memory")
+GENERATION_CACHE_ENABLED = os.getenv("GENERATION_CACHE_ENABLED", "true").lower() != "false"
+GENERATION_CACHE_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", "1024"))
+GENERATION_CACHE_COLLECTION = os.getenv("GENERATION_CACHE_COLLECTION", "generation_cache")
+GENERATION_CACHE_REDIS_URL = os.getenv("GENERATION_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# エージェントごとの TTL（秒）。GENERATION_CACHE_TTL_<AGENT> で上書きできる
+DEFAULT_AGENT_TTLS = {
+    "analyze": 3600,
+    "draft": 3600,
+    "escalation": 3600,
+    "closure": 3600,
+    "summarize": 24 * 3600,
+    "triage": 3600,
+    "chat": 600,
+    "global_chat": 120,
+}
+DEFAULT_TTL_SECONDS = 600
+
+def agent_ttl(agent: str) -> float:
+    env = os.getenv(f"GENERATION_CACHE_TTL_{agent.upper()}")
+    if env is not None:
+        return float(env)
+    return DEFAULT_AGENT_TTLS.get(agent, DEFAULT_TTL_SECONDS)
+
+def _part_repr(part: Any) -> Any:
+    """プロンプトの各パートを安定した形に変換（添付は gs:// URI と MIME で表す）"""
+    if isinstance(part, str):
+        return part
+    if hasattr(part, "to_dict"):
+        return part.to_dict()
+    return repr(part)
+
+def generation_key(model_id: str, system_instruction: Optional[str], contents: Any, generation_config: Optional[dict] = None) -> str:
+    """モデルID・システム指示・生成設定・プロンプト（添付 URI 含む）の SHA-256"""
+    parts = contents if isinstance(contents, list) else [contents]
+    payload = json.dumps({
+        "model": model_id,
+        "system": hashlib.sha256((system_instruction or "").encode("utf-8")).hexdigest(),
+        "config": generation_config or {},
+        "parts": [_part_repr(p) for p in parts],
+    }, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class BaseGenerationStore:
+    """生成結果（テキスト）の保存先。値は (text, 生成にかかった秒数)"""
+
+    # ネットワーク越しのストアは、イベントループから呼ぶときにスレッドへ逃がす
+    blocking = True
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        raise NotImplementedError
+
+    def set(self, key: str, text: str, cost_seconds: float, ttl_seconds: float, agent: str):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+
+class MemoryGenerationStore(BaseGenerationStore):
+    blocking = False
+
+    def __init__(self, max_entries: int = GENERATION_CACHE_MAX_ENTRIES):
+        self._cache = TTLCache("generation", max_entries=max_entries, ttl_seconds=DEFAULT_TTL_SECONDS)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, text, cost_seconds, ttl_seconds, agent):
+        self._cache.set(key, (text, cost_seconds), ttl_seconds=ttl_seconds)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+
+class FirestoreGenerationStore(BaseGenerationStore):
+    """
+    generation_cache/{key} に保存する。期限切れドキュメントの掃除は
+    `expire_at` フィールドに Firestore TTL ポリシーを設定して行う（読み取り時にも期限を確認する）。
+    """
+
+    def __init__(self, db, collection: str = GENERATION_CACHE_COLLECTION):
+        self._col = db.collection(collection)
+
+    def get(self, key):
+        snap = self._col.document(key).get()
+        if not snap.exists:
+            return None
+        d = snap.to_dict()
+        expire_at = d.get("expire_at")
+        if expire_at is not None and expire_at <= datetime.now(timezone.utc):
+            return None
+        return d.get("text"), float(d.get("cost_seconds", 0.0))
+
+    def set(self, key, text, cost_seconds, ttl_seconds, agent):
+        now = datetime.now(timezone.utc)
+        self._col.document(key).set({
+            "agent": agent,
+            "text": text,
+            "cost_seconds": cost_seconds,
+            "created_at": now,
+            "expire_at": now + timedelta(seconds=ttl_seconds),
+        })
+
+    def delete(self, key):
+        self._col.document(key).delete()
+
+
+class RedisGenerationStore(BaseGenerationStore):
+    """Redis 互換ストア（Memorystore 等）。redis パッケージが必要"""
+
+    def __init__(self, url: str = GENERATION_CACHE_REDIS_URL, prefix: str = "gen:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("GENERATION_CACHE_BACKEND=redis requires the 'redis' package") from e
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key):
+        raw = self._redis.get(self._prefix + key)
+        if raw is None:
+            return None
+        d = json.loads(raw)
+        return d["text"], float(d.get("cost_seconds", 0.0))
+
+    def set(self, key, text, cost_seconds, ttl_seconds, agent):
+        value = json.dumps({"agent": agent, "text": text, "cost_seconds": cost_seconds}, ensure_ascii=False)
+        self._redis.set(self._prefix + key, value, ex=max(int(ttl_seconds), 1))
+
+    def delete(self, key):
+        self._redis.delete(self._prefix + key)
+
+
+class GenerationCache:
+    """
+    generate_content の結果をプロンプト内容のハッシュで再利用する。
+    Pub/Sub の再配信やオペレーターの再実行、同じ PM 質問の繰り返しで LLM を呼び直さない。
+    ストアの障害は握りつぶして通常どおり生成する（キャッシュは最適化に過ぎない）。
+    """
+
+    def __init__(self, store: BaseGenerationStore, enabled: bool = GENERATION_CACHE_ENABLED):
+        self.store = store
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"hits": 0, "misses": 0, "bypasses": 0, "rejected": 0, "errors": 0, "latency_saved_seconds": 0.0}
+        )
+
+    def _count(self, agent: str, field: str, amount: float = 1):
+        with self._lock:
+            self._stats[agent][field] += amount
+
+    def _lookup(self, agent: str, key: str) -> Optional[str]:
+        try:
+            cached = self.store.get(key)
+        except Exception as e:
+            print(f"⚠️ Generation cache read failed ({agent}): {e}")
+            self._count(agent, "errors")
+            cached = None
+        if cached is None:
+            self._count(agent, "misses")
+            return None
+        text, cost = cached
+        self._count(agent, "hits")
+        self._count(agent, "latency_saved_seconds", cost)
+        print(f"♻️ [{agent}] generation cache hit (saved ~{cost:.2f}s)")
+        return text
+
+    def _save(self, agent: str, key: str, text: str, cost: float, accept: Optional[Callable[[str], bool]]):
+        if accept is not None and not accept(text):
+            self._count(agent, "rejected")
+            return
+        try:
+            self.store.set(key, text, cost, agent_ttl(agent), agent)
+        except Exception as e:
+            print(f"⚠️ Generation cache write failed ({agent}): {e}")
+            self._count(agent, "errors")
+
+    async def _run_store(self, fn, *args):
+        if self.store.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    def _begin(self, agent: str, bypass: bool) -> bool:
+        """bypass の集計をして、キャッシュを読むべきかを返す"""
+        if bypass:
+            self._count(agent, "bypasses")
+            return False
+        return True
+
+    def get_or_generate(
+        self,
+        agent: str,
+        model_id: str,
+        system_instruction: Optional[str],
+        contents: Any,
+        generate: Callable[[], str],
+        generation_config: Optional[dict] = None,
+        bypass: bool = False,
+        accept: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        """
+        キャッシュにあればそれを返し、なければ generate() を呼んで保存する。
+        bypass=True（UI の「再生成」）ならキャッシュを読まずに生成し、結果で上書きする。
+        accept が False を返す結果（JSON が壊れている等）は保存しない。
+        """
+        if not self.enabled:
+            return generate()
+
+        key = generation_key(model_id, system_instruction, contents, generation_config)
+        if self._begin(agent, bypass):
+            text = self._lookup(agent, key)
+            if text is not None:
+                return text
+
+        start = time.perf_counter()
+        text = generate()
+        self._save(agent, key, text, time.perf_counter() - start, accept)
+        return text
+
+    async def get_or_generate_async(
+        self,
+        agent: str,
+        model_id: str,
+        system_instruction: Optional[str],
+        contents: Any,
+        generate: Callable[[], Awaitable[str]],
+        generation_config: Optional[dict] = None,
+        bypass: bool = False,
+        accept: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        """get_or_generate の asyncio 版（generate はコルーチン関数）"""
+        if not self.enabled:
+            return await generate()
+
+        key = generation_key(model_id, system_instruction, contents, generation_config)
+        if self._begin(agent, bypass):
+            text = await self._run_store(self._lookup, agent, key)
+            if text is not None:
+                return text
+
+        start = time.perf_counter()
+        text = await generate()
+        await self._run_store(self._save, agent, key, text, time.perf_counter() - start, accept)
+        return text
+
+    def stream(
+        self,
+        agent: str,
+        model_id: str,
+        system_instruction: Optional[str],
+        contents: Any,
+        generate_stream: Callable[[], Iterator[str]],
+        generation_config: Optional[dict] = None,
+        bypass: bool = False,
+        accept: Optional[Callable[[str], bool]] = None,
+    ) -> Iterator[str]:
+        """
+        get_or_generate のストリーミング版。ヒット時はキャッシュ済みのテキストを1チャンクで返し、
+        ミス時は生成しながらチャンクを返して、最後まで生成できた結果だけを保存する。
+        """
+        if not self.enabled:
+            yield from generate_stream()
+            return
+
+        key = generation_key(model_id, system_instruction, contents, generation_config)
+        if self._begin(agent, bypass):
+            text = self._lookup(agent, key)
+            if text is not None:
+                yield text
+                return
+
+        start = time.perf_counter()
+        chunks = []
+        for chunk in generate_stream():
+            chunks.append(chunk)
+            yield chunk
+        self._save(agent, key, "".join(chunks), time.perf_counter() - start, accept)
+
+    async def stream_async(
+        self,
+        agent: str,
+        model_id: str,
+        system_instruction: Optional[str],
+        contents: Any,
+        generate_stream: Callable[[], AsyncIterator[str]],
+        generation_config: Optional[dict] = None,
+        bypass: bool = False,
+        accept: Optional[Callable[[str], bool]] = None,
+    ) -> AsyncIterator[str]:
+        """stream の asyncio 版（generate_stream は非同期イテレータを返す）"""
+        if not self.enabled:
+            async for chunk in generate_stream():
+                yield chunk
+            return
+
+        key = generation_key(model_id, system_instruction, contents, generation_config)
+        if self._begin(agent, bypass):
+            text = await self._run_store(self._lookup, agent, key)
+            if text is not None:
+                yield text
+                return
+
+        start = time.perf_counter()
+        chunks = []
+        async for chunk in generate_stream():
+            chunks.append(chunk)
+            yield chunk
+        await self._run_store(self._save, agent, key, "".join(chunks), time.perf_counter() - start, accept)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            agents = {}
+            for agent, s in self._stats.items():
+                lookups = s["hits"] + s["misses"]
+                agents[agent] = {
+                    **{k: (round(v, 3) if k == "latency_saved_seconds" else int(v)) for k, v in s.items()},
+                    "hit_rate": round(s["hits"] / lookups, 4) if lookups else 0.0,
+                }
+        return {
+            "backend": type(self.store).__name__,
+            "enabled": self.enabled,
+            "agents": agents,
+        }
+
+
+def create_generation_cache(db=None, backend: str = GENERATION_CACHE_BACKEND) -> GenerationCache:
+    backend = (backend or "memory").lower()
+    if backend == "firestore":
+        if db is None:
+            raise ValueError("Firestore backend requires a firestore.Client")
+        return GenerationCache(FirestoreGenerationStore(db))
+    if backend == "redis":
+        return GenerationCache(RedisGenerationStore())
+    return GenerationCache(MemoryGenerationStore())
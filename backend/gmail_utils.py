@@ -1,14 +1,24 @@
 import base64
+import hashlib
 import os
 import json
 import re
+import tempfile
+import threading
 
+import httplib2
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 from email.mime.text import MIMEText
 from email.utils import parseaddr
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
 from googleapiclient.errors import HttpError
-from google.cloud import storage
+from attachment_store import store_attachment
+from resilience import call
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,78 +27,303 @@ PROJECT_ID = os.getenv("GCP_PROJECT_ID", "tier3-ops-resolver")
 UPLOAD_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME", "tier3-ops-resolver-uploads")
 PROCESSED_LABEL_NAME = "OpsResolver_Done"
 
+GMAIL_SCOPES = [
+    'https://www.googleapis.com/auth/gmail.modify',
+    'https://www.googleapis.com/auth/gmail.send'
+]
+GMAIL_TOKEN_PATH = os.getenv("GMAIL_TOKEN_PATH", "token.json")
+GMAIL_HTTP_TIMEOUT = float(os.getenv("GMAIL_HTTP_TIMEOUT", "60"))
+GMAIL_HISTORY_MAX_PAGES = int(os.getenv("GMAIL_HISTORY_MAX_PAGES", "20"))
+
+ATTACHMENT_UPLOAD_WORKERS = int(os.getenv("ATTACHMENT_UPLOAD_WORKERS", "4"))
+# GCS のレジューマブルアップロードは 256KB の倍数でチャンクを切る必要がある
+ATTACHMENT_CHUNK_BYTES = int(os.getenv("ATTACHMENT_CHUNK_MB", "8")) * 1024 * 1024
+ATTACHMENT_MAX_FILE_BYTES = int(os.getenv("ATTACHMENT_MAX_FILE_MB", "100")) * 1024 * 1024
+# Gmail API は添付を base64 の JSON で丸ごと返すため、ダウンロード〜デコード中はサイズの数倍をメモリに持つ。
+# 並列ワーカー全体で同時にダウンロードしてよい添付の合計サイズをここで抑える
+ATTACHMENT_INFLIGHT_BYTES = int(os.getenv("ATTACHMENT_INFLIGHT_MB", "200")) * 1024 * 1024
+ATTACHMENT_MAX_MESSAGE_BYTES = int(os.getenv("ATTACHMENT_MAX_MESSAGE_MB", "1024")) * 1024 * 1024
+
+_creds_lock = threading.Lock()
+_credentials = None
+_discovery_doc = None
+# httplib2.Http はスレッドセーフではないため、サービスオブジェクトはスレッドごとに持つ
+_thread_local = threading.local()
+
+def get_gmail_credentials() -> Credentials:
+    """token.json の認証情報をキャッシュし、期限切れの時だけリフレッシュする"""
+    global _credentials
+    with _creds_lock:
+        if _credentials is None:
+            _credentials = Credentials.from_authorized_user_file(GMAIL_TOKEN_PATH, GMAIL_SCOPES)
+        if not _credentials.valid and _credentials.refresh_token:
+            print("🔑 Refreshing Gmail access token...")
+            _credentials.refresh(Request())
+        return _credentials
+
+def _get_discovery_doc() -> dict:
+    """ライブラリ同梱の静的 Discovery Document を一度だけ読み込む"""
+    global _discovery_doc
+    if _discovery_doc is None:
+        _discovery_doc = json.loads(discovery_cache.get_static_doc('gmail', 'v1'))
+    return _discovery_doc
+
+def _execute(request, stage: str = "gmail"):
+    """
+    Gmail API のリクエストを実行する（429 / 5xx はバックオフ付きで再試行）。
+    締め切りは httplib2 のタイムアウト。httplib2 はスレッドをまたげないので呼び出し元のスレッドで実行する
+    """
+    return call(stage, request.execute, inline=True)
+
 def get_gmail_service():
-    """token.jsonからGmail APIクライアントを生成"""
-    SCOPES = [
-        'https://www.googleapis.com/auth/gmail.modify',
-        'https://www.googleapis.com/auth/gmail.send'
-    ]
-    creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    return build('gmail', 'v1', credentials=creds)
-
-def get_or_create_label_id(service):
-    """処理済みラベルのIDを取得、なければ作成する"""
-    results = service.users().labels().list(userId='me').execute()
-    labels = results.get('labels', [])
-    
-    for label in labels:
+    """呼び出しスレッド専用の Gmail API クライアントを返す（初回のみ生成）"""
+    creds = get_gmail_credentials()
+    service = getattr(_thread_local, "gmail_service", None)
+    if service is None:
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT))
+        service = build_from_document(_get_discovery_doc(), http=http)
+        _thread_local.gmail_service = service
+    return service
+
+# 処理済みラベルIDはプロセス全体で共有（初回のみ labels.list / create）
+_label_lock = threading.Lock()
+_label_id = None
+
+def _find_label_id(service):
+    results = _execute(service.users().labels().list(userId='me'))
+    for label in results.get('labels', []):
         if label['name'] == PROCESSED_LABEL_NAME:
             return label['id']
-    
-    print(f"🏷️ Creating label: {PROCESSED_LABEL_NAME}")
-    label_object = {
-        'name': PROCESSED_LABEL_NAME,
-        'labelListVisibility': 'labelShow',
-        'messageListVisibility': 'show'
-    }
-    created = service.users().labels().create(userId='me', body=label_object).execute()
-    return created['id']
-
-def parse_and_upload_attachments(service, user_id, msg_id, parts):
-    """添付ファイルをGCSに上げる"""
-    files_info = []
-    if not parts: return []
+    return None
 
-    for part in parts:
-        if part.get('filename') and part.get('body') and part.get('body').get('attachmentId'):
-            att_id = part['body']['attachmentId']
-            filename = part['filename']
+def get_or_create_label_id(service, refresh: bool = False):
+    """処理済みラベルのIDを取得、なければ作成する"""
+    global _label_id
+    cached = _label_id
+    if cached and not refresh:
+        return cached
+
+    with _label_lock:
+        # 待っている間に他スレッドが取得/再取得済みならそれを使う
+        if _label_id and (not refresh or _label_id != cached):
+            return _label_id
+
+        label_id = _find_label_id(service)
+        if not label_id:
+            print(f"🏷️ Creating label: {PROCESSED_LABEL_NAME}")
+            label_object = {
+                'name': PROCESSED_LABEL_NAME,
+                'labelListVisibility': 'labelShow',
+                'messageListVisibility': 'show'
+            }
             try:
-                att = service.users().messages().attachments().get(userId=user_id, messageId=msg_id, id=att_id).execute()
-                data = base64.urlsafe_b64decode(att['data'].encode('UTF-8'))
-                
-                storage_client = storage.Client(project=PROJECT_ID)
-                bucket = storage_client.bucket(UPLOAD_BUCKET_NAME)
-                blob_path = f"emails/{msg_id}/{filename}"
-                blob = bucket.blob(blob_path)
-                blob.upload_from_string(data, content_type=part.get('mimeType'))
-                
-                gcs_uri = f"gs://{UPLOAD_BUCKET_NAME}/{blob_path}"
-                print(f"📎 Uploaded attachment: {gcs_uri}")
-                files_info.append(gcs_uri)
-            except Exception as e:
-                print(f"⚠️ Attachment upload failed: {e}")
-                
+                created = service.users().labels().create(userId='me', body=label_object).execute()
+                label_id = created['id']
+            except HttpError as e:
+                # 別インスタンスが先に作成した場合
+                if e.resp.status != 409:
+                    raise
+                label_id = _find_label_id(service)
+
+        _label_id = label_id
+        return label_id
+
+def _is_missing_label_error(error: HttpError) -> bool:
+    return error.resp.status in (400, 404) and "label" in str(error).lower()
+
+def mark_message_processed(service, msg_id: str):
+    """処理済みラベルを付けて既読にする（ラベルが消されていたらID を取り直して再試行）"""
+    for attempt in range(2):
+        label_id = get_or_create_label_id(service, refresh=attempt > 0)
+        try:
+            _execute(service.users().messages().modify(
+                userId='me',
+                id=msg_id,
+                body={
+                    'addLabelIds': [label_id],
+                    'removeLabelIds': ['UNREAD']
+                }
+            ))
+            return
+        except HttpError as e:
+            if attempt == 0 and _is_missing_label_error(e):
+                print(f"⚠️ Processed label {label_id} seems missing. Refreshing label ID...")
+                continue
+            raise
+
+attachment_executor = ThreadPoolExecutor(max_workers=ATTACHMENT_UPLOAD_WORKERS, thread_name_prefix="attachment")
+
+class _ByteBudget:
+    """バイト数で数えるセマフォ。上限を超える1件は、他に誰も持っていなければ単独で通す"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n: int):
+        with self._cond:
+            while self.in_use > 0 and self.in_use + n > self.limit:
+                self._cond.wait()
+            self.in_use += n
+
+    def release(self, n: int):
+        with self._cond:
+            self.in_use -= n
+            self._cond.notify_all()
+
+attachment_download_budget = _ByteBudget(ATTACHMENT_INFLIGHT_BYTES)
+
+def _collect_attachment_parts(parts) -> List[dict]:
+    """MIME パートを再帰せずに走査し、attachmentId を持つ添付パートを出現順に返す"""
+    found = []
+    stack = list(reversed(parts or []))
+    while stack:
+        part = stack.pop()
+        if part.get('filename') and part.get('body') and part.get('body').get('attachmentId'):
+            found.append(part)
         if part.get('parts'):
-            files_info.extend(parse_and_upload_attachments(service, user_id, msg_id, part['parts']))
-    return files_info
+            stack.extend(reversed(part['parts']))
+    return found
+
+def _decode_to_spool(b64_data: str) -> Tuple[tempfile.SpooledTemporaryFile, str, int]:
+    """base64url 文字列をチャンク単位でデコードして一時ファイルに書き出し、(file, sha256, size) を返す"""
+    spool = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_CHUNK_BYTES)
+    digest = hashlib.sha256()
+    size = 0
+    step = (ATTACHMENT_CHUNK_BYTES // 3) * 4
+    for i in range(0, len(b64_data), step):
+        chunk = b64_data[i:i + step]
+        chunk += "=" * (-len(chunk) % 4)
+        decoded = base64.urlsafe_b64decode(chunk)
+        digest.update(decoded)
+        size += len(decoded)
+        spool.write(decoded)
+    spool.seek(0)
+    return spool, digest.hexdigest(), size
+
+def _upload_attachment(user_id: str, msg_id: str, part: dict) -> Optional[str]:
+    att_id = part['body']['attachmentId']
+    filename = part['filename']
+    reserved = int(part['body'].get('size') or 0)
+    try:
+        service = get_gmail_service()
+        # 一時ファイルに書き出すまでは添付全体がメモリに載るので、その間だけ枠を取る
+        attachment_download_budget.acquire(reserved)
+        try:
+            att = _execute(service.users().messages().attachments().get(userId=user_id, messageId=msg_id, id=att_id))
+            # Gmail API は添付を JSON 内の base64 として一括で返すため、ここから先をストリーム化する
+            spool, sha256, size = _decode_to_spool(att.pop('data'))
+            del att
+        finally:
+            attachment_download_budget.release(reserved)
+
+        with spool:
+            gcs_uri, duplicate = store_attachment(
+                spool, sha256, size, filename, part.get('mimeType'), msg_id,
+                chunk_size=ATTACHMENT_CHUNK_BYTES,
+            )
+
+        if duplicate:
+            print(f"♻️ Duplicate attachment, reusing: {gcs_uri} ({filename})")
+        else:
+            print(f"📎 Uploaded attachment: {gcs_uri} ({filename})")
+        return gcs_uri
+    except Exception as e:
+        print(f"⚠️ Attachment upload failed ({filename}): {e}")
+        return None
 
-def fetch_history_changes(start_history_id: str):
-    """指定された historyId 以降の変更履歴を取得する"""
+def parse_and_upload_attachments(service, user_id, msg_id, parts):
+    """添付ファイルをGCSに上げる（サイズ上限チェック → 並列・チャンク分割アップロード）"""
+    targets = []
+    total_bytes = 0
+    for part in _collect_attachment_parts(parts):
+        size = int(part['body'].get('size') or 0)
+        if size > ATTACHMENT_MAX_FILE_BYTES:
+            print(f"⏩ Skipped attachment over per-file cap: {part['filename']} ({size} bytes)")
+            continue
+        if total_bytes + size > ATTACHMENT_MAX_MESSAGE_BYTES:
+            print(f"⏩ Skipped attachment over per-message cap: {part['filename']} ({size} bytes)")
+            continue
+        total_bytes += size
+        targets.append(part)
+
+    if not targets:
+        return []
+
+    results = attachment_executor.map(lambda p: _upload_attachment(user_id, msg_id, p), targets)
+    return [uri for uri in results if uri]
+
+def fetch_history_changes(start_history_id: str, max_pages: int = GMAIL_HISTORY_MAX_PAGES):
+    """
+    指定された historyId 以降の変更履歴（INBOXへの messageAdded）を全ページ取得する。
+    戻り値: (history レコード, 最新の historyId, エラー)
+    """
     service = get_gmail_service()
+    history: List[dict] = []
+    latest_history_id = None
+    page_token = None
     try:
-        history = service.users().history().list(
-            userId='me', 
-            startHistoryId=start_history_id, 
-            historyTypes=['messageAdded']
-        ).execute()
-        return history.get('history', []), None
+        for _ in range(max_pages):
+            response = _execute(service.users().history().list(
+                userId='me', 
+                startHistoryId=start_history_id, 
+                historyTypes=['messageAdded'],
+                labelId='INBOX',
+                pageToken=page_token,
+            ))
+            history.extend(response.get('history', []))
+            latest_history_id = response.get('historyId', latest_history_id)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+        else:
+            print(f"⚠️ History paging stopped after {max_pages} pages.")
+        return history, latest_history_id, None
     except HttpError as error:
         if error.resp.status == 404:
             print("⚠️ History ID too old or invalid. Need reset.")
-            return [], "RESET_REQUIRED"
+            return [], None, "RESET_REQUIRED"
         raise error
 
+def extract_added_message_ids(history: List[dict]) -> List[str]:
+    """history レコードから新着メッセージIDを重複なく取り出す（自分の送信/下書きは除外）"""
+    seen = set()
+    msg_ids = []
+    for record in history:
+        for added in record.get('messagesAdded', []):
+            message = added.get('message', {})
+            labels = message.get('labelIds', [])
+            if 'SENT' in labels or 'DRAFT' in labels:
+                continue
+            msg_id = message.get('id')
+            if msg_id and msg_id not in seen:
+                seen.add(msg_id)
+                msg_ids.append(msg_id)
+    return msg_ids
+
+def list_unread_message_ids(query: str, max_messages: int) -> List[str]:
+    """検索クエリに一致するメッセージIDをページングしながら最大 max_messages 件取得する"""
+    service = get_gmail_service()
+    msg_ids: List[str] = []
+    page_token = None
+    while len(msg_ids) < max_messages:
+        response = _execute(service.users().messages().list(
+            userId='me',
+            q=query,
+            maxResults=min(500, max_messages - len(msg_ids)),
+            pageToken=page_token,
+        ))
+        msg_ids.extend(m['id'] for m in response.get('messages', []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+    return msg_ids
+
+def get_current_history_id() -> str:
+    service = get_gmail_service()
+    return _execute(service.users().getProfile(userId='me'))['historyId']
+
 def _b64url_decode(data: str) -> bytes:
     data = data.replace("-", "+").replace("_", "/")
     data += "=" * (-len(data) % 4)
@@ -132,31 +367,18 @@ def get_email_body(payload: dict) -> str:
 
     return ""
 
-def process_single_message(msg_id: str):
-    """メッセージIDから詳細を取得し、ターゲットならデータを返す"""
-    service = get_gmail_service()
-    try:
-        message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-    except HttpError as e:
-        if e.resp.status == 404:
-            return None
-        raise e
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+
+def _is_already_processed(service, message: dict) -> bool:
+    return get_or_create_label_id(service) in message.get('labelIds', [])
 
+def _extract_incident(service, message: dict) -> dict:
+    """Gmailメッセージ(format=full)からインシデント情報を組み立て、添付をGCSに上げる"""
+    msg_id = message['id']
     thread_id = message.get('threadId')
     payload = message.get('payload', {})
     headers = payload.get('headers', [])
 
-    label_id = get_or_create_label_id(service)
-    if label_id in message.get('labelIds', []):
-        print(f"⏩ Already processed: {msg_id}")
-        try:
-            service.users().messages().modify(
-                userId='me', id=msg_id, body={'removeLabelIds': ['UNREAD']}
-            ).execute()
-        except Exception:
-            pass
-        return None
-
     hmap = {h.get('name', '').lower(): h.get('value') for h in headers}
     subject = hmap.get('subject', '(No Subject)')
     raw_from = hmap.get('from', 'Unknown')
@@ -189,16 +411,6 @@ def process_single_message(msg_id: str):
 
     file_urls = parse_and_upload_attachments(service, 'me', msg_id, payload.get('parts', []))
 
-    service.users().messages().modify(
-        userId='me',
-        id=msg_id,
-        body={
-            'addLabelIds': [label_id],
-            'removeLabelIds': ['UNREAD']
-        }
-    ).execute()
-    print("🏷️ Marked as processed (Done + Read).")
-
     return {
         "title": subject,
         "description": full_body,
@@ -210,6 +422,130 @@ def process_single_message(msg_id: str):
         "gmail_message_id": message_id,
     }
 
+def process_single_message(msg_id: str):
+    """
+    メッセージIDから詳細を取得し、ターゲットならデータを返す。
+    処理済みラベルはまだ付けない（呼び出し側がジョブを積んでから mark_message_processed する）
+    """
+    service = get_gmail_service()
+    try:
+        message = _execute(service.users().messages().get(userId='me', id=msg_id, format='full'))
+    except HttpError as e:
+        if e.resp.status == 404:
+            return None
+        raise e
+
+    if _is_already_processed(service, message):
+        print(f"⏩ Already processed: {msg_id}")
+        try:
+            _execute(service.users().messages().modify(
+                userId='me', id=msg_id, body={'removeLabelIds': ['UNREAD']}
+            ))
+        except Exception:
+            pass
+        return None
+
+    return _extract_incident(service, message)
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def fetch_messages_batch(service, msg_ids: List[str]) -> Dict[str, Optional[dict]]:
+    """
+    messages.get(format=full) を HTTP バッチでまとめて取得する。
+    失敗したパートは個別 get にフォールバックし、404 のメッセージは None を返す。
+    """
+    messages: Dict[str, Optional[dict]] = {}
+    failed: List[str] = []
+
+    def on_response(request_id, response, exception):
+        if exception is None:
+            messages[request_id] = response
+        elif isinstance(exception, HttpError) and exception.resp.status == 404:
+            messages[request_id] = None
+        else:
+            print(f"⚠️ Batch get failed for {request_id}: {exception}")
+            failed.append(request_id)
+
+    for chunk in _chunks(list(msg_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for msg_id in chunk:
+            batch.add(service.users().messages().get(userId='me', id=msg_id, format='full'), request_id=msg_id)
+        try:
+            batch.execute()
+        except Exception as e:
+            print(f"⚠️ Batch request failed ({len(chunk)} messages): {e}")
+            failed.extend(m for m in chunk if m not in messages and m not in failed)
+
+    for msg_id in failed:
+        try:
+            messages[msg_id] = _execute(service.users().messages().get(userId='me', id=msg_id, format='full'))
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            messages[msg_id] = None
+
+    return messages
+
+def _batch_modify(service, msg_ids: List[str], body: dict):
+    for chunk in _chunks(list(msg_ids), 1000):
+        _execute(service.users().messages().batchModify(userId='me', body={**body, 'ids': chunk}))
+
+def mark_messages_processed(service, msg_ids: List[str]):
+    """messages.batchModify で処理済みラベル付与 + 既読化をまとめて行う（失敗時は1件ずつ）"""
+    if not msg_ids:
+        return
+    for attempt in range(2):
+        label_id = get_or_create_label_id(service, refresh=attempt > 0)
+        try:
+            _batch_modify(service, msg_ids, {'addLabelIds': [label_id], 'removeLabelIds': ['UNREAD']})
+            print(f"🏷️ Marked {len(msg_ids)} messages as processed (Done + Read).")
+            return
+        except HttpError as e:
+            if attempt == 0 and _is_missing_label_error(e):
+                print(f"⚠️ Processed label {label_id} seems missing. Refreshing label ID...")
+                continue
+            print(f"⚠️ batchModify failed, falling back to per-message modify: {e}")
+            break
+
+    for msg_id in msg_ids:
+        mark_message_processed(service, msg_id)
+
+def process_messages_batch(msg_ids: List[str]) -> Tuple[List[Tuple[str, dict]], List[str]]:
+    """
+    複数メッセージを一括で取り込む（バッチ取得 → 添付アップロード）。
+    戻り値: ([(msg_id, incident)], 取り込みに失敗した msg_id)。
+    処理済みラベルはまだ付けない（呼び出し側がジョブを積めた分だけ mark_messages_processed する）
+    """
+    service = get_gmail_service()
+    messages = fetch_messages_batch(service, msg_ids)
+
+    incidents: List[Tuple[str, dict]] = []
+    failed: List[str] = []
+    already_processed: List[str] = []
+    for msg_id in msg_ids:
+        message = messages.get(msg_id)
+        if not message:
+            continue
+        if _is_already_processed(service, message):
+            print(f"⏩ Already processed: {msg_id}")
+            already_processed.append(msg_id)
+            continue
+        try:
+            incidents.append((msg_id, _extract_incident(service, message)))
+        except Exception as e:
+            print(f"⚠️ Failed to ingest message {msg_id}: {e}")
+            failed.append(msg_id)
+
+    if already_processed:
+        try:
+            _batch_modify(service, already_processed, {'removeLabelIds': ['UNREAD']})
+        except Exception:
+            pass
+
+    return incidents, failed
+
 def _normalize_msgid(v: str | None) -> str | None:
     if not v:
         return None
@@ -255,7 +591,7 @@ def send_reply(
         if thread_id:
             body_obj["threadId"] = thread_id
 
-        sent_message = service.users().messages().send(userId="me", body=body_obj).execute()
+        sent_message = _execute(service.users().messages().send(userId="me", body=body_obj), stage="gmail_send")
         print(f"📧 Sent email to {to_email} (Msg ID: {sent_message['id']})")
         return sent_message
     except Exception as e:
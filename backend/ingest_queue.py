@@ -0,0 +1,464 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from typing import Callable, Dict, List, Optional
+from schemas import IngestJob
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# firestore (既定・本番) / sqlite / memory (ローカル検証用に明示したときだけ)。
+# Webhook は即 ACK し、メールは処理済みラベルと history カーソルで再取得されなくなるため、
+# プロセス内メモリのキューだとインスタンスの入れ替わりでジョブが失われる
+INGEST_QUEUE_BACKEND = os.getenv("INGEST_QUEUE_BACKEND", "firestore")
+INGEST_QUEUE_SQLITE_PATH = os.getenv("INGEST_QUEUE_SQLITE_PATH", "ingest_queue.db")
+INGEST_QUEUE_COLLECTION = os.getenv("INGEST_QUEUE_COLLECTION", "ingest_queue")
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "5"))
+INGEST_LEASE_SECONDS = float(os.getenv("INGEST_LEASE_SECONDS", "600"))
+INGEST_RETRY_BASE_SECONDS = float(os.getenv("INGEST_RETRY_BASE_SECONDS", "5"))
+INGEST_RETRY_MAX_SECONDS = float(os.getenv("INGEST_RETRY_MAX_SECONDS", "300"))
+INGEST_POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", "5"))
+# DONE になったジョブを重複排除用に保持する期間
+INGEST_DONE_RETENTION_SECONDS = float(os.getenv("INGEST_DONE_RETENTION_SECONDS", str(3 * 24 * 3600)))
+
+
+class NonRetryableJobError(Exception):
+    """リトライしても成功しないジョブ。即座に Dead Letter に送る"""
+
+
+def _new_job(kind: str, payload: dict, job_id: Optional[str]) -> IngestJob:
+    now = time.time()
+    return IngestJob(
+        id=job_id or f"job-{uuid.uuid4().hex}",
+        kind=kind,
+        payload=payload,
+        available_at=now,
+        created_at=now,
+        updated_at=now,
+    )
+
+
+class BaseIngestQueue:
+    """
+    取り込みジョブキューのインターフェース。
+    job_id を重複排除キーとして扱い、同じIDのジョブは一度しか登録されない（Pub/Sub再配信対策）。
+    """
+
+    def enqueue(self, kind: str, payload: dict, job_id: Optional[str] = None) -> bool:
+        raise NotImplementedError
+
+    def claim(self) -> Optional[IngestJob]:
+        """実行可能なジョブを1件リースする（期限切れリースも再取得対象）"""
+        raise NotImplementedError
+
+    def complete(self, job: IngestJob):
+        raise NotImplementedError
+
+    def fail(self, job: IngestJob, error: str, retry_in: Optional[float]):
+        """retry_in が None なら Dead Letter、それ以外は retry_in 秒後に再実行"""
+        raise NotImplementedError
+
+    def dead_letters(self, limit: int = 50) -> List[IngestJob]:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+
+class InMemoryIngestQueue(BaseIngestQueue):
+    def __init__(self):
+        self._jobs: Dict[str, IngestJob] = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, kind, payload, job_id=None):
+        job = _new_job(kind, payload, job_id)
+        with self._lock:
+            self._purge_done(job.created_at)
+            if job.id in self._jobs:
+                return False
+            self._jobs[job.id] = job
+        return True
+
+    def claim(self):
+        now = time.time()
+        with self._lock:
+            candidates = [
+                j for j in self._jobs.values()
+                if (j.status == "PENDING" and j.available_at <= now)
+                or (j.status == "LEASED" and (j.lease_until or 0) <= now)
+            ]
+            if not candidates:
+                return None
+            job = min(candidates, key=lambda j: j.available_at)
+            job.status = "LEASED"
+            job.attempts += 1
+            job.lease_until = now + INGEST_LEASE_SECONDS
+            job.updated_at = now
+            return job.model_copy(deep=True)
+
+    def complete(self, job):
+        with self._lock:
+            stored = self._jobs.get(job.id)
+            if stored:
+                stored.status = "DONE"
+                stored.lease_until = None
+                stored.updated_at = time.time()
+
+    def fail(self, job, error, retry_in):
+        now = time.time()
+        with self._lock:
+            stored = self._jobs.get(job.id)
+            if not stored:
+                return
+            stored.last_error = error
+            stored.lease_until = None
+            stored.updated_at = now
+            if retry_in is None:
+                stored.status = "DEAD"
+            else:
+                stored.status = "PENDING"
+                stored.available_at = now + retry_in
+
+    def dead_letters(self, limit=50):
+        with self._lock:
+            dead = [j.model_copy(deep=True) for j in self._jobs.values() if j.status == "DEAD"]
+        return sorted(dead, key=lambda j: j.updated_at, reverse=True)[:limit]
+
+    def stats(self):
+        counts = {"PENDING": 0, "LEASED": 0, "DONE": 0, "DEAD": 0}
+        with self._lock:
+            for j in self._jobs.values():
+                counts[j.status] += 1
+        return counts
+
+    def _purge_done(self, now: float):
+        expired = [
+            k for k, j in self._jobs.items()
+            if j.status == "DONE" and j.updated_at < now - INGEST_DONE_RETENTION_SECONDS
+        ]
+        for k in expired:
+            del self._jobs[k]
+
+
+class SqliteIngestQueue(BaseIngestQueue):
+    def __init__(self, path: str = INGEST_QUEUE_SQLITE_PATH):
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                available_at REAL NOT NULL,
+                lease_until REAL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_jobs_ready ON ingest_jobs(status, available_at)")
+
+    def _row_to_job(self, row) -> IngestJob:
+        return IngestJob(
+            id=row[0], kind=row[1], payload=json.loads(row[2]), status=row[3],
+            attempts=row[4], available_at=row[5], lease_until=row[6], last_error=row[7],
+            created_at=row[8], updated_at=row[9],
+        )
+
+    def enqueue(self, kind, payload, job_id=None):
+        job = _new_job(kind, payload, job_id)
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM ingest_jobs WHERE status = 'DONE' AND updated_at < ?",
+                (job.created_at - INGEST_DONE_RETENTION_SECONDS,),
+            )
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO ingest_jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.kind, json.dumps(job.payload, ensure_ascii=False), job.status,
+                 job.attempts, job.available_at, None, None, job.created_at, job.updated_at),
+            )
+        return cur.rowcount == 1
+
+    def claim(self):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    """
+                    SELECT * FROM ingest_jobs
+                    WHERE (status = 'PENDING' AND available_at <= ?)
+                       OR (status = 'LEASED' AND lease_until <= ?)
+                    ORDER BY available_at LIMIT 1
+                    """,
+                    (now, now),
+                ).fetchone()
+                if not row:
+                    self._conn.execute("COMMIT")
+                    return None
+                job = self._row_to_job(row)
+                job.status = "LEASED"
+                job.attempts += 1
+                job.lease_until = now + INGEST_LEASE_SECONDS
+                job.updated_at = now
+                self._conn.execute(
+                    "UPDATE ingest_jobs SET status = ?, attempts = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+                    (job.status, job.attempts, job.lease_until, job.updated_at, job.id),
+                )
+                self._conn.execute("COMMIT")
+                return job
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def complete(self, job):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE ingest_jobs SET status = 'DONE', lease_until = NULL, updated_at = ? WHERE id = ?",
+                (time.time(), job.id),
+            )
+
+    def fail(self, job, error, retry_in):
+        now = time.time()
+        with self._lock:
+            if retry_in is None:
+                self._conn.execute(
+                    "UPDATE ingest_jobs SET status = 'DEAD', lease_until = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+                    (error, now, job.id),
+                )
+            else:
+                self._conn.execute(
+                    """
+                    UPDATE ingest_jobs SET status = 'PENDING', lease_until = NULL, last_error = ?,
+                        available_at = ?, updated_at = ? WHERE id = ?
+                    """,
+                    (error, now + retry_in, now, job.id),
+                )
+
+    def dead_letters(self, limit=50):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM ingest_jobs WHERE status = 'DEAD' ORDER BY updated_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [self._row_to_job(r) for r in rows]
+
+    def stats(self):
+        counts = {"PENDING": 0, "LEASED": 0, "DONE": 0, "DEAD": 0}
+        with self._lock:
+            for status, n in self._conn.execute("SELECT status, COUNT(*) FROM ingest_jobs GROUP BY status"):
+                counts[status] = n
+        return counts
+
+
+class FirestoreIngestQueue(BaseIngestQueue):
+    """
+    Firestore をバックエンドにしたキュー（Cloud Run の複数インスタンスで共有）。
+    DONE ジョブの掃除は `expire_at` フィールドに Firestore TTL ポリシーを設定して行う。
+    クエリには (status, available_at) / (status, lease_until) の複合インデックスが必要。
+    """
+
+    def __init__(self, db, collection: str = INGEST_QUEUE_COLLECTION):
+        from google.cloud import firestore
+        from google.api_core.exceptions import AlreadyExists
+
+        self._firestore = firestore
+        self._already_exists = AlreadyExists
+        self._db = db
+        self._col = db.collection(collection)
+
+    def enqueue(self, kind, payload, job_id=None):
+        job = _new_job(kind, payload, job_id)
+        try:
+            self._col.document(job.id).create(job.model_dump())
+            return True
+        except self._already_exists:
+            return False
+
+    def claim(self):
+        now = time.time()
+        ready = list(
+            self._col.where("status", "==", "PENDING")
+            .where("available_at", "<=", now)
+            .order_by("available_at")
+            .limit(5)
+            .stream()
+        )
+        expired = list(
+            self._col.where("status", "==", "LEASED")
+            .where("lease_until", "<=", now)
+            .limit(5)
+            .stream()
+        )
+        for snap in ready + expired:
+            job = self._try_lease(snap.reference, now)
+            if job:
+                return job
+        return None
+
+    def _try_lease(self, doc_ref, now: float) -> Optional[IngestJob]:
+        transaction = self._db.transaction()
+
+        @self._firestore.transactional
+        def lease(tx):
+            snap = doc_ref.get(transaction=tx)
+            if not snap.exists:
+                return None
+            job = IngestJob(**snap.to_dict())
+            claimable = (job.status == "PENDING" and job.available_at <= now) or (
+                job.status == "LEASED" and (job.lease_until or 0) <= now
+            )
+            if not claimable:
+                return None
+            job.status = "LEASED"
+            job.attempts += 1
+            job.lease_until = now + INGEST_LEASE_SECONDS
+            job.updated_at = now
+            tx.update(doc_ref, {
+                "status": job.status,
+                "attempts": job.attempts,
+                "lease_until": job.lease_until,
+                "updated_at": job.updated_at,
+            })
+            return job
+
+        return lease(transaction)
+
+    def complete(self, job):
+        from datetime import datetime, timezone
+
+        now = time.time()
+        self._col.document(job.id).update({
+            "status": "DONE",
+            "lease_until": None,
+            "updated_at": now,
+            "expire_at": datetime.fromtimestamp(now + INGEST_DONE_RETENTION_SECONDS, tz=timezone.utc),
+        })
+
+    def fail(self, job, error, retry_in):
+        now = time.time()
+        update = {"last_error": error, "lease_until": None, "updated_at": now}
+        if retry_in is None:
+            update["status"] = "DEAD"
+        else:
+            update["status"] = "PENDING"
+            update["available_at"] = now + retry_in
+        self._col.document(job.id).update(update)
+
+    def dead_letters(self, limit=50):
+        docs = self._col.where("status", "==", "DEAD").limit(limit).stream()
+        return [IngestJob(**d.to_dict()) for d in docs]
+
+    def stats(self):
+        counts = {}
+        for status in ("PENDING", "LEASED", "DEAD"):
+            result = self._col.where("status", "==", status).count().get()
+            counts[status] = int(result[0][0].value)
+        return counts
+
+
+def create_ingest_queue(db=None, backend: str = INGEST_QUEUE_BACKEND) -> BaseIngestQueue:
+    backend = (backend or "firestore").lower()
+    if backend == "firestore":
+        if db is None:
+            raise ValueError("Firestore backend requires a firestore.Client")
+        return FirestoreIngestQueue(db)
+    if backend == "sqlite":
+        print("⚠️ Ingest queue: sqlite backend (local file; not shared across instances)")
+        return SqliteIngestQueue()
+    if backend == "memory":
+        print("⚠️ Ingest queue: in-memory backend (jobs are lost on restart; local use only)")
+        return InMemoryIngestQueue()
+    raise ValueError(f"Unknown INGEST_QUEUE_BACKEND: {backend}")
+
+
+class IngestWorkerPool:
+    """
+    キューを並列数上限付きで消化するワーカースレッド群。
+    失敗したジョブはジッター付き指数バックオフで再実行し、上限回数を超えたら Dead Letter に送る。
+    """
+
+    def __init__(
+        self,
+        queue: BaseIngestQueue,
+        handlers: Dict[str, Callable[[dict], None]],
+        workers: int = INGEST_WORKERS,
+        max_attempts: int = INGEST_MAX_ATTEMPTS,
+    ):
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"ingest-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        print(f"👷 Ingest workers started: {self.workers} (backend={type(self.queue).__name__})")
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        self._wakeup.set()
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+
+    def wake(self):
+        """新しいジョブが積まれたことをワーカーに知らせる"""
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim()
+            except Exception as e:
+                print(f"⚠️ Ingest queue claim failed: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(INGEST_POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+
+            self._execute(job)
+
+    def _execute(self, job: IngestJob):
+        handler = self.handlers.get(job.kind)
+        if handler is None:
+            self.queue.fail(job, f"No handler for job kind: {job.kind}", None)
+            return
+
+        try:
+            handler(job.payload)
+            self.queue.complete(job)
+        except NonRetryableJobError as e:
+            print(f"☠️ Job {job.id} dead-lettered: {e}")
+            self.queue.fail(job, str(e), None)
+        except Exception as e:
+            traceback.print_exc()
+            if job.attempts >= self.max_attempts:
+                print(f"☠️ Job {job.id} dead-lettered after {job.attempts} attempts: {e}")
+                self.queue.fail(job, str(e), None)
+            else:
+                delay = min(INGEST_RETRY_MAX_SECONDS, INGEST_RETRY_BASE_SECONDS * (2 ** (job.attempts - 1)))
+                delay = random.uniform(delay / 2, delay)
+                print(f"🔁 Job {job.id} failed (attempt {job.attempts}), retry in {delay:.1f}s: {e}")
+                self.queue.fail(job, str(e), delay)
@@ -0,0 +1,179 @@
+import json
+import re
+import threading
+
+from typing import Any, Dict
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*\n?(.*?)\n?\s*```", re.DOTALL)
+_VALID_ESCAPES = set('"\\/bfnrtu')
+_HEX = set("0123456789abcdefABCDEF")
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+# プロセス全体の集計（/metrics 用）
+_stats_lock = threading.Lock()
+_stats = {"clean": 0, "repaired": 0, "failed": 0, "regenerated": 0}
+
+
+class JsonOutputError(ValueError):
+    """修復しても JSON として読めない（もしくはスキーマに合わない）生成結果"""
+
+    def __init__(self, message: str, raw_text: str = ""):
+        super().__init__(message)
+        self.raw_text = raw_text
+
+
+def _count(field: str):
+    with _stats_lock:
+        _stats[field] += 1
+
+
+def record_regeneration():
+    """修復できずに生成し直した回数（呼び出し側が数える）"""
+    _count("regenerated")
+
+
+def json_repair_stats() -> Dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _strip_fences(text: str) -> str:
+    m = _FENCE.search(text)
+    return m.group(1) if m else text
+
+
+def _outer_object(text: str) -> str:
+    """最初の { から、対応する } まで（文字列内の括弧は数えない）。閉じていなければ末尾まで"""
+    start = text.find("{")
+    if start == -1:
+        return text
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:]
+
+
+def _repair(text: str) -> str:
+    """
+    よくある崩れを1パスで直す:
+    - 文字列内の不正なエスケープ（Windows パスの C:\\Users 等）はバックスラッシュを二重にする
+    - 文字列内の生の改行・タブはエスケープする
+    - 閉じ括弧直前の末尾カンマを取り除く
+    - Python のリテラル（True / False / None）を JSON に直す
+    - 途中で切れた出力は、開いている文字列と括弧を閉じる
+    """
+    out = []
+    stack = []
+    in_string = False
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if in_string:
+            if ch == "\\":
+                nxt = text[i + 1] if i + 1 < n else ""
+                if nxt == "u" and all(c in _HEX for c in text[i + 2:i + 6]) and len(text[i + 2:i + 6]) == 4:
+                    out.append(text[i:i + 6])
+                    i += 6
+                    continue
+                if nxt in _VALID_ESCAPES and nxt != "u":
+                    out.append(ch + nxt)
+                    i += 2
+                    continue
+                out.append("\\\\")
+            elif ch == '"':
+                in_string = False
+                out.append(ch)
+            elif ch in _CONTROL_ESCAPES:
+                out.append(_CONTROL_ESCAPES[ch])
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            # 末尾カンマ: 直前の空白以外の文字がカンマなら消す
+            j = len(out) - 1
+            while j >= 0 and out[j].isspace():
+                j -= 1
+            if j >= 0 and out[j] == ",":
+                del out[j]
+            if stack:
+                stack.pop()
+            out.append(ch)
+        elif ch.isascii() and ch.isalpha():
+            m = re.match(r"[A-Za-z]+", text[i:])
+            word = m.group(0)
+            out.append(_PY_LITERALS.get(word, word))
+            i += len(word)
+            continue
+        else:
+            out.append(ch)
+        i += 1
+
+    if in_string:
+        out.append('"')
+    while out and (out[-1].isspace() or out[-1] in ",:"):
+        out.pop()
+    out.extend(reversed(stack))
+    return "".join(out)
+
+
+def loads_lenient(text: str, count: bool = True) -> Any:
+    """
+    LLM の JSON 出力を読む。まずそのまま、次にコードフェンスと前後の文章を除いて、
+    それでも駄目なら _repair() で直してから読む。どうしても読めなければ JsonOutputError。
+    count=False なら集計しない（キャッシュ可否の判定など、同じ出力を後でもう一度読む場合）
+    """
+    def done(field: str):
+        if count:
+            _count(field)
+
+    if text is None:
+        raise JsonOutputError("empty output")
+    try:
+        value = json.loads(text)
+        done("clean")
+        return value
+    except ValueError:
+        pass
+
+    candidate = _outer_object(_strip_fences(text.strip()))
+    try:
+        value = json.loads(candidate)
+        done("clean")
+        return value
+    except ValueError:
+        pass
+
+    try:
+        value = json.loads(_repair(candidate), strict=False)
+    except ValueError as e:
+        done("failed")
+        raise JsonOutputError(f"unrecoverable JSON output: {e}", raw_text=text) from e
+    done("repaired")
+    return value
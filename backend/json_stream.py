@@ -0,0 +1,167 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_SIMPLE_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+
+
+class JsonFieldStreamer:
+    """
+    生成途中の JSON オブジェクトから、トップレベルの文字列フィールドを逐次取り出すパーサ。
+    チャンクの途中でエスケープ（\\n や \\uXXXX）が分断されていても正しく復元する。
+
+        streamer = JsonFieldStreamer(["comment", "revised_reply_body"])
+        for chunk in stream:
+            for field, text in streamer.feed(chunk):
+                ...  # text は field の値の増分
+        streamer.values  # 完了したフィールドの値
+    """
+
+    def __init__(self, fields: Optional[Iterable[str]] = None):
+        self.fields = set(fields) if fields is not None else None
+        self.values: Dict[str, str] = {}
+        self._state = "start"
+        self._key: List[str] = []
+        self._field: Optional[str] = None
+        self._escape: Optional[str] = None  # None / "" (直前が \\) / "uXXXX" の途中
+        self._high_surrogate: Optional[int] = None
+        self._depth = 0
+        self._other_in_string = False
+        self._other_escape = False
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def _wanted(self, field: str) -> bool:
+        return self.fields is None or field in self.fields
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        out: List[Tuple[str, str]] = []
+
+        def emit(text: str):
+            field = self._field
+            if not self._wanted(field):
+                return
+            self.values[field] = self.values.get(field, "") + text
+            if out and out[-1][0] == field:
+                out[-1] = (field, out[-1][1] + text)
+            else:
+                out.append((field, text))
+
+        for ch in chunk:
+            st = self._state
+            if st == "start":
+                if ch == "{":
+                    self._state = "key_or_end"
+            elif st == "key_or_end":
+                if ch == '"':
+                    self._state = "key"
+                    self._key = []
+                elif ch == "}":
+                    self._state = "done"
+            elif st == "key":
+                if self._escape is not None:
+                    self._key.append(ch)
+                    self._escape = None
+                elif ch == "\\":
+                    self._escape = ""
+                elif ch == '"':
+                    self._state = "colon"
+                else:
+                    self._key.append(ch)
+            elif st == "colon":
+                if ch == ":":
+                    self._state = "value"
+            elif st == "value":
+                if ch.isspace():
+                    continue
+                if ch == '"':
+                    self._state = "string"
+                    self._field = "".join(self._key)
+                    if self._wanted(self._field):
+                        self.values.setdefault(self._field, "")
+                else:
+                    self._state = "other"
+                    self._depth = 0
+                    self._other_in_string = False
+                    self._other_escape = False
+                    self._feed_other(ch)
+            elif st == "string":
+                self._feed_string(ch, emit)
+            elif st == "other":
+                self._feed_other(ch)
+            elif st == "after_value":
+                if ch == ",":
+                    self._state = "key_or_end"
+                elif ch == "}":
+                    self._state = "done"
+        return out
+
+    def _feed_string(self, ch: str, emit):
+        if self._escape is None:
+            if ch == "\\":
+                self._escape = ""
+            elif ch == '"':
+                self._state = "after_value"
+            else:
+                self._flush_surrogate(emit)
+                emit(ch)
+            return
+
+        if self._escape == "":
+            if ch == "u":
+                self._escape = "u"
+            else:
+                self._flush_surrogate(emit)
+                emit(_SIMPLE_ESCAPES.get(ch, ch))
+                self._escape = None
+            return
+
+        if ch not in _HEX_DIGITS:
+            # 壊れた \uXXXX はそのままの文字列として出し、この文字は通常どおり扱う（閉じの " かもしれない）
+            self._flush_surrogate(emit)
+            emit("\\" + self._escape)
+            self._escape = None
+            self._feed_string(ch, emit)
+            return
+        self._escape += ch
+        if len(self._escape) < 5:
+            return
+        code = int(self._escape[1:], 16)
+        self._escape = None
+        if 0xD800 <= code <= 0xDBFF:
+            self._flush_surrogate(emit)
+            self._high_surrogate = code
+        elif 0xDC00 <= code <= 0xDFFF and self._high_surrogate is not None:
+            emit(chr(0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)))
+            self._high_surrogate = None
+        else:
+            self._flush_surrogate(emit)
+            emit(chr(code))
+
+    def _flush_surrogate(self, emit):
+        if self._high_surrogate is not None:
+            emit("�")
+            self._high_surrogate = None
+
+    def _feed_other(self, ch: str):
+        """文字列以外の値（null / 数値 / ネストしたオブジェクト・配列）は読み飛ばす"""
+        if self._other_in_string:
+            if self._other_escape:
+                self._other_escape = False
+            elif ch == "\\":
+                self._other_escape = True
+            elif ch == '"':
+                self._other_in_string = False
+            return
+        if ch == '"':
+            self._other_in_string = True
+        elif ch in "{[":
+            self._depth += 1
+        elif ch in "}]":
+            if self._depth == 0:
+                self._state = "done"
+            else:
+                self._depth -= 1
+        elif ch == "," and self._depth == 0:
+            self._state = "key_or_end"
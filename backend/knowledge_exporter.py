@@ -2,6 +2,7 @@ import os
 import json
 from google.cloud import storage
 from schemas import Case
+from knowledge_utils import invalidate_knowledge_cache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -115,6 +116,8 @@ def export_case_to_knowledge(case: Case, closure_note: str):
             content_type="application/json"
         )
         print(f"✅ Exported Timeline: gs://{BUCKET_NAME}/knowledge/timeline/{case.id}.jsonl")
+
+        invalidate_knowledge_cache()
         
         return True
 
@@ -1,9 +1,16 @@
+import asyncio
 import json
 import os
+import re
+import threading
+import time
+import unicodedata
 
 from typing import List, Optional
 from google.cloud import discoveryengine_v1 as discoveryengine
 from google.api_core.client_options import ClientOptions
+from cache_utils import TTLCache
+from resilience import CircuitBreaker, call, call_async, policy
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,63 +19,196 @@ PROJECT_ID = os.getenv("GCP_PROJECT_ID", "tier3-ops-resolver")
 LOCATION = os.getenv("VERTEX_SEARCH_LOCATION", "global")
 APP_ID = os.getenv("VERTEX_SEARCH_APP_ID", "ops-resolver-search_1770099767218")
 
+SERVING_CONFIG = f"projects/{PROJECT_ID}/locations/{LOCATION}/collections/default_collection/engines/{APP_ID}/servingConfigs/default_search"
+NO_KNOWLEDGE_TEXT = "（関連するナレッジは見つかりませんでした）"
+
+KNOWLEDGE_CACHE_TTL_SECONDS = float(os.getenv("KNOWLEDGE_CACHE_TTL_SECONDS", "900"))
+KNOWLEDGE_CACHE_MAX_ENTRIES = int(os.getenv("KNOWLEDGE_CACHE_MAX_ENTRIES", "512"))
+
+# 同じ (query, filters, limit) の検索結果を再利用する。ナレッジ公開時に全消去する
+knowledge_cache = TTLCache("knowledge_search", max_entries=KNOWLEDGE_CACHE_MAX_ENTRIES, ttl_seconds=KNOWLEDGE_CACHE_TTL_SECONDS)
+
+# 検索が続けて失敗・タイムアウトしている間は RAG を飛ばし、参考情報なしで生成を続ける
+SEARCH_BREAKER_FAILURES = int(os.getenv("SEARCH_BREAKER_FAILURES", "5"))
+SEARCH_BREAKER_RESET_SECONDS = float(os.getenv("SEARCH_BREAKER_RESET_SECONDS", "30"))
+search_breaker = CircuitBreaker("search", SEARCH_BREAKER_FAILURES, SEARCH_BREAKER_RESET_SECONDS)
+
+# gRPC チャネルはスレッドセーフなので、プロセス全体で1つのクライアントを共有する
+_client_lock = threading.Lock()
+_search_client: Optional[discoveryengine.SearchServiceClient] = None
+# grpc.aio のチャネルはイベントループに紐づくため、ループごとに保持する
+_async_clients = {}
+_async_client_factory = None
+
+def _client_options() -> Optional[ClientOptions]:
+    if LOCATION == "global":
+        return None
+    return ClientOptions(api_endpoint=f"{LOCATION}-discoveryengine.googleapis.com")
+
+def get_search_client() -> discoveryengine.SearchServiceClient:
+    """共有の SearchServiceClient を返す（初回のみ生成）"""
+    global _search_client
+    if _search_client is None:
+        with _client_lock:
+            if _search_client is None:
+                _search_client = discoveryengine.SearchServiceClient(client_options=_client_options())
+    return _search_client
+
+def get_async_search_client() -> discoveryengine.SearchServiceAsyncClient:
+    """現在のイベントループ用の SearchServiceAsyncClient を返す"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        with _client_lock:
+            for stale in [l for l in _async_clients if l.is_closed()]:
+                del _async_clients[stale]
+            client = _async_clients.get(loop)
+            if client is None:
+                if _async_client_factory:
+                    client = _async_client_factory()
+                else:
+                    client = discoveryengine.SearchServiceAsyncClient(client_options=_client_options())
+                _async_clients[loop] = client
+    return client
+
+def set_search_clients(client=None, async_client_factory=None):
+    """クライアントを差し替える（ローカルスタブ・ベンチマーク用）。None で既定に戻す"""
+    global _search_client, _async_client_factory
+    with _client_lock:
+        _search_client = client
+        _async_client_factory = async_client_factory
+        _async_clients.clear()
+
+def build_search_request(query: str, filters: List[str], limit: int) -> discoveryengine.SearchRequest:
+    filter_str = ""
+    if filters:
+        quoted_filters = [f'"{f}"' for f in filters]
+        filter_str = f'knowledge_type: ANY({", ".join(quoted_filters)})'
+
+    print(f"🔍 Searching App: '{query[:50]}...' Filter: {filter_str}")
+
+    return discoveryengine.SearchRequest(
+        serving_config=SERVING_CONFIG,
+        query=query,
+        page_size=limit,
+        filter=filter_str,
+        content_search_spec=discoveryengine.SearchRequest.ContentSearchSpec(
+            snippet_spec=discoveryengine.SearchRequest.ContentSearchSpec.SnippetSpec(
+                return_snippet=True
+            )
+        ),
+    )
+
+def format_search_results(results) -> str:
+    context_text = ""
+    for i, result in enumerate(results):
+        data_obj = result.document.struct_data
+        if not data_obj:
+            data_obj = result.document.derived_struct_data
+
+        try:
+            data_dict = {}
+            for key, value in data_obj.items():
+                data_dict[str(key)] = str(value)
+
+            content_str = json.dumps(data_dict, ensure_ascii=False, indent=2)
+        except:
+            content_str = str(data_obj)
+
+        context_text += f"\n--- [参考資料 {i+1}] ---\n{content_str}\n"
+
+    if not context_text:
+        return NO_KNOWLEDGE_TEXT
+
+    return context_text
+
+_RESULT_HEADER = re.compile(r"\n--- \[参考資料 \d+\] ---\n")
+
+def merge_knowledge_contexts(*contexts: str) -> str:
+    """
+    複数の検索結果テキストを1つにまとめる（同じドキュメントは1回だけ残し、番号を振り直す）。
+    エージェントをまとめて1回で呼ぶときに、同じナレッジを重複して送らないようにする
+    """
+    seen = set()
+    docs = []
+    for context in contexts:
+        if not context or context == NO_KNOWLEDGE_TEXT:
+            continue
+        for block in _RESULT_HEADER.split(context):
+            block = block.strip()
+            if block and block not in seen:
+                seen.add(block)
+                docs.append(block)
+    if not docs:
+        return NO_KNOWLEDGE_TEXT
+    return "".join(f"\n--- [参考資料 {i+1}] ---\n{doc}\n" for i, doc in enumerate(docs))
+
+def _cache_key(query: str, filters: List[str], limit: int) -> tuple:
+    normalized = " ".join(unicodedata.normalize("NFKC", query).lower().split())
+    return (normalized, tuple(sorted(set(filters or []))), limit)
+
+def invalidate_knowledge_cache():
+    """ナレッジが更新されたら呼ぶ（古い検索結果を返さないように）"""
+    knowledge_cache.clear()
+    print("🧹 Knowledge search cache invalidated.")
+
 def search_knowledge_base(query: str, filters: List[str] = [], limit: int = 5) -> str:
     """
     Vertex AI Search (App/Engine) を検索し、結果をテキストとして返す
     """
+    key = _cache_key(query, filters, limit)
+    cached = knowledge_cache.get(key)
+    if cached is not None:
+        print(f"⚡ Knowledge cache hit: '{query[:50]}...'")
+        return cached
+
+    if not search_breaker.allow():
+        print(f"⏭️ Knowledge search skipped (search degraded): '{query[:50]}...'")
+        return ""
+
     try:
-        client_options = (
-            ClientOptions(api_endpoint=f"{LOCATION}-discoveryengine.googleapis.com")
-            if LOCATION != "global" else None
-        )
-        
-        client = discoveryengine.SearchServiceClient(client_options=client_options)
-        
-        serving_config = f"projects/{PROJECT_ID}/locations/{LOCATION}/collections/default_collection/engines/{APP_ID}/servingConfigs/default_search"
-
-        filter_str = ""
-        if filters:
-            quoted_filters = [f'"{f}"' for f in filters]
-            filter_str = f'knowledge_type: ANY({", ".join(quoted_filters)})'
-
-        print(f"🔍 Searching App: '{query[:50]}...' Filter: {filter_str}")
-
-        request = discoveryengine.SearchRequest(
-            serving_config=serving_config,
-            query=query,
-            page_size=limit,
-            filter=filter_str,
-            content_search_spec=discoveryengine.SearchRequest.ContentSearchSpec(
-                snippet_spec=discoveryengine.SearchRequest.ContentSearchSpec.SnippetSpec(
-                    return_snippet=True
-                )
-            ),
+        start = time.perf_counter()
+        request = build_search_request(query, filters, limit)
+        # 再試行は resilience 側で行う（クライアント既定の retry は切り、1回あたりの締め切りだけ渡す）
+        response = call(
+            "search",
+            lambda: get_search_client().search(request, retry=None, timeout=policy("search").timeout or None),
+            inline=True,
         )
-        
-        response = client.search(request)
-        
-        context_text = ""
-        for i, result in enumerate(response.results):
-            data_obj = result.document.struct_data
-            if not data_obj:
-                data_obj = result.document.derived_struct_data
-            
-            try:
-                data_dict = {}
-                for key, value in data_obj.items():
-                    data_dict[str(key)] = str(value) 
-                
-                content_str = json.dumps(data_dict, ensure_ascii=False, indent=2)
-            except:
-                content_str = str(data_obj)
-
-            context_text += f"\n--- [参考資料 {i+1}] ---\n{content_str}\n"
-            
-        if not context_text:
-            return "（関連するナレッジは見つかりませんでした）"
-            
+        search_breaker.record_success()
+        context_text = format_search_results(response.results)
+        knowledge_cache.set(key, context_text, cost_seconds=time.perf_counter() - start)
         return context_text
 
     except Exception as e:
+        search_breaker.record_failure()
         print(f"⚠️ Knowledge Search Error: {e}")
-        return ""
\ No newline at end of file
+        return ""
+
+async def search_knowledge_base_async(query: str, filters: List[str] = [], limit: int = 5) -> str:
+    """
+    search_knowledge_base の asyncio 版。1ワーカーから複数のRAG検索を同時に投げられる
+    """
+    key = _cache_key(query, filters, limit)
+    cached = knowledge_cache.get(key)
+    if cached is not None:
+        print(f"⚡ Knowledge cache hit: '{query[:50]}...'")
+        return cached
+
+    if not search_breaker.allow():
+        print(f"⏭️ Knowledge search skipped (search degraded): '{query[:50]}...'")
+        return ""
+
+    try:
+        start = time.perf_counter()
+        request = build_search_request(query, filters, limit)
+        response = await call_async("search", lambda: get_async_search_client().search(request, retry=None))
+        search_breaker.record_success()
+        context_text = format_search_results(response.results)
+        knowledge_cache.set(key, context_text, cost_seconds=time.perf_counter() - start)
+        return context_text
+
+    except Exception as e:
+        search_breaker.record_failure()
+        print(f"⚠️ Knowledge Search Error (async): {e}")
+        return ""
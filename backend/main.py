@@ -1,8 +1,11 @@
 # backend/main.py
+import asyncio
+import contextvars
+import functools
 import json
 import uuid
 import mimetypes
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 from gmail_utils import send_reply 
@@ -12,19 +15,44 @@ from dotenv import load_dotenv
 from pathlib import Path
 import os
 import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part
 from google.cloud import firestore, storage
+from google.api_core.exceptions import FailedPrecondition
 from pydantic import BaseModel
-from knowledge_utils import search_knowledge_base 
+from knowledge_utils import search_knowledge_base, search_knowledge_base_async, knowledge_cache, merge_knowledge_contexts
 from knowledge_exporter import export_case_to_knowledge
-from gmail_utils import fetch_history_changes, process_single_message
+from context_builder import PromptContext, context_stats
+from generation_cache import create_generation_cache
+from agent_registry import AgentRegistry
+from json_stream import JsonFieldStreamer
+from attachment_store import attachment_mime_type, lookup_attachments, mark_attachments_analyzed
+from case_store import new_timeline_event, append_timeline_events, save_case
+from case_store import load_case, update_case
+from case_store import lookup_case_id_by_thread, index_case_thread, forget_thread, thread_index_cache
+from case_store import load_timeline_since
+from case_store import load_case_async, save_case_async, update_case_async, load_active_board_async
+from case_store import load_full_timeline_async, list_timeline_page_async, load_timeline_since_async
+from gmail_utils import fetch_history_changes, process_single_message, process_messages_batch
+from gmail_utils import mark_message_processed, mark_messages_processed
+from gmail_utils import extract_added_message_ids, list_unread_message_ids, get_current_history_id
+from ingest_queue import create_ingest_queue, IngestWorkerPool
+from json_repair import loads_lenient, JsonOutputError, json_repair_stats, record_regeneration
+from resilience import resilience_stats
+from quota_governor import QuotaGovernor, quota_lane
 
 from schemas import Case, CreateTriageRequest, AiProposal, EmailDraft, ApproveRequest
-from schemas import ReplyIngestRequest, CloseRequest
+from schemas import ReplyIngestRequest, CloseRequest, TriageResult, TimelineEvent, CombinedTriageOutput
+from schemas import CaseStatus, CaseSummary, CaseListPage, TimelinePage
+from schemas import ClosureDraft, EscalationDecision, response_schema
 
 load_dotenv
 
@@ -39,6 +67,38 @@ CURRENT_ACCOUNT = os.getenv("TARGET_EMAIL_ACCOUNT", "0sasurai0@gmail.com")
 vertexai.init(project=PROJECT_ID, location=LOCATION)
 db = firestore.Client(project=PROJECT_ID)
 
+# API リクエスト経路は AsyncClient を使う（インジェストワーカー等のスレッドは同期の db）。
+# grpc.aio のチャネルはイベントループに紐づくため、ループごとに1つ保持する
+_async_dbs = {}
+_async_db_lock = threading.Lock()
+
+def get_adb() -> firestore.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _async_dbs.get(loop)
+    if client is None:
+        with _async_db_lock:
+            for stale in [l for l in _async_dbs if l.is_closed()]:
+                del _async_dbs[stale]
+            client = _async_dbs.get(loop)
+            if client is None:
+                client = firestore.AsyncClient(project=PROJECT_ID)
+                _async_dbs[loop] = client
+    return client
+
+# Gmail API (googleapiclient) には非同期版がないため、専用の上限付きスレッドプールに閉じ込める。
+# 送信が詰まってもイベントループや Starlette のスレッドプールを巻き込まない
+GMAIL_MAX_WORKERS = int(os.getenv("GMAIL_MAX_WORKERS", "4"))
+gmail_executor = ThreadPoolExecutor(max_workers=GMAIL_MAX_WORKERS, thread_name_prefix="gmail")
+
+async def run_gmail(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(gmail_executor, functools.partial(fn, *args, **kwargs))
+
+generation_cache = create_generation_cache(db)
+# Gemini のクォータは全エージェントで共有する。チャット > 新規トリアージ > 再解析・KB化 の順に枠を配る
+quota_governor = QuotaGovernor()
+# エージェントごとの GenerativeModel はプロセス内で使い回す（各 *_INSTRUCTION の定義直後に登録）
+agent_registry = AgentRegistry(MODEL_ID, governor=quota_governor)
+
 app = FastAPI(title="OpsResolver API")
 
 app.add_middleware(
@@ -60,47 +120,162 @@ def now_utc_iso() -> str:
 def now_jst_iso() -> str:
     return datetime.now(JST).isoformat()
 
-def clean_json_text(text: str) -> str:
-    text = text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    elif text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
-
-    start_idx = text.find("{")
-    end_idx = text.rfind("}")
-    
-    if start_idx != -1 and end_idx != -1:
-        text = text[start_idx : end_idx + 1]
+JSON_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+# pydantic モデルから作ったスキーマで出力を制約する（false で MIME 指定のみ。スキーマ非対応のモデル向け）
+RESPONSE_SCHEMA_ENABLED = os.getenv("RESPONSE_SCHEMA_ENABLED", "true").lower() != "false"
+# 修復しても読めない出力のときに作り直す回数
+JSON_REGENERATE_ATTEMPTS = int(os.getenv("JSON_REGENERATE_ATTEMPTS", "1"))
+
+def json_generation_config(model=None, exclude=()) -> dict:
+    """model を渡すと response_schema 付きの設定を返す（exclude はスキーマから外すフィールド）"""
+    if model is None or not RESPONSE_SCHEMA_ENABLED:
+        return JSON_GENERATION_CONFIG
+    return {**JSON_GENERATION_CONFIG, "response_schema": response_schema(model, exclude)}
+# プロンプトに埋め込む現在時刻の粒度（分）。秒単位だと同じ依頼の再実行が生成キャッシュに当たらない
+PROMPT_CLOCK_MINUTES = max(1, int(os.getenv("PROMPT_CLOCK_MINUTES", "10")))
+
+def prompt_clock(now: datetime) -> datetime:
+    return now.replace(minute=now.minute - now.minute % PROMPT_CLOCK_MINUTES, second=0, microsecond=0)
+
+def _is_json_text(text: str) -> bool:
+    try:
+        loads_lenient(text, count=False)
+        return True
+    except JsonOutputError:
+        return False
+
+def _cache_accept(generation_config: Optional[dict], accept):
+    if accept is not None:
+        return accept
+    is_json = (generation_config or {}).get("response_mime_type") == "application/json"
+    return _is_json_text if is_json else None
+
+def cached_generate(agent: str, contents, generation_config: Optional[dict] = None, regenerate: bool = False, accept=None) -> str:
+    """
+    エージェントの generate_content のテキストを生成キャッシュ経由で取得する（regenerate=True でキャッシュを無視）。
+    accept を渡すと、それが True を返す結果だけをキャッシュする（省略時は JSON としてパースできるか）
+    """
+    def call() -> str:
+        return agent_registry.generate(agent, contents, generation_config)
+
+    return generation_cache.get_or_generate(
+        agent, MODEL_ID, agent_registry.instruction(agent), contents, call,
+        generation_config=generation_config,
+        bypass=regenerate,
+        accept=_cache_accept(generation_config, accept),
+    )
+
+async def cached_generate_async(agent: str, contents, generation_config: Optional[dict] = None, regenerate: bool = False, accept=None) -> str:
+    """cached_generate の asyncio 版（generate_content_async を使う）"""
+    async def call() -> str:
+        return await agent_registry.generate_async(agent, contents, generation_config)
+
+    return await generation_cache.get_or_generate_async(
+        agent, MODEL_ID, agent_registry.instruction(agent), contents, call,
+        generation_config=generation_config,
+        bypass=regenerate,
+        accept=_cache_accept(generation_config, accept),
+    )
 
-    return text
+def cached_generate_stream_async(agent: str, contents, generation_config: Optional[dict] = None, regenerate: bool = False):
+    """cached_generate_stream の asyncio 版（非同期イテレータを返す）"""
+    return generation_cache.stream_async(
+        agent, MODEL_ID, agent_registry.instruction(agent), contents,
+        lambda: agent_registry.stream_async(agent, contents, generation_config),
+        generation_config=generation_config,
+        bypass=regenerate,
+        accept=_cache_accept(generation_config, None),
+    )
+
+def _try_parse(parse, text: str):
+    try:
+        return parse(text)
+    except Exception as e:
+        return e
 
-def get_multimodal_content(text_prompt: str, gcs_uris: List[str]) -> List[Union[str, Part]]:
-    """テキストとGCS上のファイルをGemini入力用Partに変換する"""
+_RETRY = object()
+
+def _json_attempts(agent: str, parse, attempts: Optional[int]):
+    """
+    generate_json の各試行で使う (accept, result) を順に返す。
+    accept はキャッシュ可否の判定ついでにパース結果を覚えておき、result で同じ出力を二度読まない
+    """
+    attempts = JSON_REGENERATE_ATTEMPTS if attempts is None else attempts
+    for attempt in range(attempts + 1):
+        parsed = {}
+
+        def accept(text: str) -> bool:
+            if text not in parsed:
+                parsed[text] = _try_parse(parse, text)
+            return not isinstance(parsed[text], Exception)
+
+        def result(raw_text: str):
+            value = parsed[raw_text] if raw_text in parsed else _try_parse(parse, raw_text)
+            if not isinstance(value, Exception):
+                return value
+            if attempt >= attempts:
+                if isinstance(value, JsonOutputError):
+                    raise value
+                raise JsonOutputError(f"invalid {agent} output: {value}", raw_text=raw_text) from value
+            record_regeneration()
+            print(f"🔁 [{agent}] Unrecoverable output, regenerating ({attempt + 1}/{attempts}): {value}")
+            return _RETRY
+
+        yield attempt, accept, result
+
+def generate_json(agent: str, contents, generation_config: dict, regenerate: bool = False, parse=loads_lenient, attempts: Optional[int] = None):
+    """
+    JSON を返すエージェントを呼び、parse(生テキスト) の結果を返す。
+    軽微な崩れは loads_lenient がその場で直すので、parse が失敗する（修復不能・スキーマ不一致の）ときだけ
+    キャッシュを無視して生成し直す。parse に通った出力だけをキャッシュする。最後まで駄目なら JsonOutputError
+    """
+    for attempt, accept, result in _json_attempts(agent, parse, attempts):
+        raw_text = cached_generate(agent, contents, generation_config, regenerate or attempt > 0, accept=accept)
+        value = result(raw_text)
+        if value is not _RETRY:
+            return value
+
+async def generate_json_async(agent: str, contents, generation_config: dict, regenerate: bool = False, parse=loads_lenient, attempts: Optional[int] = None):
+    """generate_json の asyncio 版"""
+    for attempt, accept, result in _json_attempts(agent, parse, attempts):
+        raw_text = await cached_generate_async(agent, contents, generation_config, regenerate or attempt > 0, accept=accept)
+        value = result(raw_text)
+        if value is not _RETRY:
+            return value
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data), ensure_ascii=False)}\n\n"
+
+def sse_response(events) -> StreamingResponse:
+    # プロキシ（Cloud Run / nginx）でバッファリングされないようにする
+    return StreamingResponse(events, media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# true にすると、このケースで一度解析した添付を以降の解析では送らずファイル名だけを伝える（トークン節約）。
+# 再解析でモデルがログやスクリーンショットを見られなくなるので既定は off。regenerate 時は常に全て送る
+SKIP_ANALYZED_ATTACHMENTS = os.getenv("SKIP_ANALYZED_ATTACHMENTS", "false").lower() == "true"
+
+def get_multimodal_content(text_prompt: str, gcs_uris: List[str], case_id: Optional[str] = None, regenerate: bool = False) -> List[Union[str, Part]]:
+    """テキストとGCS上のファイルをGemini入力用Partに変換する（SKIP_ANALYZED_ATTACHMENTS なら解析済みの添付は再送しない）"""
     parts = [text_prompt]
+
+    entries = {}
+    if gcs_uris:
+        try:
+            entries = lookup_attachments(gcs_uris)
+        except Exception as e:
+            print(f"⚠️ Attachment index lookup failed: {e}")
+    analyzed = {}
+    if SKIP_ANALYZED_ATTACHMENTS and case_id and not regenerate:
+        analyzed = {uri: entry for uri, entry in entries.items() if case_id in entry.get("analyzed_case_ids", [])}
+    if analyzed:
+        names = [", ".join(entry.get("filenames", [])) or uri for uri, entry in analyzed.items()]
+        print(f"♻️ Skipping already-analyzed attachments: {names}")
+        parts[0] = text_prompt + "\n\n【再送付された添付（このケースで解析済みのため省略）】\n" + "\n".join(f"- {n}" for n in names)
     
     for uri in gcs_uris:
-        ext = uri.split('.')[-1].lower()
-        mime_type = None
-
-        if ext in ['png']:
-            mime_type = "image/png"
-        elif ext in ['jpg', 'jpeg']:
-            mime_type = "image/jpeg"
-        elif ext in ['webp']:
-            mime_type = "image/webp"
-        elif ext in ['heic', 'heif']:
-            mime_type = "image/heif"
-            
-        elif ext in ['mp4', 'mov', 'mpeg', 'mpg', 'avi']:
-            mime_type = "video/mp4"
-            
-        elif ext in ['pdf']:
-            mime_type = "application/pdf"
-        elif ext in ['txt', 'log', 'csv', 'json', 'py', 'js', 'html', 'xml']:
-            mime_type = "text/plain"
+        if uri in analyzed:
+            continue
+        mime_type = attachment_mime_type(uri, entries.get(uri))
 
         if mime_type:
             print(f"📎 Attaching to Gemini: {uri} as {mime_type}")
@@ -109,7 +284,7 @@ def get_multimodal_content(text_prompt: str, gcs_uris: List[str]) -> List[Union[
             except Exception as e:
                 print(f"⚠️ Failed to attach part {uri}: {e}")
         else:
-            print(f"⏩ Skipped unsupported file type: {uri} (ext: {ext})")
+            print(f"⏩ Skipped unsupported file type: {uri}")
         
     return parts
 
@@ -183,11 +358,6 @@ Severity/優先度に応じて `next_contact_due_proposal` を計算して出力
 - `next_contact_due_proposal` は Current Time より過去にしてはいけない
 - 迷った場合は「Current Time + 4 hours」を採用すること
 
-# Windowsパスの扱い（重要）
-ログにWindowsパス（例: C:\\Windows\\Logs...）が含まれる場合、JSON文字列に出力する際はバックスラッシュを必ず二重にエスケープすること。
-- NG: "C:\\Windows\\System32"
-- OK: "C:\\\\Windows\\\\System32"
-
 # 出力形式（AiProposalに準拠したJSONのみ）
 {
   "summary": "事象の概要（1-2行）",
@@ -206,21 +376,28 @@ Severity/優先度に応じて `next_contact_due_proposal` を計算して出力
   "next_contact_due_proposal": "2026-02-13T14:00:00+09:00"
 }
 """
+agent_registry.register("analyze", ANALYZER_INSTRUCTION)
 
-def analyze_incident(title: str, description: str, logs: str, file_urls: List[str], history: str = "") -> AiProposal:
-    model = GenerativeModel(model_name=MODEL_ID, system_instruction=ANALYZER_INSTRUCTION)
-    
-    search_query = title[:100]    
-    knowledge_context = search_knowledge_base(
-        query=search_query,
-        filters=["fix_case_card", "timeline_event"]
-    )
+ANALYZER_RAG_FILTERS = ["fix_case_card", "timeline_event"]
+# 解析では生成させない AiProposal のフィールド（返信・クローズ系は別エージェントが埋める）
+ANALYZER_EXCLUDED_FIELDS = [
+    "reply_draft", "internal_note_draft", "validation_checklist", "closure_draft",
+    "closure_note", "routing_suggestion", "escalation_suggestion",
+]
+ANALYZER_GENERATION_CONFIG = json_generation_config(AiProposal, exclude=ANALYZER_EXCLUDED_FIELDS)
+
+def _analyze_prompt(title: str, description: str, logs: str, history: str, knowledge_context: str, now_jst: datetime) -> str:
     print(f"📚 [RAG Result]:\n{knowledge_context[:500]}...\n(Total length: {len(knowledge_context)})")
 
-    now_jst = datetime.now(JST)
-    current_time_iso = now_jst.isoformat()
+    current_time_iso = prompt_clock(now_jst).isoformat()
 
-    base_prompt = f"""
+    ctx = PromptContext("analyze")
+    history = ctx.text("history", history, keep="tail")
+    logs = ctx.text("logs", logs, keep="head_tail")
+    knowledge_context = ctx.text("knowledge", knowledge_context)
+    ctx.log()
+
+    return f"""
     【前提情報】
     Current Time: {current_time_iso}
 
@@ -243,32 +420,63 @@ def analyze_incident(title: str, description: str, logs: str, file_urls: List[st
     {knowledge_context}
     """
 
-    prompt_parts = get_multimodal_content(base_prompt, file_urls)
+def _parse_proposal(raw_text: str, now_jst: datetime) -> AiProposal:
+    data = loads_lenient(raw_text)
+    data["next_contact_due_proposal"] = normalize_next_due(
+        data.get("next_contact_due_proposal"),
+        now_jst=now_jst,
+        fallback_hours=4,
+    )
+    return AiProposal(**data)
+
+def _failed_proposal(e: Exception, raw_text: str) -> AiProposal:
+    print(f"❌ Analyzer Error: {e}")
+    print(f"💀 Raw Response (First 500 chars): {raw_text[:500]}")
+
+    return AiProposal(
+        summary=f"Analysis failed: {e}",
+        hypotheses=[], missing_info=[], evidence_pack=[], next_action_plan=[],
+        confidence_score=0.0, next_contact_due_proposal=now_utc_iso()
+    )
+
+def analyze_incident(title: str, description: str, logs: str, file_urls: List[str], history: str = "", case_id: Optional[str] = None, regenerate: bool = False) -> AiProposal:
+    
+    knowledge_context = search_knowledge_base(query=title[:100], filters=ANALYZER_RAG_FILTERS)
+    now_jst = datetime.now(JST)
+    base_prompt = _analyze_prompt(title, description, logs, history, knowledge_context, now_jst)
+    prompt_parts = get_multimodal_content(base_prompt, file_urls, case_id=case_id, regenerate=regenerate)
     
     try:
-        response = model.generate_content(
-            prompt_parts, 
-            generation_config={"response_mime_type": "application/json"}
+        proposal = generate_json(
+            "analyze", prompt_parts, ANALYZER_GENERATION_CONFIG, regenerate,
+            parse=lambda raw_text: _parse_proposal(raw_text, now_jst),
         )
-        json_text = clean_json_text(response.text)
-        data = json.loads(json_text)
-        data["next_contact_due_proposal"] = normalize_next_due(
-            data.get("next_contact_due_proposal"),
-            now_jst=now_jst,
-            fallback_hours=4,
-        )
-
-        return AiProposal(**data)
+        if case_id and file_urls:
+            mark_attachments_analyzed(file_urls, case_id)
+        return proposal
 
     except Exception as e:
-        print(f"❌ Analyzer Error: {e}")
-        print(f"💀 Raw Response (First 500 chars): {response.text[:500]}")
+        return _failed_proposal(e, getattr(e, "raw_text", ""))
+
+async def analyze_incident_async(title: str, description: str, logs: str, file_urls: List[str], history: str = "", case_id: Optional[str] = None, regenerate: bool = False) -> AiProposal:
+    """analyze_incident の asyncio 版（API リクエスト用）"""
+    knowledge_context = await search_knowledge_base_async(query=title[:100], filters=ANALYZER_RAG_FILTERS)
+    now_jst = datetime.now(JST)
+    base_prompt = _analyze_prompt(title, description, logs, history, knowledge_context, now_jst)
+    # 解析済み添付の索引は同期クライアントなのでスレッドで引く
+    prompt_parts = await asyncio.to_thread(get_multimodal_content, base_prompt, file_urls, case_id, regenerate)
 
-        return AiProposal(
-            summary=f"Analysis failed: {e}",
-            hypotheses=[], missing_info=[], evidence_pack=[], next_action_plan=[],
-            confidence_score=0.0, next_contact_due_proposal=now_utc_iso()
+    try:
+        proposal = await generate_json_async(
+            "analyze", prompt_parts, ANALYZER_GENERATION_CONFIG, regenerate,
+            parse=lambda raw_text: _parse_proposal(raw_text, now_jst),
         )
+        if case_id and file_urls:
+            await asyncio.to_thread(mark_attachments_analyzed, file_urls, case_id)
+        return proposal
+
+    except Exception as e:
+        return _failed_proposal(e, getattr(e, "raw_text", ""))
 
 # ==========================================
 #  2. Drafter Agent (代筆担当)
@@ -302,19 +510,24 @@ DRAFTER_INSTRUCTION = """
 - 解析結果（原因や解決策）をわかりやすく伝えること。
 - 解決策がある場合は、承認を求めること。
 """
+agent_registry.register("draft", DRAFTER_INSTRUCTION)
 
-def draft_reply(proposal: AiProposal, sender_email: Optional[str], history: str = "") -> EmailDraft:
-    model = GenerativeModel(model_name=MODEL_ID, system_instruction=DRAFTER_INSTRUCTION)
-    
-    search_query = proposal.summary[:100]    
-    knowledge_context = search_knowledge_base(
-        query=search_query,
-        filters=["reply_draft", "policy_guard_card"]
-    )
+DRAFTER_RAG_FILTERS = ["reply_draft", "policy_guard_card"]
+DRAFTER_GENERATION_CONFIG = json_generation_config(EmailDraft)
+
+def _parse_draft(raw_text: str) -> EmailDraft:
+    return EmailDraft(**loads_lenient(raw_text))
+
+def _draft_prompt(proposal: AiProposal, sender_email: Optional[str], history: str, knowledge_context: str) -> str:
     print(f"📚 [RAG Result for Drafter]:\n{knowledge_context[:500]}...\n")
 
+    ctx = PromptContext("draft")
+    history = ctx.text("history", history, keep="tail")
+    knowledge_context = ctx.text("knowledge", knowledge_context)
+    ctx.log()
+
     context = proposal.model_dump_json()
-    prompt = f"""
+    return f"""
     【解析結果 JSON】
     {context}
     
@@ -334,22 +547,36 @@ def draft_reply(proposal: AiProposal, sender_email: Optional[str], history: str
     
     {knowledge_context}
     """
+
+def _failed_draft(e: Exception, sender_email: Optional[str]) -> EmailDraft:
+    print(f"❌ Drafter Error: {e}")
+    return EmailDraft(
+        to=sender_email or "", 
+        subject="Draft Error", 
+        body="ドラフト生成に失敗しました。手動で作成してください。"
+    )
+
+def draft_reply(proposal: AiProposal, sender_email: Optional[str], history: str = "", knowledge_context: Optional[str] = None, regenerate: bool = False) -> EmailDraft:
+    
+    if knowledge_context is None:
+        knowledge_context = search_knowledge_base(query=proposal.summary[:100], filters=DRAFTER_RAG_FILTERS)
+    prompt = _draft_prompt(proposal, sender_email, history, knowledge_context)
     try:
-        response = model.generate_content(
-            prompt,
-            generation_config={"response_mime_type": "application/json"}
-        )
-        json_text = clean_json_text(response.text)
-        data = json.loads(json_text)
-        return EmailDraft(**data)
+        return generate_json("draft", prompt, DRAFTER_GENERATION_CONFIG, regenerate, parse=_parse_draft)
 
     except Exception as e:
-        print(f"❌ Drafter Error: {e}")
-        return EmailDraft(
-            to=sender_email or "", 
-            subject="Draft Error", 
-            body="ドラフト生成に失敗しました。手動で作成してください。"
-        )
+        return _failed_draft(e, sender_email)
+
+async def draft_reply_async(proposal: AiProposal, sender_email: Optional[str], history: str = "", knowledge_context: Optional[str] = None, regenerate: bool = False) -> EmailDraft:
+    """draft_reply の asyncio 版（API リクエスト用）"""
+    if knowledge_context is None:
+        knowledge_context = await search_knowledge_base_async(query=proposal.summary[:100], filters=DRAFTER_RAG_FILTERS)
+    prompt = _draft_prompt(proposal, sender_email, history, knowledge_context)
+    try:
+        return await generate_json_async("draft", prompt, DRAFTER_GENERATION_CONFIG, regenerate, parse=_parse_draft)
+
+    except Exception as e:
+        return _failed_draft(e, sender_email)
 
 # ==========================================
 #  3. Editor Agent (編集担当)
@@ -380,16 +607,18 @@ EDITOR_INSTRUCTION = """
   "comment": "エンジニアへの回答、または処理内容の要約"
 }
 """
+agent_registry.register("chat", EDITOR_INSTRUCTION)
 
-@app.post("/cases/{case_id}/chat")
-def chat_with_case(case_id: str, req: ChatRequest):
-    doc_ref = db.collection("cases").document(case_id)
-    doc = doc_ref.get()
-    if not doc.exists:
+# ストリーミング時に逐次表示するフィールド
+EDITOR_STREAM_FIELDS = ["comment", "revised_reply_body", "revised_closure_note"]
+
+async def _prepare_case_chat(case_id: str, req: ChatRequest):
+    """(case, tracker, prompt) を返す"""
+    adb = get_adb()
+    case, tracker = await load_case_async(adb, case_id)
+    if case is None:
         raise HTTPException(status_code=404, detail="Case not found")
     
-    case = Case(**doc.to_dict())
-    
     if not case.latest_proposal:
         raise HTTPException(status_code=400, detail="No proposal to edit")
 
@@ -400,18 +629,11 @@ def chat_with_case(case_id: str, req: ChatRequest):
     current_closure = "（未記入）"    
     if case.latest_proposal.closure_note:
         current_closure = case.latest_proposal.closure_note
-      
-    history_lines = []
-    for event in case.timeline:
-        d = event.dict() if hasattr(event, "dict") else event        
-        ts = d.get("timestamp", "")
-        actor = d.get("actor", "UNKNOWN")
-        evt_type = d.get("type", "EVENT")
-        msg = d.get("message", "")        
-        line = f"[{ts}] {actor} ({evt_type}): {msg}"
-        history_lines.append(line)
-    
-    history_text = "\n".join(history_lines) if history_lines else "（履歴なし）"    
+
+    ctx = PromptContext("chat")
+    history_text = ctx.case_history("history", *await load_case_history_async(adb, case)) or "（履歴なし）"
+    current_draft = ctx.text("draft", current_draft, keep="head_tail")
+    ctx.log()
 
     prompt = f"""
     
@@ -437,43 +659,79 @@ def chat_with_case(case_id: str, req: ChatRequest):
     - クローズメモ/要約指示なら revised_closure_note を出力。
     - 質問なら comment のみで回答。
     """
+    return case, tracker, prompt
+
+async def _apply_case_chat_result(case: Case, tracker, data: dict) -> dict:
+    """Editor の出力をケースに反映して保存し、API レスポンスを返す"""
+    reply_msg = data.get("comment", "処理完了しました。")
     
-    model = GenerativeModel(model_name=MODEL_ID, system_instruction=EDITOR_INSTRUCTION)
+    updated = False
+
+    new_body = data.get("revised_reply_body")
+    if new_body and new_body.strip() and new_body != "null":
+        if case.latest_proposal and case.latest_proposal.reply_draft:
+            case.latest_proposal.reply_draft.body = new_body
+            updated = True
+            reply_msg = f"メールドラフトを修正しました。\n({data.get('comment', '')})"
+
+    new_note = data.get("revised_closure_note")
+    if new_note and new_note.strip() and new_note != "null":
+        if case.latest_proposal:
+            case.latest_proposal.closure_note = new_note
+            updated = True
+            reply_msg = f"クローズメモを更新しました。\n({data.get('comment', '')})"
+
+    if updated:
+        case.updated_at = now_utc_iso()
+        # 編集中に再解析などでドラフトが差し替わっていたら、古いドラフト基準の修正で上書きしない
+        await update_case_async(get_adb(), case, tracker, check_update_time=True)
+
+    return {
+        "status": "success", 
+        "reply": data.get("comment", "修正しました。"),
+        "updated_case": case
+    }
+
+@app.post("/cases/{case_id}/chat")
+async def chat_with_case(case_id: str, req: ChatRequest):
+    case, tracker, prompt = await _prepare_case_chat(case_id, req)
     try:
-        response = model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
-        data = json.loads(clean_json_text(response.text))
-        reply_msg = data.get("comment", "処理完了しました。")
-        
-        updated = False
-
-        new_body = data.get("revised_reply_body")
-        if new_body and new_body.strip() and new_body != "null":
-            if case.latest_proposal and case.latest_proposal.reply_draft:
-                case.latest_proposal.reply_draft.body = new_body
-                updated = True
-                reply_msg = f"メールドラフトを修正しました。\n({data.get('comment', '')})"
-
-        new_note = data.get("revised_closure_note")
-        if new_note and new_note.strip() and new_note != "null":
-            if case.latest_proposal:
-                case.latest_proposal.closure_note = new_note
-                updated = True
-                reply_msg = f"クローズメモを更新しました。\n({data.get('comment', '')})"
-
-        if updated:
-            case.updated_at = now_utc_iso()
-            doc_ref.set(case.model_dump())
-
-        return {
-            "status": "success", 
-            "reply": data.get("comment", "修正しました。"),
-            "updated_case": case
-        }
-        
+        raw_text = await cached_generate_async("chat", prompt, JSON_GENERATION_CONFIG, req.regenerate)
+        return await _apply_case_chat_result(case, tracker, loads_lenient(raw_text))
+    except FailedPrecondition:
+        raise HTTPException(status_code=409, detail="Case was updated while editing. Please retry.")
     except Exception as e:
         print(f"Chat Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/cases/{case_id}/chat/stream")
+async def chat_with_case_stream(case_id: str, req: ChatRequest):
+    """
+    /cases/{case_id}/chat の SSE 版。
+    event: delta  {"field": "comment" | "revised_reply_body" | "revised_closure_note", "text": 増分}
+    event: done   /chat と同じレスポンス（生成完了後に保存してから送る）
+    event: error  {"status": HTTP ステータス, "detail": 内容}
+    """
+    case, tracker, prompt = await _prepare_case_chat(case_id, req)
+
+    async def events():
+        streamer = JsonFieldStreamer(EDITOR_STREAM_FIELDS)
+        chunks = []
+        try:
+            async for chunk in cached_generate_stream_async("chat", prompt, JSON_GENERATION_CONFIG, req.regenerate):
+                chunks.append(chunk)
+                for field, text in streamer.feed(chunk):
+                    yield sse_event("delta", {"field": field, "text": text})
+            data = loads_lenient("".join(chunks))
+            yield sse_event("done", await _apply_case_chat_result(case, tracker, data))
+        except FailedPrecondition:
+            yield sse_event("error", {"status": 409, "detail": "Case was updated while editing. Please retry."})
+        except Exception as e:
+            print(f"Chat Stream Error: {e}")
+            yield sse_event("error", {"status": 500, "detail": str(e)})
+
+    return sse_response(events())
+
 # ==========================================
 #  4. PM Agent (編集担当)
 # ==========================================
@@ -495,12 +753,11 @@ PM_INSTRUCTION = """
 - `status` が `WAITING_INTERNAL` や `PROPOSED` のまま放置されている案件をボトルネックとして扱う。
 - 特定の案件についての質問には、IDとタイトルを照合して回答する。
 """
+agent_registry.register("global_chat", PM_INSTRUCTION)
 
-@app.post("/global/chat")
-def global_chat(req: ChatRequest):
-    docs = db.collection("cases").where("status", "!=", "CLOSED").stream()
-    
-    active_cases = []
+async def _prepare_global_chat(req: ChatRequest) -> str:
+    adb = get_adb()
+    active_cases = await load_active_board_async(adb)
     focused_case_details = ""
     target_case_id = None
 
@@ -514,51 +771,36 @@ def global_chat(req: ChatRequest):
     else:
         print("👀 No specific Case ID detected in query.")
 
-    for doc in docs:
-        d = doc.to_dict()
-        doc_id = d.get("id")
-
-        if target_case_id and doc_id == target_case_id:
-            print(f"✅ Found detail data for: {target_case_id}")
-            history_text = ""
-            timeline = d.get("timeline", [])
-            for event in timeline:
-                ts = event.get("timestamp", "")
-                actor = event.get("actor", "UNKNOWN")
-                msg = event.get("message", "")
-                evt_type = event.get("type", "")
-                history_text += f"[{ts}] {actor} ({evt_type}): {msg}\n"
-            if not history_text:
-                history_text = "(Timeline is empty)"
-            
-            focused_case_details = f"""
-            === ユーザーが指定したケースの詳細 (ID: {target_case_id}) ===
-            Target ID: {target_case_id}
-            Title: {d.get("title")}
-            Description: {d.get("description")}
-            Status: {d.get("status")}
-            Priority: {d.get("priority")}
-            Next Due: {d.get("next_contact_due")}
-            
-            【Timeline (History)】
-            {history_text}
-            =======================================================
-            """
-
-        active_cases.append({
-            "id": d.get("id"),
-            "title": d.get("title"),
-            "status": d.get("status"),
-            "priority": d.get("priority"),
-            "waiting_for": d.get("waiting_for"),
-            "next_due": d.get("next_contact_due"),
-            "customer": d.get("customer_name")
-        })
+    ctx = PromptContext("global_chat")
+
+    # 詳細が必要なのは質問で指定された1件だけなので、そのケースだけ読み込む
+    target_case = None
+    if target_case_id and any(c.get("id") == target_case_id for c in active_cases):
+        target_case, _ = await load_case_async(adb, target_case_id)
+
+    if target_case:
+        print(f"✅ Found detail data for: {target_case_id}")
+        history_text = ctx.case_history("history", *await load_case_history_async(adb, target_case)) or "(Timeline is empty)"
+        
+        focused_case_details = f"""
+        === ユーザーが指定したケースの詳細 (ID: {target_case_id}) ===
+        Target ID: {target_case_id}
+        Title: {target_case.title}
+        Description: {target_case.description}
+        Status: {target_case.status}
+        Priority: {target_case.priority}
+        Next Due: {target_case.next_contact_due}
+        
+        【Timeline (History)】
+        {history_text}
+        =======================================================
+        """
     
     from datetime import timedelta, timezone
-    now_jst = datetime.now(timezone(timedelta(hours=9))).strftime("%Y-%m-%d %H:%M:%S (JST)")
+    now_jst = prompt_clock(datetime.now(timezone(timedelta(hours=9)))).strftime("%Y-%m-%d %H:%M (JST)")
     
-    context = json.dumps(active_cases, ensure_ascii=False, indent=2)
+    context = ctx.text("board", json.dumps(active_cases, ensure_ascii=False, indent=2))
+    ctx.log()
     prompt = f"""
     
     【前提情報】
@@ -575,15 +817,39 @@ def global_chat(req: ChatRequest):
     上記の情報を元に、PMとして回答してください。
     指定されたケースの詳細情報（Detail Context）がある場合は、その経緯（Timeline）を要約・参照して回答してください。    
     """
+    return prompt
 
-    model = GenerativeModel(model_name=MODEL_ID, system_instruction=PM_INSTRUCTION)
+@app.post("/global/chat")
+async def global_chat(req: ChatRequest):
+    prompt = await _prepare_global_chat(req)
     try:
-        response = model.generate_content(prompt)
-        return {"status": "success", "reply": response.text}
+        reply = await cached_generate_async("global_chat", prompt, regenerate=req.regenerate)
+        return {"status": "success", "reply": reply}
     except Exception as e:
         print(f"PM Chat Error: {e}")
         return {"status": "error", "reply": "申し訳ありません。現在状況の分析に失敗しました。"}
 
+@app.post("/global/chat/stream")
+async def global_chat_stream(req: ChatRequest):
+    """
+    /global/chat の SSE 版。
+    event: delta {"text": 増分} / event: done /global/chat と同じレスポンス / event: error
+    """
+    prompt = await _prepare_global_chat(req)
+
+    async def events():
+        chunks = []
+        try:
+            async for chunk in cached_generate_stream_async("global_chat", prompt, regenerate=req.regenerate):
+                chunks.append(chunk)
+                yield sse_event("delta", {"text": chunk})
+            yield sse_event("done", {"status": "success", "reply": "".join(chunks)})
+        except Exception as e:
+            print(f"PM Chat Stream Error: {e}")
+            yield sse_event("error", {"status": 500, "detail": "申し訳ありません。現在状況の分析に失敗しました。"})
+
+    return sse_response(events())
+
 # ==========================================
 #  5. Escalation Manager (エスカレーション判定)
 # ==========================================
@@ -603,12 +869,13 @@ JSONのみを出力してください。
   "reason": "過去の類似ログ(Case-123)でDB再起動が必要と判断され、SREに移管されているため。"
 }
 """
+agent_registry.register("escalation", ESCALATION_INSTRUCTION)
 
-def consult_escalation_manager(title: str, description: str, logs: str) -> Optional[str]:
-    query = f"{title} escalation transfer history"
-    knowledge = search_knowledge_base(query, filters=["escalation"])
-    
-    prompt = f"""
+ESCALATION_RAG_FILTERS = ["escalation"]
+ESCALATION_GENERATION_CONFIG = json_generation_config(EscalationDecision)
+
+def _escalation_prompt(title: str, description: str, logs: str, knowledge: str) -> str:
+    return f"""
     【インシデント情報】
     Title: {title}
     Desc: {description}
@@ -620,17 +887,30 @@ def consult_escalation_manager(title: str, description: str, logs: str) -> Optio
     上記に基づき、エスカレーション先を判定してください。
     Tier-3エンジニア自身で解決すべきなら "None" を返してください。
     """
+
+def _escalation_target(raw_text: str) -> Optional[str]:
+    target = EscalationDecision(**loads_lenient(raw_text)).target
+    if not target or target.upper() == "NONE":
+        return None
+    return target
+
+def consult_escalation_manager(title: str, description: str, logs: str, regenerate: bool = False) -> Optional[str]:
+    knowledge = search_knowledge_base(f"{title} escalation transfer history", filters=ESCALATION_RAG_FILTERS)
+    prompt = _escalation_prompt(title, description, logs, knowledge)
     
-    model = GenerativeModel(model_name=MODEL_ID, system_instruction=ESCALATION_INSTRUCTION)
     try:
-        response = model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
-        data = json.loads(clean_json_text(response.text))
-        
-        target = data.get("target")
-        if not target or target.upper() == "NONE":
-            return None
-            
-        return target
+        return generate_json("escalation", prompt, ESCALATION_GENERATION_CONFIG, regenerate, parse=_escalation_target)
+    except Exception as e:
+        print(f"⚠️ Escalation Manager Error: {e}")
+        return None
+
+async def consult_escalation_manager_async(title: str, description: str, logs: str, regenerate: bool = False) -> Optional[str]:
+    """consult_escalation_manager の asyncio 版（API リクエスト用）"""
+    knowledge = await search_knowledge_base_async(f"{title} escalation transfer history", filters=ESCALATION_RAG_FILTERS)
+    prompt = _escalation_prompt(title, description, logs, knowledge)
+
+    try:
+        return await generate_json_async("escalation", prompt, ESCALATION_GENERATION_CONFIG, regenerate, parse=_escalation_target)
     except Exception as e:
         print(f"⚠️ Escalation Manager Error: {e}")
         return None
@@ -658,6 +938,397 @@ CLOSER_INSTRUCTION = """
   "knowledge_title": "..."
 }
 """
+agent_registry.register("closure", CLOSER_INSTRUCTION)
+
+CLOSER_GENERATION_CONFIG = json_generation_config(ClosureDraft)
+
+def _parse_closure(raw_text: str) -> dict:
+    return ClosureDraft(**loads_lenient(raw_text)).model_dump()
+
+# ==========================================
+#  7. Triage Orchestrator (並列トリアージ)
+# ==========================================
+# Analyzer / Escalation / Drafter用RAG は互いに独立なので並列に走らせ、
+# Drafter の生成だけ Analyzer の結果を待つ（クリティカルパス = Analyzer + Drafter生成）
+TRIAGE_MAX_WORKERS = int(os.getenv("TRIAGE_MAX_WORKERS", "8"))
+triage_executor = ThreadPoolExecutor(max_workers=TRIAGE_MAX_WORKERS, thread_name_prefix="triage")
+
+def submit_triage(fn, *args, **kwargs):
+    """triage_executor に投げる（クォータのレーン指定などの contextvars を引き継ぐ）"""
+    return triage_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+# split: Analyzer / Drafter / Escalation Manager を別々に呼ぶ（3回生成）
+# combined: 3つの RAG 結果を重複排除してまとめ、1回の構造化出力で全部を得る。
+#           出力が CombinedTriageOutput として検証できなければ split で作り直す
+TRIAGE_MODE = os.getenv("TRIAGE_MODE", "split").lower()
+_triage_stats_lock = threading.Lock()
+triage_stats = {"split": 0, "combined": 0, "combined_fallbacks": 0}
+
+def _count_triage(field: str):
+    with _triage_stats_lock:
+        triage_stats[field] += 1
+
+def _timed(timings: dict, stage: str, fn, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 3)
+
+def run_triage(
+    title: str,
+    description: str,
+    logs: str,
+    file_urls: List[str],
+    sender_email: Optional[str],
+    history: str = "",
+    consult_escalation: bool = True,
+    case_id: Optional[str] = None,
+    regenerate: bool = False,
+    mode: Optional[str] = None,
+) -> TriageResult:
+    """Analyzer / Drafter / Escalation Manager を依存関係に沿って並列実行する（mode 省略時は TRIAGE_MODE）"""
+    timings: dict = {}
+    start = time.perf_counter()
+
+    if (mode or TRIAGE_MODE) == "combined":
+        result = _combined_triage(timings, title, description, logs, file_urls, sender_email, history, consult_escalation, case_id, regenerate)
+        if result is not None:
+            timings["total"] = round(time.perf_counter() - start, 3)
+            print(f"⏱️ Triage timings (combined): {timings}")
+            return result
+
+    analyze_future = submit_triage(
+        _timed, timings, "analyze", analyze_incident, title, description, logs, file_urls, history, case_id, regenerate
+    )
+    drafter_rag_future = submit_triage(
+        _timed, timings, "drafter_rag", search_knowledge_base, query=title[:100], filters=DRAFTER_RAG_FILTERS
+    )
+    escalation_future = None
+    if consult_escalation:
+        escalation_future = submit_triage(
+            _timed, timings, "escalation", consult_escalation_manager, title, description, logs, regenerate
+        )
+
+    proposal = analyze_future.result()
+    draft = _timed(
+        timings, "draft", draft_reply, proposal, sender_email,
+        knowledge_context=drafter_rag_future.result(), regenerate=regenerate,
+    )
+    proposal.reply_draft = draft
+
+    esc_target = escalation_future.result() if escalation_future else None
+    timings["total"] = round(time.perf_counter() - start, 3)
+    print(f"⏱️ Triage timings: {timings}")
+    _count_triage("split")
+
+    return TriageResult(proposal=proposal, escalation_target=esc_target, timings=timings)
+
+async def _timed_async(timings: dict, stage: str, coro):
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 3)
+
+async def run_triage_async(
+    title: str,
+    description: str,
+    logs: str,
+    file_urls: List[str],
+    sender_email: Optional[str],
+    history: str = "",
+    consult_escalation: bool = True,
+    case_id: Optional[str] = None,
+    regenerate: bool = False,
+    mode: Optional[str] = None,
+) -> TriageResult:
+    """run_triage の asyncio 版（API リクエスト用）。triage_executor のスレッドを使わずに同じ順序で並行実行する"""
+    timings: dict = {}
+    start = time.perf_counter()
+
+    if (mode or TRIAGE_MODE) == "combined":
+        result = await _combined_triage_async(timings, title, description, logs, file_urls, sender_email, history, consult_escalation, case_id, regenerate)
+        if result is not None:
+            timings["total"] = round(time.perf_counter() - start, 3)
+            print(f"⏱️ Triage timings (combined): {timings}")
+            return result
+
+    analyze_task = asyncio.ensure_future(_timed_async(
+        timings, "analyze", analyze_incident_async(title, description, logs, file_urls, history, case_id, regenerate)
+    ))
+    drafter_rag_task = asyncio.ensure_future(_timed_async(
+        timings, "drafter_rag", search_knowledge_base_async(query=title[:100], filters=DRAFTER_RAG_FILTERS)
+    ))
+    escalation_task = None
+    if consult_escalation:
+        escalation_task = asyncio.ensure_future(_timed_async(
+            timings, "escalation", consult_escalation_manager_async(title, description, logs, regenerate)
+        ))
+
+    proposal = await analyze_task
+    knowledge_context = await drafter_rag_task
+    draft = await _timed_async(
+        timings, "draft", draft_reply_async(proposal, sender_email, knowledge_context=knowledge_context, regenerate=regenerate)
+    )
+    proposal.reply_draft = draft
+
+    esc_target = await escalation_task if escalation_task else None
+    timings["total"] = round(time.perf_counter() - start, 3)
+    print(f"⏱️ Triage timings: {timings}")
+    _count_triage("split")
+
+    return TriageResult(proposal=proposal, escalation_target=esc_target, timings=timings)
+
+# ------------------------------------------
+#  まとめてトリアージ（TRIAGE_MODE=combined）
+# ------------------------------------------
+COMBINED_TRIAGE_INSTRUCTION = """
+あなたは "OpsResolver"（Tier-3 サポートエンジニアAI）です。
+1件のインシデントについて、次の3つを1回でまとめて作成してください。
+  1) proposal: 解析レポート（AiProposal）
+  2) reply_draft: 顧客への返信メールのドラフト（EmailDraft）
+  3) escalation_target: 他部署へのエスカレーション先（不要なら null）
+
+# 最優先事項（重要）
+- 出力は必ず **有効なJSON**（パース可能）であること（Markdownコードフェンス不要）
+- `proposal.next_contact_due_proposal` は **Current Time を基準**に計算し、**過去日時にしない**こと
+
+# 1) 解析（proposal）
+- エラーコード/ログ根拠から根本原因を仮説化し、検証コマンドや次アクションを具体的に提案する
+- 断定ではなく、根拠（ログの行/ファイル/現象）を添える。不足情報があれば具体的な質問として列挙する
+- メール本文の署名や名乗りから顧客名を `detected_customer_name` に入れる（特定できない場合は null）
+- `next_contact_due_proposal` は ISO8601（timezone 付き）。P1: +4時間 / P2: +1日 / P3: +3日。迷ったら +4時間
+- 参考情報のうち『fix_case_card』の解決策や原因分析を優先して参考にする
+
+# 2) 返信ドラフト（reply_draft）
+- 宛名には `detected_customer_name` を使う（例: 田中 様）。署名には必ず `[担当者名]` を置く
+- 丁寧で共感的な日本語で、解析結果（原因や解決策）をわかりやすく伝える。解決策がある場合は承認を求める
+- これまでの経緯がある場合は挨拶を簡潔にし、文脈に沿った表現にする
+- 『policy_guard_card』のルール（断定禁止など）は厳守する
+
+# 3) エスカレーション判定（escalation_target）
+- Tier-3 で解決可能なら null。過去の類似事例が特定のチーム（SRE, Network, Dev, Billing, Legal など）で解決されている場合はそのチーム名
+- 迷った場合は null（自己解決）を優先する
+
+# 出力形式（JSONのみ）
+{
+  "proposal": {
+    "summary": "事象の概要（1-2行）",
+    "detected_customer_name": "田中 太郎",
+    "hypotheses": [{"cause": "原因の仮説", "likelihood": "High/Medium/Low", "reasoning": "理由"}],
+    "missing_info": ["不足情報"],
+    "evidence_pack": [{"type": "LOG_SNIPPET", "content": "根拠の説明", "source": "file_name or log_line", "is_verified": true}],
+    "next_action_plan": [{"type": "COMMAND", "title": "アクション名", "description": "詳細", "command": "具体的なコマンド"}],
+    "confidence_score": 0.9,
+    "next_contact_due_proposal": "2026-02-13T14:00:00+09:00"
+  },
+  "reply_draft": {"to": "user@example.com", "subject": "件名...", "body": "田中 様\\n\\nお世話になっております...\\n\\n[担当者名]", "attachments": []},
+  "escalation_target": null
+}
+"""
+agent_registry.register("triage", COMBINED_TRIAGE_INSTRUCTION)
+
+TRIAGE_GENERATION_CONFIG = json_generation_config(
+    CombinedTriageOutput, exclude=[f"proposal.{name}" for name in ANALYZER_EXCLUDED_FIELDS]
+)
+
+def _combined_queries(title: str, consult_escalation: bool) -> List[Tuple[str, List[str]]]:
+    """split モードで各エージェントが投げるのと同じ RAG 検索"""
+    queries = [(title[:100], ANALYZER_RAG_FILTERS), (title[:100], DRAFTER_RAG_FILTERS)]
+    if consult_escalation:
+        queries.append((f"{title} escalation transfer history", ESCALATION_RAG_FILTERS))
+    return queries
+
+def _combined_prompt(title: str, description: str, logs: str, history: str, sender_email: Optional[str], knowledge: List[str], now_jst: datetime) -> str:
+    ctx = PromptContext("triage")
+    history = ctx.text("history", history, keep="tail")
+    logs = ctx.text("logs", logs, keep="head_tail")
+    knowledge_context = ctx.text("triage_knowledge", merge_knowledge_contexts(*knowledge))
+    ctx.log()
+
+    return f"""
+    【前提情報】
+    Current Time: {prompt_clock(now_jst).isoformat()}
+    返信の宛先: {sender_email or 'user@example.com'}
+
+    【これまでの経緯 (History)】
+    --------------------------------------------------
+    {history if history else "なし（新規案件）"}
+    --------------------------------------------------
+
+    【現在のインシデント】
+    Title: {title}
+    Description: {description}
+    Logs: {logs}
+
+    【参考情報：過去の類似症例・返信例・ポリシー・エスカレーション実績 (RAG)】
+    {knowledge_context}
+    """
+
+def _parse_combined(raw_text: str, now_jst: datetime) -> CombinedTriageOutput:
+    data = loads_lenient(raw_text)
+    proposal = data.get("proposal") or {}
+    proposal["next_contact_due_proposal"] = normalize_next_due(
+        proposal.get("next_contact_due_proposal"),
+        now_jst=now_jst,
+        fallback_hours=4,
+    )
+    return CombinedTriageOutput(**data)
+
+def _combined_result(out: CombinedTriageOutput, consult_escalation: bool, timings: dict) -> TriageResult:
+    proposal = out.proposal
+    proposal.reply_draft = out.reply_draft
+    target = out.escalation_target if consult_escalation else None
+    if target and target.upper() == "NONE":
+        target = None
+    _count_triage("combined")
+    return TriageResult(proposal=proposal, escalation_target=target, timings=timings, mode="combined")
+
+def _combined_failed(e: Exception, raw_text: str):
+    print(f"⚠️ Combined triage output rejected, falling back to split agents: {e}")
+    print(f"💀 Raw Response (First 500 chars): {raw_text[:500]}")
+    _count_triage("combined_fallbacks")
+
+def _combined_triage(timings: dict, title: str, description: str, logs: str, file_urls: List[str], sender_email: Optional[str],
+                     history: str, consult_escalation: bool, case_id: Optional[str], regenerate: bool) -> Optional[TriageResult]:
+    """1回の生成で解析・返信ドラフト・エスカレーション判定を得る。出力が検証に通らなければ None"""
+    rag_start = time.perf_counter()
+    futures = [submit_triage(search_knowledge_base, query=q, filters=f) for q, f in _combined_queries(title, consult_escalation)]
+    knowledge = [f.result() for f in futures]
+    timings["rag"] = round(time.perf_counter() - rag_start, 3)
+
+    now_jst = datetime.now(JST)
+    prompt = _combined_prompt(title, description, logs, history, sender_email, knowledge, now_jst)
+    prompt_parts = get_multimodal_content(prompt, file_urls, case_id=case_id, regenerate=regenerate)
+
+    try:
+        # 修復できない出力は作り直さず split にフォールバックする（attempts=0）
+        out = _timed(
+            timings, "combined", generate_json, "triage", prompt_parts, TRIAGE_GENERATION_CONFIG, regenerate,
+            parse=lambda raw_text: _parse_combined(raw_text, now_jst), attempts=0,
+        )
+    except Exception as e:
+        _combined_failed(e, getattr(e, "raw_text", ""))
+        return None
+
+    if case_id and file_urls:
+        mark_attachments_analyzed(file_urls, case_id)
+    return _combined_result(out, consult_escalation, timings)
+
+async def _combined_triage_async(timings: dict, title: str, description: str, logs: str, file_urls: List[str], sender_email: Optional[str],
+                                 history: str, consult_escalation: bool, case_id: Optional[str], regenerate: bool) -> Optional[TriageResult]:
+    """_combined_triage の asyncio 版"""
+    rag_start = time.perf_counter()
+    knowledge = await asyncio.gather(*[
+        search_knowledge_base_async(query=q, filters=f) for q, f in _combined_queries(title, consult_escalation)
+    ])
+    timings["rag"] = round(time.perf_counter() - rag_start, 3)
+
+    now_jst = datetime.now(JST)
+    prompt = _combined_prompt(title, description, logs, history, sender_email, list(knowledge), now_jst)
+    prompt_parts = await asyncio.to_thread(get_multimodal_content, prompt, file_urls, case_id, regenerate)
+
+    try:
+        out = await _timed_async(
+            timings, "combined",
+            generate_json_async(
+                "triage", prompt_parts, TRIAGE_GENERATION_CONFIG, regenerate,
+                parse=lambda raw_text: _parse_combined(raw_text, now_jst), attempts=0,
+            ),
+        )
+    except Exception as e:
+        _combined_failed(e, getattr(e, "raw_text", ""))
+        return None
+
+    if case_id and file_urls:
+        await asyncio.to_thread(mark_attachments_analyzed, file_urls, case_id)
+    return _combined_result(out, consult_escalation, timings)
+
+# ==========================================
+#  8. Case Summarizer (ローリング要約)
+# ==========================================
+# 古い経緯は case.history_summary に畳み込み、各エージェントには「要約 + 要約後のイベント」だけを渡す。
+# 要約は watermark (seq) 以降の差分だけを既存要約に追記する形で更新するため、ターンごとのプロンプトはほぼ一定になる
+SUMMARIZER_INSTRUCTION = """
+あなたはサポートケースの記録係です。
+「これまでの要約」に「新しいイベント」の内容を反映し、更新後の要約だけをプレーンテキストで出力してください。
+
+【ルール】
+- 症状、試した対処とその結果、顧客の反応、決定事項、未解決事項を時系列で簡潔にまとめる。
+- エラーコード、製品名、バージョン、日時などの固有情報は省略しない。
+- 推測は書かない。800文字以内。
+"""
+agent_registry.register("summarize", SUMMARIZER_INSTRUCTION)
+SUMMARY_KEEP_RECENT_EVENTS = int(os.getenv("SUMMARY_KEEP_RECENT_EVENTS", "8"))
+SUMMARY_MIN_NEW_EVENTS = int(os.getenv("SUMMARY_MIN_NEW_EVENTS", "4"))
+summary_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SUMMARY_MAX_WORKERS", "2")), thread_name_prefix="summary")
+_summaries_in_flight = set()
+_summaries_lock = threading.Lock()
+
+def load_case_history(case: Case) -> Tuple[Optional[str], List[TimelineEvent]]:
+    """(ローリング要約, 要約に含まれていないイベント) を返す"""
+    return case.history_summary, load_timeline_since(db, case, case.summary_watermark)
+
+async def load_case_history_async(adb, case: Case) -> Tuple[Optional[str], List[TimelineEvent]]:
+    return case.history_summary, await load_timeline_since_async(adb, case, case.summary_watermark)
+
+def _summary_due(case: Case) -> bool:
+    return case.timeline_count - SUMMARY_KEEP_RECENT_EVENTS - case.summary_watermark >= SUMMARY_MIN_NEW_EVENTS
+
+def refresh_case_summary(case_id: str) -> bool:
+    case, tracker = load_case(db, case_id)
+    if case is None or not _summary_due(case):
+        return False
+
+    upto = case.timeline_count - SUMMARY_KEEP_RECENT_EVENTS
+    delta = load_timeline_since(db, case, case.summary_watermark, upto)
+    if not delta or delta[-1].seq is None:
+        return False
+
+    ctx = PromptContext("summarize")
+    previous = ctx.text("summary", case.history_summary or "（なし）")
+    delta_text = ctx.timeline("history", delta)
+    ctx.log()
+
+    prompt = f"""
+    【ケース】
+    Title: {case.title}
+
+    【これまでの要約】
+    {previous}
+
+    【新しいイベント】
+    {delta_text}
+    """
+    summary_text = cached_generate("summarize", prompt)
+
+    case.history_summary = summary_text.strip()
+    case.summary_watermark = delta[-1].seq
+    # 要約フィールドだけを部分更新するので、並行するケース更新は上書きしない
+    update_case(db, case, tracker)
+    print(f"📝 Case {case_id} summary advanced to seq {case.summary_watermark}")
+    return True
+
+def schedule_summary_refresh(case: Case):
+    """要約が必要な分だけイベントが溜まっていれば、バックグラウンドで差分要約する"""
+    if not _summary_due(case):
+        return
+    with _summaries_lock:
+        if case.id in _summaries_in_flight:
+            return
+        _summaries_in_flight.add(case.id)
+
+    def run():
+        try:
+            refresh_case_summary(case.id)
+        except Exception as e:
+            print(f"⚠️ Summary refresh failed for {case.id}: {e}")
+        finally:
+            with _summaries_lock:
+                _summaries_in_flight.discard(case.id)
+
+    summary_executor.submit(run)
 
 # ==========================================
 #  End Points
@@ -667,11 +1338,276 @@ class PubSubMessage(BaseModel):
     message: dict
     subscription: str
 
+GMAIL_UNREAD_QUERY = "is:unread -from:me -label:OpsResolver_Done"
+GMAIL_RESYNC_MAX_MESSAGES = int(os.getenv("GMAIL_RESYNC_MAX_MESSAGES", "50"))
+
+# historyId カーソル（reset_db.py で削除すると次回はフル再同期になる）
+gmail_state_ref = db.collection("system").document("gmail_state")
+# 同一インスタンス内では通知を直列に処理し、同じ差分を二重に取り込まない
+gmail_history_lock = threading.Lock()
+
+def _advance_history_cursor(history_id: Optional[str]):
+    """historyId カーソルを前進させる（巻き戻しはしない）"""
+    if not history_id:
+        return
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def update(tx):
+        snap = gmail_state_ref.get(transaction=tx)
+        current = (snap.to_dict() or {}).get("history_id") if snap.exists else None
+        if current and int(current) >= int(history_id):
+            return
+        tx.set(gmail_state_ref, {"history_id": str(history_id), "updated_at": now_utc_iso()}, merge=True)
+
+    update(transaction)
+
+def _collect_new_message_ids(notified_history_id: Optional[str]):
+    """前回カーソル以降の新着メッセージIDと、次に保存すべき historyId を返す"""
+    snap = gmail_state_ref.get()
+    cursor = (snap.to_dict() or {}).get("history_id") if snap.exists else None
+
+    if cursor and notified_history_id and int(notified_history_id) <= int(cursor):
+        print(f"⏩ History {notified_history_id} already covered by cursor {cursor}")
+        return [], None
+
+    if cursor:
+        history, latest_history_id, error = fetch_history_changes(cursor)
+        if error != "RESET_REQUIRED":
+            msg_ids = extract_added_message_ids(history)
+            print(f"📜 History delta since {cursor}: {len(msg_ids)} new messages")
+            candidates = [h for h in (latest_history_id, notified_history_id) if h]
+            return msg_ids, max(candidates, key=int) if candidates else None
+
+    # カーソル未保存 or 期限切れ: 件数上限付きでフル再同期
+    print(f"🔍 Full resync: scanning UNREAD messages (max {GMAIL_RESYNC_MAX_MESSAGES})...")
+    resync_history_id = notified_history_id or get_current_history_id()
+    msg_ids = list_unread_message_ids(GMAIL_UNREAD_QUERY, GMAIL_RESYNC_MAX_MESSAGES)
+    return msg_ids, resync_history_id
+
+def handle_gmail_notification(payload: dict):
+    """[Job] Push通知1件分: historyId カーソル以降の新着メールを取り込み、トリアージジョブに分解する"""
+    with gmail_history_lock:
+        msg_ids, next_history_id = _collect_new_message_ids(payload.get("history_id"))
+
+        if not msg_ids:
+            print("📭 No new messages found.")
+            _advance_history_cursor(next_history_id)
+            return
+
+        print(f"📥 Found {len(msg_ids)} new messages. Ingesting in batch...")
+        try:
+            incidents, failed = process_messages_batch(msg_ids)
+        except Exception as e:
+            # バッチ経路が使えない場合はメッセージ単位のジョブに分解して個別に処理する
+            print(f"⚠️ Batch ingestion failed, falling back to per-message jobs: {e}")
+            incidents, failed = [], msg_ids
+
+        # ラベルはジョブを積めたメールにだけ付ける。途中で失敗してもカーソルは進めないので、
+        # このジョブのリトライで残りのメールを拾い直せる（積み済みの分はジョブIDで重複が弾かれる）
+        enqueued: List[str] = []
+        try:
+            for msg_id, incident_data in incidents:
+                ingest_queue.enqueue("gmail_incident", {"incident": incident_data}, job_id=f"gmail-incident-{msg_id}")
+                enqueued.append(msg_id)
+        finally:
+            if enqueued:
+                ingest_pool.wake()
+                mark_messages_processed(get_gmail_service(), enqueued)
+        # 差分モードでは次回以降に再検出されないため、失敗分は個別ジョブとしてリトライさせる（ラベルはそのジョブが付ける）
+        for msg_id in failed:
+            ingest_queue.enqueue("gmail_message", {"msg_id": msg_id}, job_id=f"gmail-msg-{msg_id}")
+        ingest_pool.wake()
+
+        _advance_history_cursor(next_history_id)
+
+def handle_gmail_message(payload: dict):
+    """[Job] メール本文/添付を取り込み、トリアージジョブを積んでから処理済みラベルを付ける"""
+    msg_id = payload["msg_id"]
+    incident_data = process_single_message(msg_id)
+    if not incident_data:
+        return
+    # 先にラベルを付けると、積む前に落ちた場合のリトライが「処理済み」で素通りしてしまう。
+    # ジョブID で重複は弾かれるので、リトライで同じメールを積み直しても二重にはならない
+    ingest_queue.enqueue("gmail_incident", {"incident": incident_data}, job_id=f"gmail-incident-{msg_id}")
+    ingest_pool.wake()
+    mark_message_processed(get_gmail_service(), msg_id)
+    print("🏷️ Marked as processed (Done + Read).")
+
+def handle_gmail_incident(payload: dict):
+    """[Job] 取り込み済みメール1件をケースに反映する（既存ケース更新 or 新規作成）"""
+    process_incident(payload["incident"])
+
+def process_incident(incident_data: dict):
+    subject = incident_data['title']
+    thread_id = incident_data.get("gmail_thread_id")
+    gmail_message_id = incident_data.get("gmail_message_id")            
+            
+    print(f"📨 Processing: {subject}")
+            
+    existing_case = None
+    tracker = None
+    thread_case_id = lookup_case_id_by_thread(db, thread_id) if thread_id else None
+    match = re.search(r"\[Case:\s*(case-[a-f0-9]+)\]", subject, re.IGNORECASE)
+    tagged_id = match.group(1) if match else None
+
+    if thread_case_id and thread_case_id != tagged_id:
+        existing_case, tracker = load_case(db, thread_case_id)
+        if existing_case:
+            print(f"🔗 Found existing case by Thread ID: {existing_case.id}")
+        else:
+            forget_thread(thread_id)
+
+    if tagged_id:
+        print(f"🔗 Found Case ID tag: {tagged_id}")
+        tagged_case, tagged_tracker = load_case(db, tagged_id)
+        if tagged_case is not None:
+            existing_case, tracker = tagged_case, tagged_tracker
+            # 件名タグで辿れた新しいスレッドも索引に載せ、次回からキー参照で見つかるようにする
+            if thread_id and thread_case_id != tagged_case.id and tagged_case.gmail_thread_id:
+                index_case_thread(db, thread_id, tagged_case.id)
+
+    if existing_case:
+
+        thread_id = incident_data.get("gmail_thread_id")
+        gmail_message_id = incident_data.get("gmail_message_id")
+        if not getattr(existing_case, "gmail_thread_id", None) and thread_id:
+            existing_case.gmail_thread_id = thread_id
+        if not getattr(existing_case, "gmail_message_id", None) and gmail_message_id:
+            existing_case.gmail_message_id = gmail_message_id
+                
+        print(f"🔄 Updating Case: {existing_case.id}")
+                
+        history_summary, history_events = load_case_history(existing_case)
+        reply_event = new_timeline_event(
+            "REPLY_RECEIVED", "USER", incident_data['description'],
+            {"has_logs": bool(incident_data['file_urls'])},
+        )
+        new_events = append_timeline_events(existing_case, [reply_event])
+                
+        ctx = PromptContext("reanalysis")
+        history_text = ctx.case_history("history", history_summary, history_events + new_events[-1:])
+        ctx.log()
+
+        combined_logs = f"""
+        【これまでの経緯】
+        Title: {existing_case.title}
+        Description: {existing_case.description}
+                
+        【ユーザーからの最新の返信】
+        {incident_data['description']}
+                
+        【新規添付ログ/ファイル】
+        {incident_data['file_urls']}
+        """
+                
+        print("🧠 Running Re-Analysis...")
+        with quota_lane("background"):
+            triage = run_triage(
+                title=existing_case.title, 
+                description=existing_case.description, 
+                logs=combined_logs,
+                file_urls=incident_data['file_urls'],
+                sender_email=incident_data['sender_email'],
+                history=history_text,
+                consult_escalation=False,
+                case_id=existing_case.id,
+            )
+        new_proposal = triage.proposal
+                
+        existing_case.latest_proposal = new_proposal
+        existing_case.status = "PROPOSED" 
+        existing_case.waiting_for = compute_waiting_for("PROPOSED")
+        if new_proposal.next_contact_due_proposal:
+            existing_case.next_contact_due = new_proposal.next_contact_due_proposal
+        existing_case.updated_at = now_utc_iso()
+                
+        update_case(db, existing_case, tracker, new_events)
+        schedule_summary_refresh(existing_case)
+        print(f"✅ Case {existing_case.id} Updated")
+
+    else:
+        print(f"🆕 Creating NEW case: {subject}")
+        thread_id = incident_data.get("gmail_thread_id")
+        gmail_message_id = incident_data.get("gmail_message_id")
+
+        print("DEBUG CREATE before pop:",
+              "thread_id=", incident_data.get("gmail_thread_id"),
+              "message_id=", incident_data.get("gmail_message_id"),
+              "saved_thread_id=", thread_id,
+              "saved_message_id=", gmail_message_id)
+
+        incident_data.pop("gmail_thread_id", None)
+        incident_data.pop("gmail_message_id", None)
+
+        req = CreateTriageRequest(**incident_data)  
+        new_case_id = f"case-{uuid.uuid4().hex[:8]}"
+        triage = run_triage(req.title, req.description, req.logs or "", req.file_urls, req.sender_email, case_id=new_case_id)
+        proposal = triage.proposal
+
+        initial_timeline_event = new_timeline_event(
+            "INGEST", "USER", incident_data['description'],
+            {
+                "subject": incident_data['title'],
+                "from": incident_data['sender_email'],
+                "files": len(incident_data['file_urls']),
+                "gmail_thread_id": thread_id,
+                "gmail_message_id": gmail_message_id,
+                "triage_timings": triage.timings,
+            },
+        )
+
+        esc_target = triage.escalation_target
+        print(f"⚖️ Escalation Judgment: {esc_target}")      
+
+        print("DEBUG new_case fields:",
+              "case_id(planned)=", new_case_id,
+              "gmail_thread_id=", thread_id,
+              "gmail_message_id=", gmail_message_id)
+
+        new_case = Case(
+            id=new_case_id,
+            title=req.title,
+            description=req.description,
+            status="PROPOSED",
+            priority="P1",
+            created_at=now_utc_iso(),
+            updated_at=now_utc_iso(),
+            next_contact_due=proposal.next_contact_due_proposal,
+            waiting_for=compute_waiting_for("PROPOSED"),
+            latest_proposal=proposal,
+            sender_email=req.sender_email,
+            sender_name=req.sender_name, 
+            customer_name=proposal.detected_customer_name, 
+            gmail_thread_id=thread_id,
+            gmail_message_id=gmail_message_id,
+            escalation_target=esc_target,                      
+        )
+        new_events = append_timeline_events(new_case, [initial_timeline_event])
+        save_case(db, new_case, new_events)
+        print(f"✅ New Case Created: {new_case.id}")
+
+ingest_queue = create_ingest_queue(db)
+ingest_pool = IngestWorkerPool(ingest_queue, handlers={
+    "gmail_notification": handle_gmail_notification,
+    "gmail_message": handle_gmail_message,
+    "gmail_incident": handle_gmail_incident,
+})
+
+@app.on_event("startup")
+def start_ingest_workers():
+    # Cloud Run では「CPU を常に割り当てる」設定にしておくこと（レスポンス後もワーカーが動くため）
+    ingest_pool.start()
+
+@app.on_event("shutdown")
+def stop_ingest_workers():
+    ingest_pool.stop()
+
 @app.post("/webhook/gmail")
 async def gmail_webhook(data: PubSubMessage):
+    """Pub/Sub Push を受けたらジョブを積んで即 ACK する（重い処理はワーカーで実行）"""
     try:
         import base64
-        import re
         
         pubsub_data = base64.b64decode(data.message['data']).decode('utf-8')
         json_data = json.loads(pubsub_data)
@@ -683,182 +1619,20 @@ async def gmail_webhook(data: PubSubMessage):
         if email_address != CURRENT_ACCOUNT:
             return {"status": "ignored", "reason": "wrong_account"}
 
-        print("🔍 Scanning for UNREAD messages...")
-        
-        service = get_gmail_service()
-        query = "is:unread -from:me -label:OpsResolver_Done"        
-        results = service.users().messages().list(
-            userId='me', 
-            q=query,
-            maxResults=5 
-        ).execute()
-        
-        messages = results.get('messages', [])
-        
-        if not messages:
-            print("📭 No unread messages found.")
-            return {"status": "no_unread_messages"}
-
-        print(f"📥 Found {len(messages)} unread messages. Processing...")
-
-        for msg in messages:
-            msg_id = msg['id']
-            
-            incident_data = process_single_message(msg_id)            
-            if not incident_data:
-                continue
+        pubsub_id = data.message.get('messageId') or data.message.get('message_id')
+        # キューへの書き込みは同期 I/O なので、イベントループを止めないようスレッドで実行する
+        queued = await asyncio.to_thread(
+            ingest_queue.enqueue,
+            "gmail_notification",
+            {"history_id": json_data.get('historyId')},
+            job_id=f"pubsub-{pubsub_id}" if pubsub_id else None,
+        )
+        if not queued:
+            print(f"⏩ Duplicate push ignored: {pubsub_id}")
+            return {"status": "duplicate"}
 
-            subject = incident_data['title']
-            thread_id = incident_data.get("gmail_thread_id")
-            gmail_message_id = incident_data.get("gmail_message_id")            
-            
-            print(f"📨 Processing: {subject}")
-            
-            existing_case = None
-            if thread_id:
-                docs = db.collection("cases").where("gmail_thread_id", "==", thread_id).limit(1).stream()
-                for d in docs:
-                    existing_case = Case(**d.to_dict())
-                    print(f"🔗 Found existing case by Thread ID: {existing_case.id}")
-                    break
-            
-            match = re.search(r"\[Case:\s*(case-[a-f0-9]+)\]", subject, re.IGNORECASE)
-            if match:
-                extracted_id = match.group(1)
-                print(f"🔗 Found Case ID tag: {extracted_id}")
-                doc = db.collection("cases").document(extracted_id).get()
-                if doc.exists:
-                    existing_case = Case(**doc.to_dict())
-
-            if existing_case:
-
-                thread_id = incident_data.get("gmail_thread_id")
-                gmail_message_id = incident_data.get("gmail_message_id")
-                if not getattr(existing_case, "gmail_thread_id", None) and thread_id:
-                    existing_case.gmail_thread_id = thread_id
-                if not getattr(existing_case, "gmail_message_id", None) and gmail_message_id:
-                    existing_case.gmail_message_id = gmail_message_id
-                
-                print(f"🔄 Updating Case: {existing_case.id}")
-                
-                existing_case.timeline.append({
-                    "id": f"evt-{uuid.uuid4().hex[:4]}",
-                    "timestamp": now_utc_iso(),
-                    "type": "REPLY_RECEIVED",
-                    "actor": "USER",
-                    "message": incident_data['description'],
-                    "metadata": {"has_logs": bool(incident_data['file_urls'])}
-                })
-                
-                history_text = ""
-                for event in existing_case.timeline:
-                    evt_dict = event.dict() if hasattr(event, "dict") else event
-                            
-                    ts = evt_dict.get("timestamp", "")
-                    actor = evt_dict.get("actor", "UNKNOWN")
-                    msg = evt_dict.get("message", "")
-                            
-                    history_text += f"[{ts}] {actor}: {msg}\n"
-
-                combined_logs = f"""
-                【これまでの経緯】
-                Title: {existing_case.title}
-                Description: {existing_case.description}
-                
-                【ユーザーからの最新の返信】
-                {incident_data['description']}
-                
-                【新規添付ログ/ファイル】
-                {incident_data['file_urls']}
-                """
-                
-                print("🧠 Running Re-Analysis...")
-                new_proposal = analyze_incident(
-                    title=existing_case.title, 
-                    description=existing_case.description, 
-                    logs=combined_logs,
-                    file_urls=incident_data['file_urls'],
-                    history=history_text
-                )
-                
-                new_draft = draft_reply(new_proposal, incident_data['sender_email'])
-                new_proposal.reply_draft = new_draft
-                
-                existing_case.latest_proposal = new_proposal
-                existing_case.status = "PROPOSED" 
-                existing_case.waiting_for = compute_waiting_for("PROPOSED")
-                if new_proposal.next_contact_due_proposal:
-                    existing_case.next_contact_due = new_proposal.next_contact_due_proposal
-                existing_case.updated_at = now_utc_iso()
-                
-                db.collection("cases").document(existing_case.id).set(existing_case.model_dump(), merge=True)
-                print(f"✅ Case {existing_case.id} Updated")
-
-            else:
-                print(f"🆕 Creating NEW case: {subject}")
-                thread_id = incident_data.get("gmail_thread_id")
-                gmail_message_id = incident_data.get("gmail_message_id")
-
-                print("DEBUG CREATE before pop:",
-                      "thread_id=", incident_data.get("gmail_thread_id"),
-                      "message_id=", incident_data.get("gmail_message_id"),
-                      "saved_thread_id=", thread_id,
-                      "saved_message_id=", gmail_message_id)
-
-                incident_data.pop("gmail_thread_id", None)
-                incident_data.pop("gmail_message_id", None)
-
-                req = CreateTriageRequest(**incident_data)  
-                proposal = analyze_incident(req.title, req.description, req.logs or "", req.file_urls)
-                draft = draft_reply(proposal, req.sender_email)
-                proposal.reply_draft = draft
-
-                initial_timeline_event = {
-                    "id": f"evt-{uuid.uuid4().hex[:4]}",
-                    "timestamp": now_utc_iso(),
-                    "type": "INGEST", 
-                    "actor": "USER",
-                    "message": incident_data['description'], 
-                    "metadata": {
-                        "subject": incident_data['title'],
-                        "from": incident_data['sender_email'],
-                        "files": len(incident_data['file_urls']),
-                        "gmail_thread_id": thread_id,
-                        "gmail_message_id": gmail_message_id,
-                    }
-                }          
-
-                esc_target = consult_escalation_manager(req.title, req.description, req.logs or "")
-                print(f"⚖️ Escalation Judgment: {esc_target}")      
-
-                print("DEBUG new_case fields:",
-                      "case_id(planned)=", f"case-{uuid.uuid4().hex[:8]}",
-                      "gmail_thread_id=", thread_id,
-                      "gmail_message_id=", gmail_message_id)
-
-                new_case = Case(
-                    id=f"case-{uuid.uuid4().hex[:8]}",
-                    title=req.title,
-                    description=req.description,
-                    status="PROPOSED",
-                    priority="P1",
-                    created_at=now_utc_iso(),
-                    updated_at=now_utc_iso(),
-                    next_contact_due=proposal.next_contact_due_proposal,
-                    waiting_for=compute_waiting_for("PROPOSED"),
-                    latest_proposal=proposal,
-                    sender_email=req.sender_email,
-                    sender_name=req.sender_name, 
-                    customer_name=proposal.detected_customer_name, 
-                    gmail_thread_id=thread_id,
-                    gmail_message_id=gmail_message_id,
-                    timeline=[initial_timeline_event],
-                    escalation_target=esc_target,                      
-                )
-                db.collection("cases").document(new_case.id).set(new_case.model_dump())
-                print(f"✅ New Case Created: {new_case.id}")
-
-        return {"status": "ok"}
+        ingest_pool.wake()
+        return {"status": "queued"}
 
     except Exception as e:
         print(f"❌ Webhook Error: {e}")
@@ -866,36 +1640,99 @@ async def gmail_webhook(data: PubSubMessage):
         traceback.print_exc()
         return {"status": "error", "detail": str(e)}
 
-@app.get("/cases", response_model=List[Case])
-def list_cases():
-    docs = db.collection("cases").order_by("updated_at", direction=firestore.Query.DESCENDING).stream()
-    cases = []
-    for doc in docs:
-        cases.append(Case(**doc.to_dict()))
-    return cases
+@app.get("/ingest/stats")
+def ingest_stats():
+    return {
+        "backend": type(ingest_queue).__name__,
+        "jobs": ingest_queue.stats(),
+        "dead_letters": [j.model_dump() for j in ingest_queue.dead_letters(limit=20)],
+    }
+
+@app.get("/metrics")
+def get_metrics():
+    """キャッシュ等のチューニング用メトリクス"""
+    return {
+        "caches": {
+            "knowledge_search": knowledge_cache.stats(),
+            "gmail_thread_index": thread_index_cache.stats(),
+        },
+        "generation_cache": generation_cache.stats(),
+        "triage": {"mode": TRIAGE_MODE, **triage_stats},
+        "json_output": json_repair_stats(),
+        "resilience": resilience_stats(),
+        "quota": quota_governor.stats(),
+        "agents": agent_registry.stats(),
+        "prompt_context": context_stats(),
+    }
+
+CASE_LIST_DEFAULT_PAGE_SIZE = 50
+CASE_LIST_MAX_PAGE_SIZE = 200
+CASE_SUMMARY_FIELDS = list(CaseSummary.model_fields.keys())
+
+@app.get("/cases", response_model=CaseListPage)
+async def list_cases(
+    status: Optional[CaseStatus] = None,
+    limit: int = Query(CASE_LIST_DEFAULT_PAGE_SIZE, ge=1, le=CASE_LIST_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+):
+    """
+    ケース一覧（updated_at 降順）。一覧表示に必要なフィールドだけを Firestore から取得する。
+    cursor には前ページの next_cursor（最後のケースID）を渡す。
+    status 指定時は (status, updated_at DESC) の複合インデックスが必要。
+    """
+    cases_ref = get_adb().collection("cases")
+    query = cases_ref
+    if status:
+        query = query.where("status", "==", status)
+    query = query.order_by("updated_at", direction=firestore.Query.DESCENDING).select(CASE_SUMMARY_FIELDS)
+
+    if cursor:
+        cursor_snap = await cases_ref.document(cursor).get(field_paths=["updated_at"])
+        if not cursor_snap.exists:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.start_after(cursor_snap)
+
+    docs = [doc async for doc in query.limit(limit + 1).stream()]
+    items = [CaseSummary(**doc.to_dict()) for doc in docs[:limit]]
+    next_cursor = items[-1].id if len(docs) > limit else None
+
+    return CaseListPage(items=items, next_cursor=next_cursor)
 
 @app.get("/cases/{case_id}", response_model=Case)
-def get_case(case_id: str):
-    doc_ref = db.collection("cases").document(case_id)
-    doc = doc_ref.get()
-    if not doc.exists:
+async def get_case(case_id: str):
+    case, _ = await load_case_async(get_adb(), case_id)
+    if case is None:
+        raise HTTPException(status_code=404, detail="Case not found")
+    return case
+
+@app.get("/cases/{case_id}/timeline", response_model=TimelinePage)
+async def get_case_timeline(
+    case_id: str,
+    before: Optional[int] = Query(None, ge=1, description="この seq より古いイベントを返す"),
+    limit: int = Query(50, ge=1, le=200),
+):
+    """ケースドキュメントに載らない古いタイムラインをページングで返す（seq 昇順）"""
+    adb = get_adb()
+    case, _ = await load_case_async(adb, case_id)
+    if case is None:
         raise HTTPException(status_code=404, detail="Case not found")
-    return Case(**doc.to_dict())
+    items, next_before = await list_timeline_page_async(adb, case, before, limit)
+    return TimelinePage(items=items, next_before=next_before)
 
 @app.post("/triage", response_model=Case)
-def create_triage(req: CreateTriageRequest):
+async def create_triage(req: CreateTriageRequest):
     print(f"🚀 Triage started: {req.title} with {len(req.file_urls)} files")
     
-    proposal = analyze_incident(
+    triage = await run_triage_async(
         req.title, 
         req.description, 
         req.logs or "", 
-        req.file_urls 
+        req.file_urls,
+        req.sender_email,
+        regenerate=req.regenerate,
     )
-    
-    draft = draft_reply(proposal, req.sender_email)
-    proposal.reply_draft = draft
-    esc_target = consult_escalation_manager(req.title, req.description, req.logs or "")
+    proposal = triage.proposal
+    esc_target = triage.escalation_target
 
     new_case = Case(
         id=f"case-{uuid.uuid4().hex[:8]}",
@@ -912,19 +1749,17 @@ def create_triage(req: CreateTriageRequest):
         escalation_target=esc_target,         
     )
         
-    db.collection("cases").document(new_case.id).set(new_case.model_dump())
+    await save_case_async(get_adb(), new_case)
     print(f"✅ Case created in Firestore: {new_case.id}")
 
     return new_case
 
 @app.post("/cases/{case_id}/approve", response_model=Case)
-def approve_case(case_id: str, req: ApproveRequest):
-    doc_ref = db.collection("cases").document(case_id)
-    doc = doc_ref.get()
-    if not doc.exists:
+async def approve_case(case_id: str, req: ApproveRequest):
+    adb = get_adb()
+    target_case, tracker = await load_case_async(adb, case_id)
+    if target_case is None:
         raise HTTPException(status_code=404, detail="Case not found")
-
-    target_case = Case(**doc.to_dict())
     
     if hasattr(req.approved_content, "model_dump"):
         content_data = req.approved_content.model_dump()
@@ -968,7 +1803,8 @@ def approve_case(case_id: str, req: ApproveRequest):
               "to=", reply_to,
             )
 
-            send_reply(
+            await run_gmail(
+                send_reply,
                 to_email=reply_to,
                 subject=email_subject,
                 body=final_body,
@@ -980,7 +1816,6 @@ def approve_case(case_id: str, req: ApproveRequest):
             raise HTTPException(status_code=500, detail=f"Email sending failed: {e}")
 
     next_status = content_data.get("next_status", "WAITING_CUSTOMER")
-    target_case = Case(**doc.to_dict())
     target_case.status = next_status
     target_case.updated_at = now_utc_iso()
 
@@ -995,48 +1830,42 @@ def approve_case(case_id: str, req: ApproveRequest):
     else:
         target_case.waiting_for = []
 
-    target_case.timeline.append({
-        "id": f"evt-{uuid.uuid4().hex[:4]}",
-        "timestamp": now_utc_iso(),
-        "type": "HUMAN_APPROVE",
-        "actor": "ENGINEER",
-        "message": f"Action Approved. Status changed to {next_status}.",
-        "metadata": content_data
-    })
+    new_events = append_timeline_events(target_case, [new_timeline_event(
+        "HUMAN_APPROVE", "ENGINEER",
+        f"Action Approved. Status changed to {next_status}.",
+        content_data,
+    )])
 
-    doc_ref.set(target_case.model_dump(), merge=True)
+    await update_case_async(adb, target_case, tracker, new_events)
+    schedule_summary_refresh(target_case)
     return target_case
 
 @app.post("/cases/{case_id}/reply_ingest", response_model=Case)
-def ingest_reply(case_id: str, req: ReplyIngestRequest):
+async def ingest_reply(case_id: str, req: ReplyIngestRequest):
     print(f"🔄 Processing reply for case: {case_id}")
 
-    doc_ref = db.collection("cases").document(case_id)
-    doc = doc_ref.get()
-    if not doc.exists:
+    adb = get_adb()
+    target_case, tracker = await load_case_async(adb, case_id)
+    if target_case is None:
         raise HTTPException(status_code=404, detail="Case not found")
-    
-    target_case.timeline.append({
-        "id": f"evt-{uuid.uuid4().hex[:4]}",
-        "timestamp": now_utc_iso(),
-        "type": "REPLY_RECEIVED",
-        "actor": "USER",
-        "message": req.reply_text,
-        "metadata": {"has_logs": bool(req.new_logs)}
-    })
+
+    new_events = append_timeline_events(target_case, [new_timeline_event(
+        "REPLY_RECEIVED", "USER", req.reply_text,
+        {"has_logs": bool(req.new_logs)},
+    )])
 
     combined_logs = f"""
     [Original Logs] (Previous context)
     [User Reply] {req.reply_text}
     [New Logs Provided] {req.new_logs or "(No new logs)"}
     """
-
-    target_case = Case(**doc.to_dict())
     
-    new_proposal = analyze_incident(target_case.title, target_case.description, combined_logs, [])
-    
-    sender = target_case.latest_proposal.reply_draft.to if target_case.latest_proposal and target_case.latest_proposal.reply_draft else None
-    new_draft = draft_reply(new_proposal, sender)
+    # 返信を受けての再解析は新規トリアージ・チャットより後回しでよい
+    with quota_lane("background"):
+        new_proposal = await analyze_incident_async(target_case.title, target_case.description, combined_logs, [], regenerate=req.regenerate)
+
+        sender = target_case.latest_proposal.reply_draft.to if target_case.latest_proposal and target_case.latest_proposal.reply_draft else None
+        new_draft = await draft_reply_async(new_proposal, sender, regenerate=req.regenerate)
     new_proposal.reply_draft = new_draft
 
     target_case.latest_proposal = new_proposal
@@ -1044,38 +1873,38 @@ def ingest_reply(case_id: str, req: ReplyIngestRequest):
     target_case.waiting_for = compute_waiting_for("PROPOSED")
     target_case.updated_at = now_utc_iso()
     
-    doc_ref.set(target_case.model_dump(), merge=True)
+    await update_case_async(adb, target_case, tracker, new_events)
+    schedule_summary_refresh(target_case)
     return target_case
 
-def generate_closure_summary(case: Case) -> dict:
-    model = GenerativeModel(model_name=MODEL_ID, system_instruction=CLOSER_INSTRUCTION)
-    
-    timeline_logs = []
-    for t in case.timeline:
-        if isinstance(t, dict): d = t
-        else: d = t.model_dump() if hasattr(t, "model_dump") else t.dict()
-        timeline_logs.append(f"[{d.get('timestamp')}] {d.get('actor')}: {d.get('message')}")
+async def generate_closure_summary(case: Case, timeline: Optional[list] = None, regenerate: bool = False) -> dict:
+    """timeline には history_summary に含まれていないイベントを渡す（省略時はドキュメント内の直近分）"""
     
-    timeline_str = "\n".join(timeline_logs)
+    ctx = PromptContext("closure")
+    recent = timeline if timeline is not None else [
+        e for e in case.timeline if (e.seq or 0) > case.summary_watermark
+    ]
+    timeline_str = ctx.case_history("history", case.history_summary, recent)
+    latest_analysis = ctx.text("analysis", case.latest_proposal.model_dump_json() if case.latest_proposal else "N/A")
+    ctx.log()
     
-    prompt = f"Title: {case.title}\nDescription: {case.description}\nHistory:\n{timeline_str}\nLatest Analysis: {case.latest_proposal.model_dump_json() if case.latest_proposal else 'N/A'}"
+    prompt = f"Title: {case.title}\nDescription: {case.description}\nHistory:\n{timeline_str}\nLatest Analysis: {latest_analysis}"
     
     try:
-        response = model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
-        return json.loads(clean_json_text(response.text))
+        return await generate_json_async("closure", prompt, CLOSER_GENERATION_CONFIG, regenerate, parse=_parse_closure)
     except Exception as e:
         print(f"Closer Error: {e}")
         return {"root_cause": "Error", "resolution_steps": "N/A", "prevention_measure": "N/A", "knowledge_title": "Error"}
 
 @app.post("/cases/{case_id}/close", response_model=Case)
-def close_case(case_id: str, req: CloseRequest):
-    doc_ref = db.collection("cases").document(case_id)
-    doc = doc_ref.get()
-    if not doc.exists: raise HTTPException(status_code=404, detail="Case not found")
-    target_case = Case(**doc.to_dict())
+async def close_case(case_id: str, req: CloseRequest):
+    adb = get_adb()
+    target_case, tracker = await load_case_async(adb, case_id)
+    if target_case is None: raise HTTPException(status_code=404, detail="Case not found")
 
     print(f"🔒 Closing case: {case_id}")
-    closure_data = generate_closure_summary(target_case)
+    _, recent_events = await load_case_history_async(adb, target_case)
+    closure_data = await generate_closure_summary(target_case, recent_events, regenerate=req.regenerate)
     
     if target_case.latest_proposal:
         res_steps = closure_data.get("resolution_steps", "")
@@ -1088,15 +1917,16 @@ def close_case(case_id: str, req: CloseRequest):
 
     target_case.status = "CLOSED"
     target_case.updated_at = now_utc_iso()
-    target_case.timeline.append({
-        "id": f"evt-{uuid.uuid4().hex[:4]}", "timestamp": now_utc_iso(),
-        "type": "STATUS_CHANGE", "actor": "ENGINEER",
-        "message": f"Case Closed. Knowledge: {closure_data.get('knowledge_title')}", "metadata": closure_data
-    })
-    doc_ref.set(target_case.model_dump())  
+    new_events = append_timeline_events(target_case, [new_timeline_event(
+        "STATUS_CHANGE", "ENGINEER",
+        f"Case Closed. Knowledge: {closure_data.get('knowledge_title')}", closure_data,
+    )])
+    await update_case_async(adb, target_case, tracker, new_events)
 
     if req.publish_kb:
         print(f"🔄 Feedback Loop: Converting Case {case_id} to Knowledge...")
-        export_case_to_knowledge(target_case, req.closure_note)
+        export_case = target_case.model_copy(update={"timeline": await load_full_timeline_async(adb, target_case)})
+        # GCS へのアップロードは同期クライアントなのでスレッドで実行する
+        await asyncio.to_thread(export_case_to_knowledge, export_case, req.closure_note)
 
     return target_case
\ No newline at end of file
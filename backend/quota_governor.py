@@ -0,0 +1,293 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Gemini のクォータ（プロジェクト全体）をプロセス内で配分する。0 でその制限を無効にする
+VERTEX_RPM = float(os.getenv("VERTEX_RPM", "300"))
+VERTEX_TPM = float(os.getenv("VERTEX_TPM", "1000000"))
+VERTEX_MAX_CONCURRENCY = int(os.getenv("VERTEX_MAX_CONCURRENCY", "16"))
+# バケットに貯められる量（何秒分か）。大きいほどバーストを許す
+VERTEX_QUOTA_BURST_SECONDS = float(os.getenv("VERTEX_QUOTA_BURST_SECONDS", "10"))
+# 呼び出し前のトークン見積もり（出力ぶん・画像/動画1パートぶん）。呼び出し後に実際の使用量で精算する
+VERTEX_QUOTA_OUTPUT_TOKENS = int(os.getenv("VERTEX_QUOTA_OUTPUT_TOKENS", "1024"))
+VERTEX_QUOTA_MEDIA_TOKENS = int(os.getenv("VERTEX_QUOTA_MEDIA_TOKENS", "1000"))
+
+# 優先度順（小さいほど先）。上位のレーンが待っている間は下位のレーンを追い越させない
+LANES = {
+    "interactive": 0,   # オペレーターのチャット
+    "triage": 1,        # 新規ケースのトリアージ
+    "background": 2,    # 返信を受けての再解析・クローズ時の KB 化・要約
+}
+# 待ち行列の最大待ち時間（秒）。超えたら QuotaWaitTimeout
+LANE_MAX_WAIT_SECONDS = {
+    "interactive": float(os.getenv("QUOTA_MAX_WAIT_INTERACTIVE", "30")),
+    "triage": float(os.getenv("QUOTA_MAX_WAIT_TRIAGE", "300")),
+    "background": float(os.getenv("QUOTA_MAX_WAIT_BACKGROUND", "900")),
+}
+# 呼び出し元がレーンを指定しなかったときのエージェントごとの既定
+AGENT_LANES = {
+    "chat": "interactive",
+    "global_chat": "interactive",
+    "closure": "background",
+    "summarize": "background",
+}
+DEFAULT_LANE = "triage"
+# 待ち行列にいる呼び出しが状態を見直す最大間隔（解放通知の取りこぼし対策）
+_MAX_POLL_SECONDS = 1.0
+
+_current_lane: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("quota_lane", default=None)
+
+
+class QuotaWaitTimeout(TimeoutError):
+    """レーンの最大待ち時間までに枠が空かなかった"""
+
+
+@contextlib.contextmanager
+def quota_lane(lane: str):
+    """
+    この中で行う生成呼び出しのレーンを指定する（contextvars なので asyncio のタスク・to_thread にも引き継がれる）。
+    ThreadPoolExecutor.submit には引き継がれないため、そこでは contextvars.copy_context().run を使う
+    """
+    if lane not in LANES:
+        raise ValueError(f"unknown quota lane: {lane}")
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def lane_for(agent: str) -> str:
+    return _current_lane.get() or AGENT_LANES.get(agent, DEFAULT_LANE)
+
+
+class _Bucket:
+    """per_minute / 60 ずつ回復するトークンバケット（per_minute=0 なら無制限）"""
+
+    def __init__(self, per_minute: float, burst_seconds: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * burst_seconds, 1.0) if per_minute > 0 else 0.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.rate <= 0
+
+    def refill(self, now: float):
+        if not self.unlimited:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_seconds(self, amount: float) -> float:
+        """amount を取り出せるまでの秒数（0 なら今すぐ）。容量を超える要求は満タンになれば通す"""
+        if self.unlimited:
+            return 0.0
+        needed = min(amount, self.capacity) - self.level
+        return max(needed / self.rate, 0.0)
+
+    def take(self, amount: float):
+        if not self.unlimited:
+            self.level -= amount
+
+    def give_back(self, amount: float):
+        if not self.unlimited:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class _Waiter:
+    def __init__(self, lane: str, tokens: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.lane = lane
+        self.tokens = tokens
+        self.admitted = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future: Optional[asyncio.Future] = loop.create_future() if loop is not None else None
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Ticket:
+    """admit の戻り値。呼び出しが終わったら release(ticket, 実際のトークン数) で返す"""
+
+    def __init__(self, lane: str, tokens: int, waited: float):
+        self.lane = lane
+        self.tokens = tokens
+        self.waited = waited
+
+
+class QuotaGovernor:
+    """
+    全エージェントで共有する Gemini 呼び出しの流量制御。
+    RPM / TPM のトークンバケットと同時実行数の上限を持ち、空きが出たら優先度の高いレーンから順に通す。
+    同期（インジェストワーカー等のスレッド）と asyncio（API リクエスト）の両方から使える
+    """
+
+    def __init__(self, rpm: float = VERTEX_RPM, tpm: float = VERTEX_TPM, max_concurrency: int = VERTEX_MAX_CONCURRENCY,
+                 burst_seconds: float = VERTEX_QUOTA_BURST_SECONDS):
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self._requests = _Bucket(rpm, burst_seconds)
+        self._tokens = _Bucket(tpm, burst_seconds)
+        self._in_flight = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._stats = {lane: {"admitted": 0, "queued": 0, "timeouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0} for lane in LANES}
+        self._throttled = 0
+
+    def _dispatch(self, now: float) -> float:
+        """
+        先頭（最優先・最古）から通せるだけ通す。lock を持って呼ぶ。
+        戻り値: 先頭がバケットの回復待ちなら回復までの秒数（同時実行数待ち・空なら _MAX_POLL_SECONDS）
+        """
+        self._requests.refill(now)
+        self._tokens.refill(now)
+        while self._queue:
+            _, _, waiter = self._queue[0]
+            if self.max_concurrency > 0 and self._in_flight >= self.max_concurrency:
+                return _MAX_POLL_SECONDS
+            wait = max(self._requests.wait_seconds(1), self._tokens.wait_seconds(waiter.tokens))
+            if wait > 0:
+                return min(wait, _MAX_POLL_SECONDS)
+            heapq.heappop(self._queue)
+            self._requests.take(1)
+            self._tokens.take(waiter.tokens)
+            self._in_flight += 1
+            waiter.admitted = True
+            waiter.wake()
+        return _MAX_POLL_SECONDS
+
+    def _enqueue(self, waiter: _Waiter) -> float:
+        with self._lock:
+            heapq.heappush(self._queue, (LANES[waiter.lane], next(self._seq), waiter))
+            return self._dispatch(time.monotonic())
+
+    def _poll(self, waiter: _Waiter, started: float) -> Optional[float]:
+        """待ち行列の waiter の状態を見直す。通ったら None、まだなら次に見直すまでの秒数"""
+        with self._lock:
+            delay = self._dispatch(time.monotonic())
+            if waiter.admitted:
+                return None
+            remaining = LANE_MAX_WAIT_SECONDS[waiter.lane] - (time.monotonic() - started)
+            if remaining <= 0:
+                self._queue = [item for item in self._queue if item[2] is not waiter]
+                heapq.heapify(self._queue)
+                self._stats[waiter.lane]["timeouts"] += 1
+                # 先頭が抜けたことで下位のレーンが通れるようになるかもしれない
+                self._dispatch(time.monotonic())
+                raise QuotaWaitTimeout(f"quota wait exceeded {LANE_MAX_WAIT_SECONDS[waiter.lane]:.1f}s ({waiter.lane})")
+            return min(delay, remaining)
+
+    def _admitted(self, waiter: _Waiter, started: float) -> Ticket:
+        waited = time.monotonic() - started
+        with self._lock:
+            s = self._stats[waiter.lane]
+            s["admitted"] += 1
+            if waited > 0.001:
+                s["queued"] += 1
+            s["wait_seconds"] += waited
+            s["max_wait_seconds"] = max(s["max_wait_seconds"], waited)
+        if waited >= 1.0:
+            print(f"🚦 [{waiter.lane}] admitted after {waited:.1f}s in the Gemini quota queue")
+        return Ticket(waiter.lane, waiter.tokens, waited)
+
+    def admit(self, lane: str, tokens: int) -> Ticket:
+        """枠が空くまで（優先度順に）ブロックする"""
+        waiter = _Waiter(lane, tokens)
+        started = time.monotonic()
+        delay = self._enqueue(waiter)
+        while not waiter.admitted:
+            waiter.event.wait(delay)
+            delay = self._poll(waiter, started)
+        return self._admitted(waiter, started)
+
+    async def admit_async(self, lane: str, tokens: int) -> Ticket:
+        """admit の asyncio 版（待っている間イベントループを止めない）"""
+        waiter = _Waiter(lane, tokens, loop=asyncio.get_running_loop())
+        started = time.monotonic()
+        delay = self._enqueue(waiter)
+        try:
+            while not waiter.admitted:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = self._poll(waiter, started)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        return self._admitted(waiter, started)
+
+    def _abandon(self, waiter: _Waiter):
+        """待ちを取りやめた呼び出しを外す（既に通っていたら枠を返す）"""
+        with self._lock:
+            if waiter.admitted:
+                self._in_flight -= 1
+                self._requests.give_back(1)
+                self._tokens.give_back(waiter.tokens)
+            else:
+                self._queue = [item for item in self._queue if item[2] is not waiter]
+                heapq.heapify(self._queue)
+            self._dispatch(time.monotonic())
+
+    def release(self, ticket: Ticket, used_tokens: Optional[int] = None):
+        """呼び出し終了。used_tokens（実際の入力+出力）が分かれば見積もりとの差を精算する"""
+        with self._lock:
+            self._in_flight -= 1
+            if used_tokens is not None:
+                diff = ticket.tokens - used_tokens
+                if diff > 0:
+                    self._tokens.give_back(diff)
+                else:
+                    self._tokens.take(-diff)
+            self._dispatch(time.monotonic())
+
+    def throttle(self):
+        """429 を受けた（見積もりより実際のクォータが厳しい）ときに呼ぶ。バケットを空にして回復を待たせる"""
+        with self._lock:
+            self._throttled += 1
+            if not self._requests.unlimited:
+                self._requests.level = min(self._requests.level, 0.0)
+            if not self._tokens.unlimited:
+                self._tokens.level = min(self._tokens.level, 0.0)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._requests.refill(time.monotonic())
+            self._tokens.refill(time.monotonic())
+            queued = {lane: 0 for lane in LANES}
+            for _, _, waiter in self._queue:
+                queued[waiter.lane] += 1
+            return {
+                "in_flight": self._in_flight,
+                "max_concurrency": self.max_concurrency,
+                "queue_depth": queued,
+                "requests_available": None if self._requests.unlimited else round(self._requests.level, 1),
+                "tokens_available": None if self._tokens.unlimited else int(self._tokens.level),
+                "throttled": self._throttled,
+                "lanes": {
+                    lane: {
+                        **{k: (round(v, 3) if isinstance(v, float) else v) for k, v in s.items()},
+                        "avg_wait_seconds": round(s["wait_seconds"] / s["admitted"], 3) if s["admitted"] else 0.0,
+                    }
+                    for lane, s in self._stats.items()
+                },
+            }
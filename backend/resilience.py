@@ -0,0 +1,421 @@
+import asyncio
+import concurrent.futures
+import os
+import random
+import threading
+import time
+
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 再試行してよい HTTP ステータス（google.api_core の例外は gRPC のコードもここに対応付けられている）
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# ソケットのタイムアウト・接続断など、ステータスを持たない一時的なエラー
+_TRANSIENT_ERRORS = (TimeoutError, ConnectionError)
+
+# 同期呼び出しの締め切り・ヘッジ用。締め切りを過ぎた呼び出しはここで最後まで走らせて結果を捨てる。
+# 遅いステージの見捨てた呼び出しが他のステージを詰まらせないよう、プールはステージごとに分ける
+RESILIENCE_MAX_WORKERS = int(os.getenv("RESILIENCE_MAX_WORKERS", "16"))
+_executors: Dict[str, concurrent.futures.ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+class StageTimeout(TimeoutError):
+    """ステージの締め切り（1回あたり or 全体）を過ぎた"""
+
+    def __init__(self, stage: str, seconds: Optional[float]):
+        super().__init__(f"{stage} timed out" + (f" after {seconds:.1f}s" if seconds is not None else ""))
+        self.stage = stage
+
+
+class StagePolicy:
+    """
+    外部呼び出し1種類ぶんの設定。環境変数 RESILIENCE_<STAGE>_<NAME> で上書きできる。
+    timeout: 1回あたりの締め切り / deadline: 再試行と待ち時間を含めた全体の締め切り（0 で無制限）
+    hedge_after: この秒数で応答がなければ同じ呼び出しをもう1本投げ、早い方を使う（0 で無効）
+    retry_status: 再試行する HTTP ステータス / retry_timeouts: タイムアウト・接続断も再試行するか
+    """
+
+    def __init__(self, stage: str, timeout: float = 0.0, deadline: float = 0.0, attempts: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, hedge_after: float = 0.0,
+                 retry_status: Set[int] = RETRYABLE_STATUS, retry_timeouts: bool = True):
+        def env(name: str, default: float) -> float:
+            return float(os.getenv(f"RESILIENCE_{stage.upper()}_{name}", default))
+
+        self.stage = stage
+        self.timeout = env("TIMEOUT", timeout)
+        self.deadline = env("DEADLINE", deadline)
+        self.attempts = max(1, int(env("ATTEMPTS", attempts)))
+        self.backoff_base = env("BACKOFF_BASE", backoff_base)
+        self.backoff_max = env("BACKOFF_MAX", backoff_max)
+        self.hedge_after = env("HEDGE_AFTER", hedge_after)
+        self.retry_status = retry_status
+        self.retry_timeouts = retry_timeouts
+
+    def backoff(self, attempt: int) -> float:
+        """指数バックオフ（full jitter）。attempt は 0 始まり"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+# ステージごとの既定値
+POLICIES: Dict[str, StagePolicy] = {
+    # RAG は補助情報なので短く切り、駄目ならブレーカーで飛ばす
+    "search": StagePolicy("search", timeout=3.0, deadline=6.0, attempts=2, backoff_base=0.2, backoff_max=1.0),
+    "llm": StagePolicy("llm", timeout=60.0, deadline=150.0, attempts=3, backoff_base=1.0, backoff_max=8.0),
+    # Gmail は httplib2 側のタイムアウト（GMAIL_HTTP_TIMEOUT）が効いている
+    "gmail": StagePolicy("gmail", attempts=4),
+    # 送信はタイムアウト・接続断だと送れたかどうか分からないので、明示的に拒否されたときだけ再試行する
+    "gmail_send": StagePolicy("gmail_send", attempts=3, retry_status={429, 503}, retry_timeouts=False),
+}
+
+_stats_lock = threading.Lock()
+_stats = defaultdict(lambda: {
+    "calls": 0, "retries": 0, "timeouts": 0, "failures": 0,
+    "hedged": 0, "hedge_wins": 0,
+})
+_breakers: Dict[str, "CircuitBreaker"] = {}
+
+
+def _count(stage: str, **deltas):
+    with _stats_lock:
+        entry = _stats[stage]
+        for key, value in deltas.items():
+            entry[key] += value
+
+
+def policy(stage: str) -> StagePolicy:
+    if stage not in POLICIES:
+        POLICIES[stage] = StagePolicy(stage)
+    return POLICIES[stage]
+
+
+def error_status(exc: BaseException) -> Optional[int]:
+    """例外の HTTP ステータス（google.api_core の例外 / googleapiclient の HttpError）"""
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        return code
+    status = getattr(getattr(exc, "resp", None), "status", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_timeout(exc: BaseException) -> bool:
+    return isinstance(exc, (TimeoutError, asyncio.TimeoutError)) or error_status(exc) == 504
+
+
+def is_retryable(exc: BaseException, stage_policy: StagePolicy) -> bool:
+    if is_timeout(exc) or isinstance(exc, _TRANSIENT_ERRORS):
+        return stage_policy.retry_timeouts
+    return error_status(exc) in stage_policy.retry_status
+
+
+class CircuitBreaker:
+    """
+    連続 failure_threshold 回失敗したら reset_seconds の間は呼び出しを止める（open）。
+    時間が経ったら1回だけ試し（half-open）、成功すれば閉じ、失敗すればまた開く
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._opens = 0
+        self._short_circuited = 0
+        _breakers[name] = self
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state()
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            if state != "closed":
+                self._short_circuited += 1
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.failure_threshold):
+                print(f"🔌 Circuit '{self.name}' opened after {self._failures} consecutive failures")
+                self._opens += 1
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self._state(),
+                "consecutive_failures": self._failures,
+                "opens": self._opens,
+                "short_circuited": self._short_circuited,
+            }
+
+
+def _attempt_timeout(stage_policy: StagePolicy, started: float) -> Optional[float]:
+    """今回の試行の締め切り（秒）。全体の締め切りを超えていれば StageTimeout"""
+    limits = [t for t in (stage_policy.timeout,) if t > 0]
+    if stage_policy.deadline > 0:
+        remaining = stage_policy.deadline - (time.monotonic() - started)
+        if remaining <= 0:
+            raise StageTimeout(stage_policy.stage, stage_policy.deadline)
+        limits.append(remaining)
+    return min(limits) if limits else None
+
+
+def _retry_delay(stage_policy: StagePolicy, attempt: int, started: float, exc: BaseException) -> Optional[float]:
+    """再試行するなら待ち時間、しないなら None（失敗・タイムアウトの集計もここで行う）"""
+    stage = stage_policy.stage
+    if is_timeout(exc):
+        _count(stage, timeouts=1)
+    last = attempt + 1 >= stage_policy.attempts
+    delay = stage_policy.backoff(attempt)
+    over_deadline = stage_policy.deadline > 0 and time.monotonic() - started + delay >= stage_policy.deadline
+    if last or over_deadline or not is_retryable(exc, stage_policy):
+        _count(stage, failures=1)
+        return None
+    _count(stage, retries=1)
+    print(f"🔁 [{stage}] attempt {attempt + 1}/{stage_policy.attempts} failed ({type(exc).__name__}: {exc}); retrying in {delay:.2f}s")
+    return delay
+
+
+def _executor(stage: str) -> concurrent.futures.ThreadPoolExecutor:
+    with _executors_lock:
+        if stage not in _executors:
+            _executors[stage] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=RESILIENCE_MAX_WORKERS, thread_name_prefix=f"resilience-{stage}")
+        return _executors[stage]
+
+
+def _submit(stage: str, fn: Callable[[], Any], release: Optional[Callable[[Any], None]]) -> concurrent.futures.Future:
+    """fn をプールに投げる。release は fn が本当に終わった時点で（完了・失敗・キャンセルのどれでも）呼ぶ"""
+    future = _executor(stage).submit(fn)
+    if release is not None:
+        future.add_done_callback(lambda f: release(None if f.cancelled() or f.exception() is not None else f.result()))
+    return future
+
+
+def _admitted(fn: Callable[[], Any], admit: Callable[[], Callable[[Any], None]], settled: threading.Event) -> Callable[[], Any]:
+    """ヘッジ用: プール側で枠を確保してから fn を実行する。確保できた時点で相手が終わっていれば送らない"""
+    def run():
+        release = admit()
+        result = None
+        try:
+            if settled.is_set():
+                return None
+            result = fn()
+            return result
+        finally:
+            release(result)
+    return run
+
+
+def _wait_sync(stage_policy: StagePolicy, fn: Callable[[], Any], timeout: Optional[float],
+               release: Optional[Callable[[Any], None]] = None, admit: Optional[Callable[[], Callable[[Any], None]]] = None):
+    """fn をプールで走らせ、締め切りまで待つ。hedge_after を過ぎたら2本目を投げて早い方を返す"""
+    stage = stage_policy.stage
+    started = time.monotonic()
+    settled = threading.Event()
+    pending = {_submit(stage, fn, release)}
+    hedge = None
+    try:
+        while True:
+            wait_for = timeout - (time.monotonic() - started) if timeout is not None else None
+            if hedge is None and stage_policy.hedge_after > 0:
+                until_hedge = stage_policy.hedge_after - (time.monotonic() - started)
+                wait_for = until_hedge if wait_for is None else min(wait_for, until_hedge)
+            done, pending = concurrent.futures.wait(pending, timeout=max(wait_for, 0) if wait_for is not None else None,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if done:
+                future = next(iter(done))
+                if future.exception() is not None and pending:
+                    # 片方が失敗しても、もう片方がまだ走っていればそちらを待つ
+                    continue
+                if future is hedge:
+                    _count(stage, hedge_wins=1)
+                return future.result()
+            if timeout is not None and time.monotonic() - started >= timeout:
+                # プールの空き待ちでまだ始まっていない試行は取り消す（走り出したものは最後まで走る）
+                for future in pending:
+                    future.cancel()
+                raise StageTimeout(stage, timeout)
+            if hedge is None and stage_policy.hedge_after > 0:
+                _count(stage, hedged=1)
+                hedge = _executor(stage).submit(_admitted(fn, admit, settled) if admit is not None else fn)
+                pending.add(hedge)
+    finally:
+        settled.set()
+
+
+def _attempt_sync(stage_policy: StagePolicy, fn: Callable[[], Any], inline: bool, started: float,
+                  release: Optional[Callable[[Any], None]], admit: Optional[Callable[[], Callable[[Any], None]]]):
+    """1回の試行。プールに渡した試行の枠は、締め切りで見捨てた後もその試行が終わるまで返さない"""
+    handed_off = False
+    result = None
+    try:
+        timeout = _attempt_timeout(stage_policy, started)
+        if inline or (timeout is None and stage_policy.hedge_after <= 0):
+            result = fn()
+            return result
+        handed_off = True
+        return _wait_sync(stage_policy, fn, timeout, release, admit)
+    finally:
+        if release is not None and not handed_off:
+            release(result)
+
+
+def call(stage: str, fn: Callable[[], Any], inline: bool = False,
+         admit: Optional[Callable[[], Callable[[Any], None]]] = None) -> Any:
+    """
+    同期の外部呼び出しを stage の設定（締め切り・再試行・ヘッジ）で実行する。
+    inline=True は呼び出し元のスレッドでそのまま実行する（ヘッジなし）。fn 自身が締め切りを守る場合
+    （クライアントに timeout を渡している）や、スレッドをまたげないクライアント（httplib2）に使う。
+    admit を渡すと、試行（ヘッジの2本目を含む）ごとに送る前に呼んで枠を確保する。admit は release(result) を返し、
+    その送信が終わった時点で呼ばれる。枠の待ち時間は締め切りに含めず、admit の例外は再試行しない
+    """
+    stage_policy = policy(stage)
+    _count(stage, calls=1)
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        release = None
+        if admit is not None:
+            admit_started = time.monotonic()
+            release = admit()
+            started += time.monotonic() - admit_started
+        try:
+            return _attempt_sync(stage_policy, fn, inline, started, release, admit)
+        except Exception as e:
+            delay = _retry_delay(stage_policy, attempt, started, e)
+            if delay is None:
+                raise
+        time.sleep(delay)
+        attempt += 1
+
+
+async def _with_release(coro: Awaitable[Any], release: Optional[Callable[[Any], None]]):
+    """coro が（完了・失敗・キャンセルのどれでも）終わった時点で枠を返す"""
+    result = None
+    try:
+        result = await coro
+        return result
+    finally:
+        if release is not None:
+            release(result)
+
+
+async def _admitted_async(make_call: Callable[[], Awaitable[Any]], admit: Callable[[], Awaitable[Callable[[Any], None]]]):
+    release = await admit()
+    return await _with_release(make_call(), release)
+
+
+async def _hedged(stage_policy: StagePolicy, make_call: Callable[[], Awaitable[Any]],
+                  release: Optional[Callable[[Any], None]] = None,
+                  admit: Optional[Callable[[], Awaitable[Callable[[Any], None]]]] = None):
+    first = asyncio.ensure_future(_with_release(make_call(), release))
+    pending = {first}
+    try:
+        done, _ = await asyncio.wait({first}, timeout=stage_policy.hedge_after)
+        if done:
+            return first.result()
+
+        _count(stage_policy.stage, hedged=1)
+        hedge = asyncio.ensure_future(_admitted_async(make_call, admit) if admit is not None else make_call())
+        pending = {first, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            task = next(iter(done))
+            if task.exception() is not None and pending:
+                continue
+            if task is hedge:
+                _count(stage_policy.stage, hedge_wins=1)
+            return task.result()
+    finally:
+        # 締め切りでこのコルーチンごとキャンセルされた場合も、走っている試行を残さない
+        for task in pending:
+            task.cancel()
+
+
+async def _attempt_async(stage_policy: StagePolicy, make_call: Callable[[], Awaitable[Any]], started: float,
+                         release: Optional[Callable[[Any], None]],
+                         admit: Optional[Callable[[], Awaitable[Callable[[Any], None]]]]):
+    try:
+        timeout = _attempt_timeout(stage_policy, started)
+    except StageTimeout:
+        if release is not None:
+            release(None)
+        raise
+    if stage_policy.hedge_after > 0:
+        run = _hedged(stage_policy, make_call, release, admit)
+    else:
+        run = _with_release(make_call(), release)
+    if timeout is None:
+        # 締め切りなし: 呼び出し自身が投げた TimeoutError はそのまま返す
+        return await run
+    try:
+        return await asyncio.wait_for(run, timeout)
+    except asyncio.TimeoutError:
+        raise StageTimeout(stage_policy.stage, timeout)
+
+
+async def call_async(stage: str, make_call: Callable[[], Awaitable[Any]],
+                     admit: Optional[Callable[[], Awaitable[Callable[[Any], None]]]] = None) -> Any:
+    """
+    call の asyncio 版。make_call は試行ごとに新しいコルーチンを返す関数（締め切りを過ぎた試行はキャンセルする）。
+    admit は call と同じく試行ごとの枠の確保（こちらはコルーチン関数）
+    """
+    stage_policy = policy(stage)
+    _count(stage, calls=1)
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        release = None
+        if admit is not None:
+            admit_started = time.monotonic()
+            release = await admit()
+            started += time.monotonic() - admit_started
+        try:
+            return await _attempt_async(stage_policy, make_call, started, release, admit)
+        except Exception as e:
+            delay = _retry_delay(stage_policy, attempt, started, e)
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def resilience_stats() -> Dict[str, Any]:
+    with _stats_lock:
+        stages = {stage: dict(entry) for stage, entry in _stats.items()}
+    return {
+        "stages": stages,
+        "breakers": {name: breaker.stats() for name, breaker in _breakers.items()},
+    }
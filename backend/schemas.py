@@ -1,5 +1,6 @@
-from typing import List, Optional, Any, Dict, Literal, Union 
+from typing import List, Optional, Any, Dict, Iterable, Literal, Union 
 from datetime import datetime
+import re
 from pydantic import BaseModel, Field, field_validator
 
 CaseStatus = Literal[
@@ -36,6 +37,7 @@ class ClosureDraft(BaseModel):
     root_cause: str
     resolution_steps: Union[str, List[str], Any]
     prevention_measure: str
+    knowledge_title: Optional[str] = None
 
     @field_validator('resolution_steps', mode='before')
     @classmethod
@@ -70,6 +72,7 @@ class TimelineEvent(BaseModel):
     actor: str
     message: str
     metadata: Optional[Dict[str, Any]] = None
+    seq: Optional[int] = Field(default=None, description="1-based position in the case timeline")
 
 class Case(BaseModel):
     id: str
@@ -89,9 +92,68 @@ class Case(BaseModel):
     escalation_target: Optional[str] = Field(default=None, description="Suggested escalation department")    
 
     latest_proposal: Optional[AiProposal] = None
-    timeline: List[TimelineEvent] = Field(default_factory=list)
+    timeline: List[TimelineEvent] = Field(default_factory=list, description="Most recent events only; full history lives in cases/{id}/timeline")
+    timeline_count: int = Field(default=0, description="Total number of timeline events (0 for cases not yet migrated)")
+    history_summary: Optional[str] = Field(default=None, description="Rolling summary of timeline events up to summary_watermark")
+    summary_watermark: int = Field(default=0, description="seq of the last event folded into history_summary")
     waiting_for: List[str] = Field(default_factory=list)
 
+class TimelinePage(BaseModel):
+    items: List[TimelineEvent]
+    next_before: Optional[int] = None
+
+class CaseSummary(BaseModel):
+    """ケース一覧用の軽量ビュー（timeline / latest_proposal を含まない）"""
+    id: str
+    title: str
+    status: CaseStatus
+    priority: Priority
+    created_at: str
+    updated_at: str
+    next_contact_due: str
+
+    sender_email: Optional[str] = None
+    customer_name: Optional[str] = None
+    escalation_target: Optional[str] = None
+    waiting_for: List[str] = Field(default_factory=list)
+
+class CaseListPage(BaseModel):
+    items: List[CaseSummary]
+    next_cursor: Optional[str] = None
+
+_SIMPLE_FIELD = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+def diff_model_paths(before: Dict[str, Any], after: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+    """
+    model_dump() 同士を比較し、変更されたフィールドを {"a.b.c": 新しい値} で返す。
+    リストは丸ごと置換、キー構成が変わった dict や Firestore のパスにできないキーを持つ dict も丸ごと置換する。
+    """
+    changes: Dict[str, Any] = {}
+    for key, new_value in after.items():
+        path = f"{prefix}{key}"
+        old_value = before.get(key) if isinstance(before, dict) else None
+        if old_value == new_value:
+            continue
+        if (
+            isinstance(old_value, dict) and isinstance(new_value, dict)
+            and old_value.keys() == new_value.keys()
+            and all(_SIMPLE_FIELD.match(str(k)) for k in new_value)
+        ):
+            changes.update(diff_model_paths(old_value, new_value, prefix=f"{path}."))
+        else:
+            changes[path] = new_value
+    return changes
+
+class CaseChangeTracker:
+    """読み込んだ時点の Case を覚えておき、保存時に変更フィールドだけを取り出す"""
+
+    def __init__(self, case: "Case", update_time: Any = None):
+        self.snapshot = case.model_dump()
+        self.update_time = update_time
+
+    def changes(self, case: "Case") -> Dict[str, Any]:
+        return diff_model_paths(self.snapshot, case.model_dump())
+
 class CreateTriageRequest(BaseModel):
     title: str
     description: str
@@ -102,6 +164,7 @@ class CreateTriageRequest(BaseModel):
     gmail_thread_id: Optional[str] = None
 
     file_urls: List[str] = Field(default_factory=list)
+    regenerate: bool = Field(default=False, description="Bypass the generation cache")
 
 class ApprovedContent(BaseModel):
     reply_body: Optional[str] = None
@@ -117,10 +180,12 @@ class ReplyIngestRequest(BaseModel):
     reply_text: str
     new_logs: Optional[str] = None
     new_file_urls: List[str] = Field(default_factory=list)
+    regenerate: bool = Field(default=False, description="Bypass the generation cache")
 
 class CloseRequest(BaseModel):
     closure_note: str = ""
     publish_kb: bool = False
+    regenerate: bool = Field(default=False, description="Bypass the generation cache")
 
 class PubSubMessage(BaseModel):
     message: dict
@@ -128,3 +193,81 @@ class PubSubMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     user_query: str  
+    regenerate: bool = Field(default=False, description="Bypass the generation cache")
+
+class TriageResult(BaseModel):
+    proposal: AiProposal
+    escalation_target: Optional[str] = None
+    timings: Dict[str, float] = Field(default_factory=dict, description="Per-stage wall-clock seconds")
+    mode: Literal['split', 'combined'] = Field(default='split', description="Which triage path produced the result")
+
+class CombinedTriageOutput(BaseModel):
+    """まとめてトリアージ（1回の生成）の出力"""
+    proposal: AiProposal
+    reply_draft: EmailDraft
+    escalation_target: Optional[str] = None
+
+class EscalationDecision(BaseModel):
+    target: Optional[str] = Field(default=None, description='Team to escalate to, or "None" when Tier-3 should keep the case')
+    reason: str = ""
+
+IngestJobStatus = Literal['PENDING', 'LEASED', 'DONE', 'DEAD']
+
+class IngestJob(BaseModel):
+    id: str
+    kind: str
+    payload: Dict[str, Any] = Field(default_factory=dict)
+    status: IngestJobStatus = 'PENDING'
+    attempts: int = 0
+    available_at: float = 0.0
+    lease_until: Optional[float] = None
+    last_error: Optional[str] = None
+    created_at: float = 0.0
+    updated_at: float = 0.0
+
+def response_schema(model: type, exclude: Iterable[str] = ()) -> Dict[str, Any]:
+    """
+    pydantic モデルから Gemini の response_schema（OpenAPI のサブセット）を作る。
+    $ref は展開し、Optional は nullable、Any を含む Union は文字列として扱う。
+    exclude には生成させないフィールドを "proposal.reply_draft" のようなドット区切りで渡す。
+    """
+    raw = model.model_json_schema()
+    defs = raw.get("$defs", {})
+    excluded = set(exclude)
+
+    def convert(node: Dict[str, Any], prefix: str) -> Dict[str, Any]:
+        if "$ref" in node:
+            node = {**defs[node["$ref"].split("/")[-1]], **{k: v for k, v in node.items() if k != "$ref"}}
+        if "anyOf" in node:
+            options = [o for o in node["anyOf"] if o.get("type") != "null"]
+            if len(options) == 1:
+                out = convert(options[0], prefix)
+            elif any(not o for o in options):
+                out = {"type": "string"}
+            else:
+                out = {"anyOf": [convert(o, prefix) for o in options]}
+            if len(options) < len(node["anyOf"]):
+                out["nullable"] = True
+            if node.get("description"):
+                out["description"] = node["description"]
+            return out
+
+        out: Dict[str, Any] = {"type": node.get("type") or "string"}
+        if "enum" in node or "const" in node:
+            out["enum"] = node.get("enum", [node.get("const")])
+        if node.get("description"):
+            out["description"] = node["description"]
+        if out["type"] == "object":
+            out["properties"] = {
+                name: convert(sub, f"{prefix}{name}.")
+                for name, sub in node.get("properties", {}).items()
+                if f"{prefix}{name}" not in excluded
+            }
+            required = [r for r in node.get("required", []) if r in out["properties"]]
+            if required:
+                out["required"] = required
+        elif out["type"] == "array":
+            out["items"] = convert(node.get("items") or {}, prefix)
+        return out
+
+    return convert(raw, "")
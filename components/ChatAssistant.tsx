@@ -35,25 +35,44 @@ export function ChatAssistant({ caseId, onUpdated }: { caseId?: string; onUpdate
 
     const userMsg = input;
     setInput('');
-    setMessages(prev => [...prev, { role: 'user', content: userMsg }]);
+    setMessages(prev => [...prev, { role: 'user', content: userMsg }, { role: 'assistant', content: '' }]);
     setLoading(true);
+
+    // 生成中の応答は末尾の assistant メッセージを書き換えて表示する
+    const showPartial = (content: string) =>
+      setMessages(prev => [...prev.slice(0, -1), { role: 'assistant', content }]);
+
     try {
       let reply = "";
       
       if (caseId) {
-        const res = await api.chatAssistant(caseId, userMsg);
+        let comment = '';
+        let draft = '';
+        const res = await api.chatAssistantStream(caseId, userMsg, {
+          onDelta: ({ field, text }) => {
+            if (field === 'comment') comment += text;
+            else draft += text;
+            showPartial(draft ? `${comment}\n\n📝 ${draft}` : comment);
+          },
+        });
         reply = res.reply;
         if (res.updated_case && onUpdated) {
             onUpdated(res.updated_case);
         }
     } else {
-        const res = await api.chatGlobal(userMsg);
+        let partial = '';
+        const res = await api.chatGlobalStream(userMsg, {
+          onDelta: ({ text }) => {
+            partial += text;
+            showPartial(partial);
+          },
+        });
         reply = res.reply;
     }
 
-      setMessages(prev => [...prev, { role: 'assistant', content: reply }]);
+      showPartial(reply);
     } catch (err: any) {
-      setMessages(prev => [...prev, { role: 'assistant', content: `Error: ${err.message}` }]);
+      showPartial(`Error: ${err.message}`);
     } finally {
       setLoading(false);
     }
@@ -91,7 +110,7 @@ export function ChatAssistant({ caseId, onUpdated }: { caseId?: string; onUpdate
         </div>
       </div>
 
-      <div ref={scrollRef} className="flex-1 overflow-y-auto p-4 bg-slate-50 space-y-4">        {messages.map((m, i) => (
+      <div ref={scrollRef} className="flex-1 overflow-y-auto p-4 bg-slate-50 space-y-4">        {messages.filter(m => m.content).map((m, i) => (
           <div key={i} className={`flex ${m.role === 'user' ? 'justify-end' : 'justify-start'}`}>
             <div className={`max-w-[85%] rounded-lg px-3 py-2 text-sm whitespace-pre-wrap ${
               m.role === 'user' 
@@ -102,7 +121,7 @@ export function ChatAssistant({ caseId, onUpdated }: { caseId?: string; onUpdate
             </div>
           </div>
         ))}
-        {loading && (
+        {loading && !messages[messages.length - 1]?.content && (
           <div className="flex justify-start">
             <div className="bg-gray-200 text-gray-500 text-xs px-3 py-1 rounded-full animate-pulse">
               AI is thinking...
@@ -1,6 +1,8 @@
 'use client';
 
-import type { Case } from '@/types/api';
+import { useState } from 'react';
+import { api } from '@/lib/apiClient';
+import type { Case, TimelineEvent } from '@/types/api';
 
 function formatToJST(isoLike: string) {
   if (!isoLike) return '';
@@ -25,7 +27,25 @@ function formatToJST(isoLike: string) {
 }
 
 export function TimelinePanel({ c }: { c: Case }) {
-   const events = [...(c.timeline ?? [])].sort((a, b) => {
+  const [older, setOlder] = useState<TimelineEvent[]>([]);
+  const [loadingOlder, setLoadingOlder] = useState(false);
+
+  const loaded = [...(c.timeline ?? []), ...older];
+  const seqs = loaded.map((e) => e.seq).filter((s): s is number => typeof s === 'number');
+  const oldestSeq = seqs.length ? Math.min(...seqs) : undefined;
+  const hasOlder = (c.timeline_count ?? 0) > loaded.length && oldestSeq !== undefined && oldestSeq > 1;
+
+  const loadOlder = async () => {
+    setLoadingOlder(true);
+    try {
+      const page = await api.getTimeline(c.id, oldestSeq);
+      setOlder((prev) => [...prev, ...page.items]);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
+   const events = loaded.sort((a, b) => {
    const ta = Date.parse(a.timestamp);
    const tb = Date.parse(b.timestamp);
    if (Number.isNaN(ta) || Number.isNaN(tb)) return a.timestamp < b.timestamp ? 1 : -1;
@@ -55,6 +75,15 @@ export function TimelinePanel({ c }: { c: Case }) {
           </div>
         ))}
         {events.length === 0 && <div className="opacity-60">No timeline events</div>}
+        {hasOlder && (
+          <button
+            className="text-xs underline opacity-70 disabled:opacity-40"
+            onClick={loadOlder}
+            disabled={loadingOlder}
+          >
+            {loadingOlder ? 'Loading...' : 'Load older events'}
+          </button>
+        )}
       </div>
     </div>
   );
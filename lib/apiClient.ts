@@ -1,5 +1,7 @@
 import type {
   Case,
+  CaseListPage,
+  TimelinePage,
   CreateTriageRequest,
   ApproveRequest,
   ReplyIngestRequest,
@@ -37,14 +39,75 @@ async function http<T>(path: string, init?: RequestInit): Promise<T> {
   return (await res.json()) as T;
 }
 
+export type SseHandlers<TDelta, TDone> = {
+  onDelta?: (delta: TDelta) => void;
+  onDone?: (result: TDone) => void;
+};
+
+async function sse<TDelta, TDone>(path: string, body: unknown, handlers: SseHandlers<TDelta, TDone>): Promise<TDone> {
+  const res = await fetch(`${API_BASE}${path}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', Accept: 'text/event-stream' },
+    body: JSON.stringify(body),
+    cache: 'no-store',
+  });
+  if (!res.ok || !res.body) {
+    const text = await res.text().catch(() => '');
+    throw new Error(text || `API Error ${res.status}`);
+  }
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let result: TDone | undefined;
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let sep: number;
+    while ((sep = buffer.indexOf('\n\n')) >= 0) {
+      const raw = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      let event = 'message';
+      let data = '';
+      for (const line of raw.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) data += line.slice(5).trim();
+      }
+      if (!data) continue;
+      const payload = JSON.parse(data);
+      if (event === 'delta') handlers.onDelta?.(payload as TDelta);
+      else if (event === 'done') {
+        result = payload as TDone;
+        handlers.onDone?.(result);
+      } else if (event === 'error') throw new Error(payload.detail ?? `API Error ${payload.status}`);
+    }
+  }
+
+  if (result === undefined) throw new Error('Stream ended before completion');
+  return result;
+}
+
 export const api = {
-  listCases: (status?: string) => {
-    const qs = status && status !== 'ALL' ? `?status=${encodeURIComponent(status)}` : '';
-    return http<Case[]>(`/cases${qs}`);
+  listCases: (status?: string, opts?: { limit?: number; cursor?: string }) => {
+    const params = new URLSearchParams();
+    if (status && status !== 'ALL') params.set('status', status);
+    if (opts?.limit) params.set('limit', String(opts.limit));
+    if (opts?.cursor) params.set('cursor', opts.cursor);
+    const qs = params.toString() ? `?${params.toString()}` : '';
+    return http<CaseListPage>(`/cases${qs}`);
   },
 
   getCase: (caseId: string) => http<Case>(`/cases/${encodeURIComponent(caseId)}`),
 
+  getTimeline: (caseId: string, before?: number, limit = 50) => {
+    const params = new URLSearchParams({ limit: String(limit) });
+    if (before) params.set('before', String(before));
+    return http<TimelinePage>(`/cases/${encodeURIComponent(caseId)}/timeline?${params.toString()}`);
+  },
+
   triage: (payload: CreateTriageRequest) =>
     http<Case>(`/triage`, {
       method: 'POST',
@@ -88,19 +151,34 @@ export const api = {
     }
   },
 
-  chatAssistant: (caseId: string, query: string) =>
+  chatAssistant: (caseId: string, query: string, regenerate = false) =>
     http<{ status: string; reply: string; updated_case?: Case }>(
       `/cases/${encodeURIComponent(caseId)}/chat`, 
       {
         method: 'POST',
-        body: JSON.stringify({ user_query: query }),
+        body: JSON.stringify({ user_query: query, regenerate }),
       }
     ),
 
-  chatGlobal: (query: string) =>
+  chatGlobal: (query: string, regenerate = false) =>
     http<{ status: string; reply: string }>('/global/chat', {
       method: 'POST',
-      body: JSON.stringify({ user_query: query }),
+      body: JSON.stringify({ user_query: query, regenerate }),
     }),
 
+  chatAssistantStream: (
+    caseId: string,
+    query: string,
+    handlers: SseHandlers<{ field: string; text: string }, { status: string; reply: string; updated_case?: Case }>,
+    regenerate = false,
+  ) =>
+    sse(`/cases/${encodeURIComponent(caseId)}/chat/stream`, { user_query: query, regenerate }, handlers),
+
+  chatGlobalStream: (
+    query: string,
+    handlers: SseHandlers<{ text: string }, { status: string; reply: string }>,
+    regenerate = false,
+  ) =>
+    sse('/global/chat/stream', { user_query: query, regenerate }, handlers),
+
 };
\ No newline at end of file
@@ -69,6 +69,12 @@ export interface TimelineEvent {
   actor: 'SYSTEM' | 'AI' | 'USER' | 'ENGINEER';
   message: string;
   metadata?: Record<string, unknown>;
+  seq?: number;
+}
+
+export interface TimelinePage {
+  items: TimelineEvent[];
+  next_before?: number | null;
 }
 
 export interface Case {
@@ -90,9 +96,31 @@ export interface Case {
   escalation_target?: string | null;
   latest_proposal?: AiProposal;
   timeline: TimelineEvent[];
+  timeline_count?: number;
+  history_summary?: string | null;
+  summary_watermark?: number;
   waiting_for: string[];
 }
 
+export interface CaseSummary {
+  id: string;
+  title: string;
+  status: CaseStatus;
+  priority: Priority;
+  created_at: string;
+  updated_at: string;
+  next_contact_due: string;
+  sender_email?: string;
+  customer_name?: string;
+  escalation_target?: string | null;
+  waiting_for: string[];
+}
+
+export interface CaseListPage {
+  items: CaseSummary[];
+  next_cursor?: string | null;
+}
+
 export interface CreateTriageRequest {
   title: string;
   description: string;
@@ -100,6 +128,7 @@ export interface CreateTriageRequest {
   sender_email?: string;
   file_urls?: string[]; 
   sender_name?: string;
+  regenerate?: boolean;
 }
 
 export type ApproveActionType = 'SEND_REPLY' | 'EXECUTE_FIX' | 'JUST_UPDATE_STATUS';
@@ -117,9 +146,11 @@ export interface ApproveRequest {
 export interface ReplyIngestRequest {
   reply_text: string;
   new_logs?: string;
+  regenerate?: boolean;
 }
 
 export interface CloseRequest {
   closure_note: string;
   publish_kb: boolean;
+  regenerate?: boolean;
 }